@@ -1,9 +1,17 @@
 import os, io, csv, json, datetime
-import pandas as pd
-from flask import Blueprint, render_template, request, redirect, url_for, flash, send_file, abort, session, jsonify, current_app
+from flask import Blueprint, render_template, request, redirect, url_for, flash, abort, session, jsonify, current_app, Response, stream_with_context
 from dateutil import parser as dateparser
-from db import db, now_iso, fetch_offer_snapshot
+from db import db, now_iso, fetch_offer_snapshot, db_stats, SQL_TRACE
 from itsdangerous import URLSafeTimedSerializer
+import http_client
+import landing_cache
+import sql_trace
+import upload_jobs
+from parallel import LazyPool, sign_link_tokens
+from upload_reader import UploadReadError, read_chunks
+from snapshots import store_snapshot, set_head, product_key_for, view_cache_stats
+from upload_validation import UploadFormatError, resolve_columns
+from integration_results import COMMUNICATION, ORDER, result_from_attempt
 try:
     from version import get_version
     PROJECT_VERSION = get_version()
@@ -126,6 +134,40 @@ def dashboard():
         version=PROJECT_VERSION,
     )
 
+# ---------- Runtime stats ----------
+@bp.get("/stats.json")
+def runtime_stats():
+    """Runtime counters of the worker that served this request (each gunicorn worker has its own)"""
+    import sys
+    tracker = getattr(sys.modules.get("app"), "link_tracker", None)
+    return jsonify({
+        "pid": os.getpid(),
+        "http_pools": http_client.pool_stats(),
+        "db_pool": db_stats(),
+        "offer_views": view_cache_stats(),
+        "landing_render_cache": landing_cache.stats(),
+        "link_tracking": tracker.stats() if tracker is not None else None,
+    })
+
+# ---------- SQL trace ----------
+SQL_TRACE_ORDERS = ("total_seconds", "max_seconds", "count", "slow")
+
+
+@bp.get("/sql")
+def sql_trace_view():
+    """Slowest statement shapes seen by this worker in trace mode (SQL_TRACE=1)"""
+    order = request.args.get("order") if request.args.get("order") in SQL_TRACE_ORDERS else "total_seconds"
+    return render_template("admin/sql_trace.html", rows=sql_trace.top(order=order), order=order,
+                           orders=SQL_TRACE_ORDERS, enabled=SQL_TRACE,
+                           slow_ms=sql_trace.SQL_SLOW_MS, pid=os.getpid())
+
+
+@bp.post("/sql/reset")
+def sql_trace_reset():
+    sql_trace.reset()
+    flash("Статистика SQL этого воркера сброшена", "success")
+    return redirect(url_for("admin.sql_trace_view"))
+
 # ---------- Offers CRUD ----------
 @bp.get("/offers")
 def offers_list():
@@ -429,16 +471,7 @@ def offer_save():
             snap = fetch_offer_snapshot(c, offer_id)
             if snap:
                 # Update only new links created after we started filling product_key
-                order_mapping = snap.get("order_mapping") or {}
-                product_key = None
-                try:
-                    po_offer_id = order_mapping.get("product_offer_id")
-                    po_struct_id = order_mapping.get("product_offer_struct_id")
-                    po_elem_id = order_mapping.get("po_struct_element_id")
-                    if po_offer_id is not None and po_struct_id is not None and po_elem_id is not None:
-                        product_key = f"{int(po_offer_id)}:{int(po_struct_id)}:{int(po_elem_id)}"
-                except (ValueError, TypeError):
-                    product_key = None
+                product_key = product_key_for(snap)
 
                 # Counts for warning (old links have product_key=NULL)
                 c.execute("SELECT COUNT(*) as cnt FROM links WHERE offer_id=?", (offer_id,))
@@ -451,19 +484,16 @@ def offer_save():
                                   FROM links
                                   WHERE offer_id=? AND product_key=? AND product_key IS NOT NULL""",
                               (offer_id, product_key))
-                    eligible_links = c.fetchone()["cnt"]
+                    updated_count = c.fetchone()["cnt"]
 
-                    c.execute("""UPDATE links
-                                  SET offer_snapshot_json = ?
-                                  WHERE offer_id = ? AND product_key = ? AND product_key IS NOT NULL""",
-                              (json.dumps(snap, ensure_ascii=False), offer_id, product_key))
-                    updated_count = c.rowcount
+                    # Links of this product follow the head: one pointer update refreshes all of them
+                    set_head(c, offer_id, product_key, store_snapshot(c, snap))
                     if updated_count > 0:
                         debug_messages.append(
                             f"✅ Обновлён снимок для {updated_count} ссылок (product_key={product_key}) — "
                             f"на лендинге отображается текущий состав услуг"
                         )
-                    elif eligible_links == 0:
+                    else:
                         debug_messages.append(
                             f"⚠️ Для этого предложения не найдено ни одной ссылки с product_key={product_key} "
                             f"(всего ссылок: {total_links})."
@@ -481,6 +511,8 @@ def offer_save():
                     )
             
             conn.commit()
+            # Rendered landing shells of the old snapshots are no longer served
+            landing_cache.evict_offer(offer_id)
             # Store debug messages in session for display on the form
             session['offer_save_debug'] = debug_messages
             # Stay on edit page when editing
@@ -530,7 +562,7 @@ def upload_delete(upload_id):
         c = conn.cursor()
         
         # Проверить, существует ли загрузка
-        c.execute("SELECT id, filename FROM bulk_uploads WHERE id=?", (upload_id,))
+        c.execute("SELECT id, filename, file_path FROM bulk_uploads WHERE id=?", (upload_id,))
         upload = c.fetchone()
         if not upload:
             flash("Загрузка не найдена", "danger")
@@ -559,6 +591,8 @@ def upload_delete(upload_id):
         # Удалить саму загрузку
         c.execute("DELETE FROM bulk_uploads WHERE id=?", (upload_id,))
         conn.commit()
+        # Файл ещё не обработанной загрузки (фоновое задание остановится само)
+        upload_jobs.remove_file(upload["file_path"])
         
         flash(f"Загрузка '{upload['filename']}' удалена. Удалено {deleted_links} ссылок и {deleted_consents} согласий.", "info")
     
@@ -589,358 +623,135 @@ def upload_new():
         return redirect(url_for("admin.upload_form"))
 
     filename = file.filename
+    # The upload is processed by a background job (upload_jobs.py); here the file is saved and
+    # only its header is read, so format errors are still reported right away
     try:
-        if filename.lower().endswith(".csv"):
-            # Read file content to handle encoding detection
-            file.seek(0)
-            file_content = file.read()
-            
-            # Try UTF-8 first, then Windows-1251 if it fails
-            try:
-                # Try to decode as UTF-8
-                content_str = file_content.decode('utf-8')
-                df = pd.read_csv(io.StringIO(content_str))
-            except (UnicodeDecodeError, UnicodeError):
-                try:
-                    # Try Windows-1251 encoding
-                    content_str = file_content.decode('windows-1251')
-                    df = pd.read_csv(io.StringIO(content_str))
-                except Exception as e:
-                    flash(f"Failed to parse CSV file. Tried UTF-8 and Windows-1251. Error: {e}", "danger")
-                    return redirect(url_for("admin.upload_form"))
-        else:
-            df = pd.read_excel(file)
-    except Exception as e:
-        flash(f"Failed to parse file: {e}", "danger")
+        path = upload_jobs.save_file(file, current_app.config["UPLOAD_DIR"])
+    except OSError as e:
+        flash(f"Failed to save file: {e}", "danger")
         return redirect(url_for("admin.upload_form"))
-
-    # Check for customer_account_id column (case insensitive)
-    customer_col = None
-    df_columns_lower = [c.lower().strip() for c in df.columns]
-    for col in df.columns:
-        if col.lower().strip() == "customer_account_id":
-            customer_col = col
-            break
-    
-    if not customer_col:
-        available_cols = ", ".join([f"'{c}'" for c in df.columns[:10]])
-        if len(df.columns) > 10:
-            available_cols += f", ... ({len(df.columns)} total columns)"
-        flash(f"File must contain 'customer_account_id' column. Found columns: {available_cols}", "danger")
+    try:
+        with open(path, "rb") as fh:
+            df = next(read_chunks(fh, filename, 1))  # first chunk carries the header
+    except UploadReadError as e:
+        upload_jobs.remove_file(path)
+        flash(str(e), "danger")
         return redirect(url_for("admin.upload_form"))
-    
-    # Check for filial_id column (case insensitive)
-    filial_col = None
-    for col in df.columns:
-        if col.lower().strip() == "filial_id":
-            filial_col = col
-            break
-    
-    if not filial_col:
-        available_cols = ", ".join([f"'{c}'" for c in df.columns[:10]])
-        if len(df.columns) > 10:
-            available_cols += f", ... ({len(df.columns)} total columns)"
-        flash(f"File must contain 'filial_id' column. Found columns: {available_cols}", "danger")
+    except Exception as e:
+        upload_jobs.remove_file(path)
+        flash(f"Failed to parse file: {e}", "danger")
         return redirect(url_for("admin.upload_form"))
 
-    # Optional: CRM CUSTOMER_ID (для Communication API / потенциальная сделка)
-    customer_id_col = None
-    for col in df.columns:
-        if col.lower().strip() == "customer_id":
-            customer_id_col = col
-            break
-
-    # Optional: subscriber name and identification number (IIN/BIN)
-    name_col = None
-    for col in df.columns:
-        if col.lower().strip() in ("name", "full_name", "customer_name", "contact_name"):
-            name_col = col
-            break
-
-    identification_col = None
-    for col in df.columns:
-        if col.lower().strip() in ("identification_number", "iin", "iin_bin", "iin/bin", "bin"):
-            identification_col = col
-            break
-
-    # Check for required address columns in file
-    address_columns = {
-        "town_name": "TOWN_NAME",
-        "street_name": "STREET_NAME",
-        "street_id": "STREET_ID",  # Keep for API compatibility
-        "house": "HOUSE",
-        "sub_house": "SUB_HOUSE",
-        "flat": "FLAT",
-        "sub_flat": "SUB_FLAT",
-        "zip_code": "ZIP_CODE"
-    }
-    required_address_cols = ["street_name", "house"]
-    optional_address_cols = ["town_name", "sub_house", "flat", "sub_flat", "zip_code", "street_id"]
-    
-    # Check if required address columns exist (case insensitive)
-    df_columns_lower = [c.lower() for c in df.columns]
-    missing_cols = []
-    for col in required_address_cols:
-        if col.lower() not in df_columns_lower:
-            missing_cols.append(col)
-    
-    if missing_cols:
-        flash(f"File must contain required address columns: {', '.join(missing_cols)}", "danger")
+    # Resolve columns (case insensitive); rows are validated column-wise by the job
+    try:
+        cols = resolve_columns(df.columns)
+    except UploadFormatError as e:
+        upload_jobs.remove_file(path)
+        flash(str(e), "danger")
         return redirect(url_for("admin.upload_form"))
-    
-    # Map Excel column names to API keys (case insensitive)
-    column_mapping = {}
-    for excel_col in address_columns.keys():
-        for df_col in df.columns:
-            if df_col.lower().strip() == excel_col.lower().strip():
-                column_mapping[excel_col] = df_col
-                break
-    
-    # Debug: Check if required address columns were found
-    missing_address_cols = [col for col in required_address_cols if col not in column_mapping]
-    if missing_address_cols:
-        available_cols = ", ".join([f"'{c}'" for c in df.columns])
-        flash(f"Warning: Some required address columns not found: {', '.join(missing_address_cols)}. Available columns: {available_cols}", "warning")
+    for warning in cols["warnings"]:
+        flash(warning, "warning")
 
-    # create bulk_upload record
+    # create bulk_upload record (queued job)
     expires_at = (datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(days=expires_in_days)).isoformat()
     with db() as conn:
         c = conn.cursor()
-        c.execute("""INSERT INTO bulk_uploads (filename, uploaded_at, offer_id, expires_at, count_total)
-                     VALUES (?, ?, ?, ?, ?)""",
-                  (filename, now_iso(), offer_id, expires_at, int(len(df))))
-        upload_id = c.lastrowid
-
         # prepare offer snapshot
         snap = fetch_offer_snapshot(c, offer_id)
         if not snap:
-            conn.rollback()
+            upload_jobs.remove_file(path)
             flash("Offer not found.", "danger")
             return redirect(url_for("admin.upload_form"))
 
         # Product binding key (new links only)
         # Format: product_offer_id:product_offer_struct_id:po_struct_element_id
-        product_key = None
-        try:
-            om = snap.get("order_mapping") or {}
-            po_offer_id = om.get("product_offer_id")
-            po_struct_id = om.get("product_offer_struct_id")
-            po_elem_id = om.get("po_struct_element_id")
-            if po_offer_id is not None and po_struct_id is not None and po_elem_id is not None:
-                product_key = f"{int(po_offer_id)}:{int(po_struct_id)}:{int(po_elem_id)}"
-        except (ValueError, TypeError):
-            product_key = None
-
-        # iterate customers
-        created = 0
-        row_counter = 0
-        errors = []
-        for idx, row_data in df.iterrows():
-            row_counter += 1
-            
-            # Get customer_account_id value
-            val = row_data.get(customer_col)
-            
-            # Debug: Show first row details if error
-            if row_counter == 1 and (pd.isna(val) or val == "" or val is None):
-                # Show available columns and first row data for debugging
-                debug_info = f"Column '{customer_col}' found. First row value: {repr(val)}. Available columns: {list(df.columns)[:5]}"
-                errors.append(f"Row {row_counter}: Missing customer_account_id. {debug_info}")
-                continue
-            
-            if pd.isna(val) or val == "" or val is None:
-                errors.append(f"Row {row_counter}: Missing customer_account_id (empty or NaN)")
-                continue
-            
-            # Convert to string and clean
-            val_str = str(val).strip()
-            if not val_str or val_str.lower() in ['nan', 'none', 'null', '']:
-                errors.append(f"Row {row_counter}: Missing customer_account_id (value: '{val}')")
-                continue
-            
-            # Try to convert to integer (handle float values like 123.0)
-            try:
-                # First try as float to handle "123.0" cases, then convert to int
-                customer_account_id = int(float(val_str))
-            except (ValueError, TypeError) as e:
-                errors.append(f"Row {row_counter}: Invalid customer_account_id (value: '{val}', type: {type(val).__name__}, error: {str(e)})")
-                continue
-            
-            if customer_account_id <= 0:
-                errors.append(f"Row {row_counter}: Invalid customer_account_id (must be positive, got: {customer_account_id})")
-                continue
-            
-            # Get filial_id from Excel file
-            filial_id_val = row_data.get(filial_col)
-            if pd.isna(filial_id_val) or filial_id_val == "":
-                errors.append(f"Row {row_counter}: Missing 'filial_id' for customer_account_id {customer_account_id}")
-                continue
-            try:
-                filial_id = int(filial_id_val)
-            except (ValueError, TypeError):
-                errors.append(f"Row {row_counter}: Invalid 'filial_id' for customer_account_id {customer_account_id}")
-                continue
-            
-            # Build address from Excel file (required for each user)
-            address = {}
-            for excel_col, api_key in address_columns.items():
-                if excel_col in column_mapping:
-                    df_col = column_mapping[excel_col]
-                    val = row_data.get(df_col)
-                    if pd.notna(val) and val != "" and str(val).strip().lower() not in ['nan', 'none', 'null']:
-                        if api_key in ("STREET_ID", "HOUSE", "FLAT"):
-                            try:
-                                # Handle float values like 123.0
-                                address[api_key] = int(float(str(val)))
-                            except (ValueError, TypeError) as e:
-                                errors.append(f"Row {row_counter}: Invalid '{excel_col}' value '{val}' for customer_account_id {customer_account_id} (must be a number)")
-                                break
-                        elif api_key == "ZIP_CODE":
-                            # ZIP_CODE should be an integer stored as a string
-                            try:
-                                zip_int = int(float(str(val)))
-                                address[api_key] = str(zip_int)
-                            except (ValueError, TypeError) as e:
-                                errors.append(f"Row {row_counter}: Invalid '{excel_col}' value '{val}' for customer_account_id {customer_account_id} (must be a number)")
-                                break
-                        else:
-                            # For text fields: TOWN_NAME, STREET_NAME, SUB_HOUSE, SUB_FLAT
-                            address[api_key] = str(val).strip() or None
-                    elif excel_col in required_address_cols:
-                        # Required field is missing for this row
-                        val_repr = repr(val) if val is not None else "None"
-                        errors.append(f"Row {row_counter}: Missing required address field '{excel_col}' for customer_account_id {customer_account_id} (column '{df_col}' value: {val_repr})")
-                        break
-                elif excel_col in required_address_cols:
-                    # Column not found in file
-                    errors.append(f"Row {row_counter}: Required address column '{excel_col}' not found in file for customer_account_id {customer_account_id}")
-                    break
-            
-            # If we hit an error in the loop above, skip this row
-            if any(f"Row {row_counter}" in err and customer_account_id in err for err in errors[-3:]):
-                continue
-            
-            # Validate required fields are present
-            if "STREET_NAME" not in address or not address["STREET_NAME"]:
-                street_val = row_data.get(column_mapping.get("street_name", "N/A"), "N/A")
-                errors.append(f"Row {row_counter}: Missing or invalid 'street_name' for customer_account_id {customer_account_id} (found value: {repr(street_val)})")
-                continue
-            if "HOUSE" not in address or address["HOUSE"] is None:
-                house_val = row_data.get(column_mapping.get("house", "N/A"), "N/A")
-                errors.append(f"Row {row_counter}: Missing or invalid 'house' for customer_account_id {customer_account_id} (found value: {repr(house_val)})")
-                continue
-            
-            # Clean up None values for optional fields
-            optional_fields = ["SUB_HOUSE", "FLAT", "SUB_FLAT", "TOWN_NAME", "ZIP_CODE", "STREET_ID"]
-            for field in optional_fields:
-                if address.get(field) is None:
-                    address.pop(field, None)
-            
-            # Get phone from Excel file (if available)
-            phone = None
-            if "phone" in df.columns:
-                phone_val = row_data.get("phone")
-                if pd.notna(phone_val) and phone_val != "":
-                    # Remove .0 suffix if phone was stored as float (e.g., 77089244226.0 -> 77089244226)
-                    phone_str = str(phone_val).strip()
-                    if phone_str.endswith('.0'):
-                        phone_str = phone_str[:-2]
-                    phone = phone_str
-
-            subscriber_name = None
-            if name_col:
-                nv = row_data.get(name_col)
-                if pd.notna(nv) and str(nv).strip() and str(nv).strip().lower() not in ("nan", "none", "null", ""):
-                    subscriber_name = str(nv).strip()
-
-            identification_number = None
-            if identification_col:
-                iv = row_data.get(identification_col)
-                if pd.notna(iv) and str(iv).strip() and str(iv).strip().lower() not in ("nan", "none", "null", ""):
-                    identification_number = str(iv).strip()
-                    # If Excel parsed IIN as float (e.g. 7802....0), trim the suffix
-                    if identification_number.endswith(".0"):
-                        identification_number = identification_number[:-2]
-
-            parsed_customer_id = None
-            if customer_id_col:
-                cv = row_data.get(customer_id_col)
-                if pd.notna(cv) and str(cv).strip() and str(cv).strip().lower() not in (
-                    "nan", "none", "null", "",
-                ):
-                    try:
-                        parsed_customer_id = int(float(str(cv).strip()))
-                    except (ValueError, TypeError):
-                        parsed_customer_id = None
-                    if parsed_customer_id is not None and parsed_customer_id <= 0:
-                        parsed_customer_id = None
-
-            # find or create user by customer_account_id
-            c.execute(
-                "SELECT id, filial_id, phone, customer_id, name, identification_number FROM users WHERE customer_account_id=?",
-                (customer_account_id,),
-            )
-            u = c.fetchone()
-            if u:
-                user_id = u["id"]
-                # Update filial_id if it has changed
-                if u["filial_id"] != filial_id:
-                    c.execute("UPDATE users SET filial_id=? WHERE id=?", (filial_id, user_id))
-                # Update phone if provided and different
-                if phone and u["phone"] != phone:
-                    c.execute("UPDATE users SET phone=? WHERE id=?", (phone, user_id))
-                if parsed_customer_id is not None and u["customer_id"] != parsed_customer_id:
-                    c.execute("UPDATE users SET customer_id=? WHERE id=?", (parsed_customer_id, user_id))
-                if subscriber_name and u["name"] != subscriber_name:
-                    c.execute("UPDATE users SET name=? WHERE id=?", (subscriber_name, user_id))
-                if identification_number and u["identification_number"] != identification_number:
-                    c.execute("UPDATE users SET identification_number=? WHERE id=?", (identification_number, user_id))
-            else:
-                c.execute(
-                    """INSERT INTO users (name, phone, identification_number, email, filial_id, customer_account_id, customer_id)
-                       VALUES (?, ?, ?, ?, ?, ?, ?)""",
-                    (subscriber_name, phone, identification_number, None, filial_id, customer_account_id, parsed_customer_id),
-                )
-                user_id = c.lastrowid
-
-            # insert link row (token to be added after we know link_id)
-            created_at = now_iso()
-            c.execute("""INSERT INTO links (upload_id, user_id, offer_id, external_id,
-                                            created_at, expires_at, status, offer_snapshot_json, product_key, address_json)
-                         VALUES (?, ?, ?, ?, ?, ?, 'NEW', ?, ?, ?)""",
-                      (upload_id, user_id, offer_id, f"{external_prefix}-{upload_id}-{row_counter}",
-                       created_at, expires_at, json.dumps(snap), product_key, json.dumps(address)))
-            link_id = c.lastrowid
-
-            created += 1
-
-        # Check if any valid rows were processed
-        if created == 0:
-            conn.rollback()
-            if errors:
-                for err in errors[:10]:  # Show first 10 errors
-                    flash(err, "danger")
-                if len(errors) > 10:
-                    flash(f"... and {len(errors) - 10} more errors", "danger")
-            else:
-                flash("No valid rows found in file. Please check the file format.", "danger")
-            return redirect(url_for("admin.upload_form"))
-        
-        # Show errors but continue if some rows were valid
-        if errors:
-            for err in errors[:5]:  # Show first 5 errors
-                flash(err, "warning")
-            if len(errors) > 5:
-                flash(f"... and {len(errors) - 5} more rows had errors", "warning")
-
-        # fetch BASE_URL & signer from app config (via current_app later)
+        product_key = product_key_for(snap)
+
+        # Snapshot is stored once (content-addressed); links only reference it.
+        # The product head moves when the job finishes with links.
+        snapshot_id = store_snapshot(c, snap)
+        c.execute("""INSERT INTO bulk_uploads (filename, uploaded_at, offer_id, expires_at, count_total, status,
+                                               file_path, external_prefix, snapshot_id, product_key)
+                     VALUES (?, ?, ?, ?, 0, 'QUEUED', ?, ?, ?, ?)""",
+                  (filename, now_iso(), offer_id, expires_at, path, external_prefix, snapshot_id, product_key))
+        upload_id = c.lastrowid
         conn.commit()
 
-    flash(f"Upload created: {created} links queued (tokens will be assigned on first visit or via /admin/uploads/<id>).", "success")
+    import sys
+    runner = getattr(sys.modules.get("app"), "upload_job_runner", None)
+    if runner is not None:
+        runner.wake()  # otherwise another worker's runner picks it up on its next poll
+    flash(f"Upload #{upload_id} queued: rows are processed in the background, progress is shown below.", "info")
     return redirect(url_for("admin.upload_detail", upload_id=upload_id))
 
+
+@bp.get("/uploads/<int:upload_id>/progress")
+def upload_progress(upload_id):
+    with db() as conn:
+        row = conn.execute("SELECT * FROM bulk_uploads WHERE id=?", (upload_id,)).fetchone()
+    if not row:
+        abort(404)
+    return jsonify(upload_jobs.progress(row))
+
+# Filters of the upload page: link status and the outcome of the order / communication call
+LINK_STATUSES = ("NEW", "OPENED", "AGREED", "REJECTED", "EXPIRED")
+RESULT_FILTERS = ("ok", "failed", "none")
+
+def _result_filter_sql(kind, value):
+    """WHERE fragment for an integration result filter (indexed *_success columns)."""
+    if value == "ok":
+        return f"l.{kind}_success = 1"
+    if value == "failed":
+        return f"l.{kind}_success = 0"
+    return f"l.{kind}_success IS NULL"
+
+def _links_base_url():
+    # Use BASE_URL from config if available, otherwise fall back to request.url_root
+    try:
+        base_url = current_app.config.get("BASE_URL")
+        # If BASE_URL is not set or is the default localhost, try to use request.url_root
+        if not base_url or base_url == "http://localhost:5000":
+            base_url = request.url_root.strip("/")
+        # If still localhost and we're not in development, log a warning
+        if base_url.startswith("http://localhost") and current_app.config.get("FLASK_ENV") != "development":
+            import logging
+            logging.warning(f"BASE_URL is set to localhost ({base_url}). Please set BASE_URL environment variable.")
+    except RuntimeError:
+        # Outside of application context, use request.url_root
+        base_url = request.url_root.strip("/")
+    return base_url
+
 @bp.get("/uploads/<int:upload_id>")
 def upload_detail(upload_id):
+    """One page of the upload's links (keyset by link id), optionally filtered.
+
+    ?after=<id> / ?before=<id> move forward / back from a page edge; payloads and API
+    responses are fetched per link from link_details when expanded.
+    """
+    page_size = max(1, current_app.config.get("UPLOAD_PAGE_SIZE") or 100)
+    filters = {
+        "status": request.args.get("status") if request.args.get("status") in LINK_STATUSES else "",
+        "order": request.args.get("order") if request.args.get("order") in RESULT_FILTERS else "",
+        "comm": request.args.get("comm") if request.args.get("comm") in RESULT_FILTERS else "",
+    }
+    after = request.args.get("after", type=int)
+    before = request.args.get("before", type=int) if after is None else None
+
+    where, params = ["l.upload_id=?"], [upload_id]
+    if filters["status"]:
+        where.append("l.status=?")
+        params.append(filters["status"])
+    if filters["order"]:
+        where.append(_result_filter_sql(ORDER, filters["order"]))
+    if filters["comm"]:
+        where.append(_result_filter_sql(COMMUNICATION, filters["comm"]))
+    if after is not None:
+        where.append("l.id > ?")
+        params.append(after)
+    elif before is not None:
+        where.append("l.id < ?")
+        params.append(before)
+
     with db() as conn:
         c = conn.cursor()
         c.execute("""SELECT bu.*, o.title as offer_title
@@ -949,178 +760,121 @@ def upload_detail(upload_id):
         batch = c.fetchone()
         if not batch: abort(404)
 
-        c.execute("""
-          SELECT l.*, u.customer_account_id, u.phone
+        # One row past the page tells whether there is a next (or previous) page
+        c.execute(f"""
+          SELECT l.id, l.external_id, l.created_at, l.expires_at, l.status, l.opened_at, l.agreed_at,
+                 l.rejected_at, l.token, l.order_id, l.order_success, l.communication_id,
+                 l.communication_success, u.customer_account_id, u.phone
           FROM links l JOIN users u ON u.id=l.user_id
-          WHERE l.upload_id=? ORDER BY l.id ASC
-        """, (upload_id,))
+          WHERE {" AND ".join(where)}
+          ORDER BY l.id {"DESC" if before is not None else "ASC"} LIMIT ?
+        """, (*params, page_size + 1))
         rows = c.fetchall()
-        # Parse order_response_json for each row
-        # Convert Row objects to dicts for easier manipulation
-        rows_list = []
-        for row in rows:
-            row_dict = dict(row)
-            # Check if order_response_json column exists and has a value
-            # sqlite3.Row supports 'in' operator and indexing
-            order_response_json = None
-            if "order_response_json" in row_dict:
-                order_response_json = row_dict["order_response_json"]
-            elif hasattr(row, "keys") and "order_response_json" in row.keys():
-                order_response_json = row["order_response_json"]
-            
-            if order_response_json and order_response_json.strip():
-                try:
-                    resp = json.loads(order_response_json)
-                    row_dict["order_response"] = resp
-                    # Format JSON for display
-                    if resp.get("response_json"):
-                        row_dict["order_response"]["response_json_formatted"] = json.dumps(resp["response_json"], ensure_ascii=False, indent=2)
-                        # Extract ORDER_ID from response_json
-                        if isinstance(resp["response_json"], dict):
-                            row_dict["order_id"] = resp["response_json"].get("ORDER_ID")
-                    # Format request payload for display
-                    if resp.get("request") and resp["request"].get("payload"):
-                        row_dict["order_response"]["request"]["payload_formatted"] = json.dumps(resp["request"]["payload"], ensure_ascii=False, indent=2)
-                except (json.JSONDecodeError, TypeError) as e:
-                    row_dict["order_response"] = {"error": f"Failed to parse response: {str(e)}", "raw": str(order_response_json)[:100]}
-                    row_dict["order_id"] = None
-            else:
-                row_dict["order_response"] = None
-                row_dict["order_id"] = None
 
-            comm_response_json = row_dict.get("communication_response_json")
-            row_dict["communication_id"] = None
-            row_dict["communication_response"] = None
-            if comm_response_json and str(comm_response_json).strip():
-                try:
-                    cresp = json.loads(comm_response_json)
-                    row_dict["communication_response"] = cresp
-                    if cresp.get("response_json") and isinstance(cresp["response_json"], dict):
-                        data = cresp["response_json"].get("DATA") or cresp["response_json"].get("data")
-                        if isinstance(data, dict):
-                            row_dict["communication_id"] = data.get("COMMUNICATION_ID", data.get("communicationId"))
-                    if row_dict["communication_id"] is None and cresp.get("communication_id") is not None:
-                        row_dict["communication_id"] = cresp.get("communication_id")
-                except (json.JSONDecodeError, TypeError):
-                    row_dict["communication_response"] = {"error": "parse failed", "raw": str(comm_response_json)[:200]}
-
-            # Generate URL
-            if row_dict.get("token"):
-                # Use BASE_URL from config if available, otherwise fall back to request.url_root
-                try:
-                    base_url = current_app.config.get("BASE_URL")
-                    # If BASE_URL is not set or is the default localhost, try to use request.url_root
-                    if not base_url or base_url == "http://localhost:5000":
-                        base_url = request.url_root.strip("/")
-                    # If still localhost and we're not in development, log a warning
-                    if base_url.startswith("http://localhost") and current_app.config.get("FLASK_ENV") != "development":
-                        import logging
-                        logging.warning(f"BASE_URL is set to localhost ({base_url}). Please set BASE_URL environment variable.")
-                except RuntimeError:
-                    # Outside of application context, use request.url_root
-                    base_url = request.url_root.strip("/")
-                row_dict["link_url"] = link_url(base_url, row_dict["token"])
-            else:
-                row_dict["link_url"] = None
-            
-            rows_list.append(row_dict)
-        rows = rows_list
-    return render_template("admin/upload_detail.html", batch=batch, rows=rows)
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+    if before is not None:
+        rows.reverse()
+    has_next = more if before is None else True
+    has_prev = (more if before is not None else after is not None) and bool(rows)
+
+    base_url = _links_base_url()
+    rows_list = []
+    for row in rows:
+        row_dict = dict(row)
+        row_dict["link_url"] = link_url(base_url, row_dict["token"]) if row_dict.get("token") else None
+        rows_list.append(row_dict)
+
+    page = {
+        "filters": {k: v for k, v in filters.items() if v},
+        "next_after": rows_list[-1]["id"] if rows_list and has_next else None,
+        "prev_before": rows_list[0]["id"] if has_prev else None,
+        "first": after is None and before is None,
+    }
+    return render_template("admin/upload_detail.html", batch=batch, rows=rows_list, page=page,
+                           statuses=LINK_STATUSES, progress=upload_jobs.progress(batch))
 
-@bp.get("/uploads/<int:upload_id>/download.csv")
-def upload_download_csv(upload_id):
-    # build CSV in-memory
+@bp.get("/links/<int:link_id>/details")
+def link_details(link_id):
+    """Latest request/response and attempt history of one link (HTML fragment for the upload page)."""
     with db() as conn:
-        c = conn.cursor()
-        c.execute("""
-          SELECT l.id, u.customer_account_id, l.external_id, l.created_at, l.expires_at, l.status,
-                 l.opened_at, l.agreed_at, l.rejected_at, l.token, u.phone, l.order_response_json,
-                 l.communication_response_json
-          FROM links l JOIN users u ON u.id=l.user_id
-          WHERE l.upload_id=?
-          ORDER BY l.id
-        """, (upload_id,))
-        rows = c.fetchall()
-
-    out = io.StringIO(newline="")
-    # Excel hint: force semicolon separator
-    out.write("sep=;\r\n")
-
-    w = csv.writer(out, delimiter=";", lineterminator="\r\n")
-    w.writerow(["link_id","customer_account_id","external_id","created_at","expires_at",
-                "status","opened_at","agreed_at","rejected_at","order_id","communication_id","url"])
+        row = conn.execute("""SELECT id, status, order_attempt_id, communication_attempt_id
+                              FROM links WHERE id=?""", (link_id,)).fetchone()
+        if not row:
+            abort(404)
+        attempts = conn.execute("""SELECT * FROM integration_attempts WHERE link_id=?
+                                   ORDER BY kind DESC, attempt_no DESC""", (link_id,)).fetchall()
+    r = dict(row)
+    for kind in (ORDER, COMMUNICATION):
+        latest = next((a for a in attempts if a["id"] == row[f"{kind}_attempt_id"]), None)
+        r[f"{kind}_response"] = result_from_attempt(latest) if latest else None
+    resp = r["order_response"]
+    if resp:
+        # Format JSON for display
+        if resp.get("response_json"):
+            resp["response_json_formatted"] = json.dumps(resp["response_json"], ensure_ascii=False, indent=2)
+        if resp.get("request") and resp["request"].get("payload"):
+            resp["request"]["payload_formatted"] = json.dumps(resp["request"]["payload"], ensure_ascii=False, indent=2)
+    return render_template("admin/_link_details.html", r=r, attempts=attempts)
+
+# Links per query while streaming the CSV export
+CSV_EXPORT_BATCH = 2000
 
-    # Use BASE_URL from config if available, otherwise fall back to request.url_root
-    try:
-        base_url = current_app.config.get("BASE_URL")
-        # If BASE_URL is not set or is the default localhost, try to use request.url_root
-        if not base_url or base_url == "http://localhost:5000":
-            base_url = request.url_root.strip("/")
-        # If still localhost and we're not in development, log a warning
-        if base_url.startswith("http://localhost") and current_app.config.get("FLASK_ENV") != "development":
-            import logging
-            logging.warning(f"BASE_URL is set to localhost ({base_url}). Please set BASE_URL environment variable.")
-    except RuntimeError:
-        # Outside of application context, use request.url_root
-        base_url = request.url_root.strip("/")
-    
-    for r in rows:
-        # Convert Row to dict for easier access
-        r_dict = dict(r)
-        
-        url = ""
-        if r_dict.get("token"):
-            url = link_url(base_url, r_dict['token'])
-        
-        # Extract ORDER_ID from order_response_json
-        order_id = ""
-        order_response_json = r_dict.get("order_response_json")
-        if order_response_json:
-            try:
-                resp = json.loads(order_response_json)
-                if resp.get("response_json") and isinstance(resp["response_json"], dict):
-                    order_id = resp["response_json"].get("ORDER_ID", "")
-            except (json.JSONDecodeError, TypeError):
-                pass
-
-        communication_id = ""
-        crj = r_dict.get("communication_response_json")
-        if crj:
-            try:
-                cresp = json.loads(crj)
-                if cresp.get("response_json") and isinstance(cresp["response_json"], dict):
-                    data = cresp["response_json"].get("DATA") or cresp["response_json"].get("data")
-                    if isinstance(data, dict):
-                        communication_id = data.get("COMMUNICATION_ID", data.get("communicationId", ""))
-                if not communication_id and cresp.get("communication_id") is not None:
-                    communication_id = cresp.get("communication_id", "")
-            except (json.JSONDecodeError, TypeError):
-                pass
-
-        w.writerow([r_dict["id"], r_dict["customer_account_id"], r_dict["external_id"], r_dict["created_at"],
-                    r_dict["expires_at"], r_dict["status"], r_dict["opened_at"], r_dict["agreed_at"],
-                    r_dict["rejected_at"], order_id, communication_id, url])
-
-    mem = io.BytesIO(out.getvalue().encode("utf-8-sig"))
-    return send_file(mem, mimetype="text/csv", as_attachment=True,
-                     download_name=f"upload_{upload_id}_links.csv")
-
-# Utility to assign tokens to any rows that are missing them (e.g., immediately after upload)
+@bp.get("/uploads/<int:upload_id>/download.csv")
+def upload_download_csv(upload_id):
+    """Stream the upload's links as CSV, one batch of links at a time (keyset by link id)."""
+    base_url = _links_base_url()
+
+    def generate():
+        out = io.StringIO(newline="")
+        w = csv.writer(out, delimiter=";", lineterminator="\r\n")
+        # UTF-8 BOM and Excel hint (force semicolon separator) go out before any query
+        out.write("\ufeffsep=;\r\n")
+        w.writerow(["link_id","customer_account_id","external_id","created_at","expires_at",
+                    "status","opened_at","agreed_at","rejected_at","order_id","communication_id","url"])
+        yield out.getvalue().encode("utf-8")
+
+        last_id = 0
+        while True:
+            # Each batch is its own short read: no transaction or pooled connection is held
+            # while the client downloads
+            with db() as conn:
+                rows = conn.execute("""
+                  SELECT l.id, u.customer_account_id, l.external_id, l.created_at, l.expires_at, l.status,
+                         l.opened_at, l.agreed_at, l.rejected_at, l.token, l.order_id, l.communication_id
+                  FROM links l JOIN users u ON u.id=l.user_id
+                  WHERE l.upload_id=? AND l.id>?
+                  ORDER BY l.id LIMIT ?
+                """, (upload_id, last_id, CSV_EXPORT_BATCH)).fetchall()
+            if not rows:
+                return
+            last_id = rows[-1]["id"]
+            out.seek(0)
+            out.truncate()
+            for r in rows:
+                url = link_url(base_url, r["token"]) if r["token"] else ""
+                w.writerow([r["id"], r["customer_account_id"], r["external_id"], r["created_at"],
+                            r["expires_at"], r["status"], r["opened_at"], r["agreed_at"],
+                            r["rejected_at"], r["order_id"], r["communication_id"], url])
+            yield out.getvalue().encode("utf-8")
+
+    return Response(stream_with_context(generate()), mimetype="text/csv",
+                    headers={"Content-Disposition": f"attachment; filename=upload_{upload_id}_links.csv"})
+
+# Utility to assign tokens to any rows that are missing them (uploads sign their links at ingest;
+# this covers links created before that, uses idx_links_missing_token)
 @bp.post("/uploads/<int:upload_id>/assign_tokens")
 def upload_assign_tokens(upload_id):
     from flask import current_app
-    signer = current_app.config["SIGNER"]
     with db() as conn:
         c = conn.cursor()
-        c.execute("SELECT id, token FROM links WHERE upload_id=? ORDER BY id", (upload_id,))
-        rows = c.fetchall()
-        assigned = 0
-        for r in rows:
-            if r["token"]:
-                continue
-            token = signer.dumps({"lid": r["id"]})
-            c.execute("UPDATE links SET token=? WHERE id=?", (token, r["id"]))
-            assigned += 1
+        c.execute("SELECT id FROM links WHERE upload_id=? AND token IS NULL ORDER BY id", (upload_id,))
+        link_ids = [r["id"] for r in c.fetchall()]
+        # Signed in parallel batches with UPLOAD_PROCESSES > 1, written in one executemany
+        with LazyPool(current_app.config.get("UPLOAD_PROCESSES") or 0) as pool:
+            tokens = sign_link_tokens(current_app.config["SECRET_KEY"], link_ids, pool)
+        c.executemany("UPDATE links SET token=? WHERE id=? AND token IS NULL", zip(tokens, link_ids))
+        assigned = len(link_ids)
         conn.commit()
     flash(f"Assigned tokens to {assigned} rows.", "success")
     return redirect(url_for("admin.upload_detail", upload_id=upload_id))
@@ -1128,7 +882,7 @@ def upload_assign_tokens(upload_id):
 # Update offer snapshot for all links of an offer (so landing shows current components/price)
 @bp.post("/offers/<int:offer_id>/update_snapshots")
 def update_offer_snapshots(offer_id):
-    """Update offer_snapshot_json for ALL links of this offer so landing shows current components."""
+    """Point ALL product-bound links of this offer at the current snapshot so landing shows current components."""
     with db() as conn:
         c = conn.cursor()
         c.execute("SELECT id FROM offers WHERE id=?", (offer_id,))
@@ -1142,16 +896,7 @@ def update_offer_snapshots(offer_id):
 
         # Product binding key for this offer.
         # Old links will have product_key=NULL and must not be touched.
-        order_mapping = snap.get("order_mapping") or {}
-        product_key = None
-        try:
-            po_offer_id = order_mapping.get("product_offer_id")
-            po_struct_id = order_mapping.get("product_offer_struct_id")
-            po_elem_id = order_mapping.get("po_struct_element_id")
-            if po_offer_id is not None and po_struct_id is not None and po_elem_id is not None:
-                product_key = f"{int(po_offer_id)}:{int(po_struct_id)}:{int(po_elem_id)}"
-        except (ValueError, TypeError):
-            product_key = None
+        product_key = product_key_for(snap)
 
         # Counts for warnings
         c.execute("SELECT COUNT(*) as cnt FROM links WHERE offer_id=?", (offer_id,))
@@ -1163,18 +908,14 @@ def update_offer_snapshots(offer_id):
             c.execute("""SELECT COUNT(*) as cnt FROM links
                           WHERE offer_id=? AND product_key=? AND product_key IS NOT NULL""",
                       (offer_id, product_key))
-            eligible_links = c.fetchone()["cnt"]
+            updated = c.fetchone()["cnt"]
 
-            c.execute("""UPDATE links
-                          SET offer_snapshot_json = ?
-                          WHERE offer_id = ? AND product_key = ? AND product_key IS NOT NULL""",
-                      (json.dumps(snap, ensure_ascii=False), offer_id, product_key))
-            updated = c.rowcount
+            set_head(c, offer_id, product_key, store_snapshot(c, snap))
         else:
-            eligible_links = 0
             updated = 0
 
         conn.commit()
+    landing_cache.evict_offer(offer_id)
     comps = (snap.get("details") or {}).get("components") or []
     comps_info = f", в снимке: {len(comps)} компонентов ({', '.join(c.get('type', '?') for c in comps) or 'нет'})" if comps is not None else ""
     if updated == 0:
@@ -1,12 +1,27 @@
 import os, json, datetime
+import contextvars
 import sys
 import logging, uuid
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor, wait as futures_wait
 from dotenv import load_dotenv
 import requests
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
+from tenacity import retry, stop_after_attempt, stop_after_delay, wait_exponential, retry_if_exception_type
 from flask import Flask, request, render_template, jsonify, abort, redirect
 from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
-from db import init_db, db, now_iso, fetch_offer_snapshot
+from db import init_db, db
+import outbox
+from snapshots import LINK_SNAPSHOT_COLUMNS, LINK_SNAPSHOT_JOIN, link_offer, localize_offer, offer_view
+import http_client
+import landing_cache
+import tracking
+import upload_jobs
+import decisions
+import metrics
+import request_timing
+from integration_results import COMMUNICATION, ORDER, store_result
 from admin_views import bp as admin_bp
 try:
     from version import get_version
@@ -45,6 +60,47 @@ class Config:
     )
     _pgd = os.getenv("COMM_PRODUCT_GROUP_DIVISION", "4").strip()
     COMM_PRODUCT_GROUP_DIVISION = int(_pgd) if _pgd else 4
+    # How agree hands off to the order/communication APIs:
+    #   outbox — enqueue jobs with the consent, a background dispatcher calls the APIs (default)
+    #   inline — call the APIs inside the HTTP request (previous behaviour)
+    #   concurrent — call both APIs in parallel inside the request under one shared deadline
+    AGREE_DISPATCH_MODE = os.getenv("AGREE_DISPATCH_MODE", "outbox").strip().lower() or "outbox"
+    AGREE_DEADLINE_SECONDS = float(os.getenv("AGREE_DEADLINE_SECONDS", "20"))
+    AGREE_CONCURRENT_WORKERS = int(os.getenv("AGREE_CONCURRENT_WORKERS", "4"))
+    OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+    OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "2"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "5"))
+    OUTBOX_RETRY_BASE_SECONDS = float(os.getenv("OUTBOX_RETRY_BASE_SECONDS", "5"))
+    OUTBOX_RETRY_MAX_SECONDS = float(os.getenv("OUTBOX_RETRY_MAX_SECONDS", "600"))
+    OUTBOX_LEASE_SECONDS = float(os.getenv("OUTBOX_LEASE_SECONDS", "300"))
+    # Keep-alive connection pools to ORDER_API / COMM_API (per worker, per upstream)
+    HTTP_POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", "4"))
+    HTTP_POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", "10"))
+    HTTP_POOL_BLOCK = os.getenv("HTTP_POOL_BLOCK", "0").strip().lower() in ("1", "true", "yes", "on")
+    # Render landing.html once per (offer snapshot, lang) and fill per-link values (landing_cache.py)
+    LANDING_RENDER_CACHE = os.getenv("LANDING_RENDER_CACHE", "1").strip().lower() in ("1", "true", "yes", "on")
+    LANDING_RENDER_CACHE_SIZE = int(os.getenv("LANDING_RENDER_CACHE_SIZE", "128"))
+    # Landing opened/expired updates are queued and flushed in batches (tracking.py); 0 = write per request
+    TRACKING_WRITE_BEHIND = os.getenv("TRACKING_WRITE_BEHIND", "1").strip().lower() in ("1", "true", "yes", "on")
+    TRACKING_FLUSH_INTERVAL = float(os.getenv("TRACKING_FLUSH_INTERVAL", "1"))
+    TRACKING_FLUSH_MAX_BATCH = int(os.getenv("TRACKING_FLUSH_MAX_BATCH", "500"))
+    # Segment uploads are read, validated and committed in chunks of this many rows
+    UPLOAD_CHUNK_ROWS = int(os.getenv("UPLOAD_CHUNK_ROWS", "50000"))
+    # Uploads run as background jobs (upload_jobs.py); files wait in UPLOAD_DIR until processed
+    UPLOAD_DIR = os.getenv("UPLOAD_DIR", "/app/uploads" if os.path.isdir("/app/uploads")
+                           else os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads"))
+    UPLOAD_JOBS_MAX_RUNNING = int(os.getenv("UPLOAD_JOBS_MAX_RUNNING", "1"))
+    UPLOAD_JOBS_POLL_INTERVAL = float(os.getenv("UPLOAD_JOBS_POLL_INTERVAL", "2"))
+    UPLOAD_JOB_LEASE_SECONDS = float(os.getenv("UPLOAD_JOB_LEASE_SECONDS", "300"))
+    # Worker processes for upload validation and token signing (parallel.py); 0/1 = in the job thread
+    UPLOAD_PROCESSES = int(os.getenv("UPLOAD_PROCESSES", "0"))
+    # Links per page on the upload detail page
+    UPLOAD_PAGE_SIZE = int(os.getenv("UPLOAD_PAGE_SIZE", "100"))
+    # Phase timings per request (request_timing.py): Server-Timing header and an "access" log line
+    SERVER_TIMING = os.getenv("SERVER_TIMING", "1").strip().lower() in ("1", "true", "yes", "on")
+    ACCESS_LOG_TIMINGS = os.getenv("ACCESS_LOG_TIMINGS", "1").strip().lower() in ("1", "true", "yes", "on")
+    # GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>" when set
+    METRICS_TOKEN = os.getenv("METRICS_TOKEN", "").strip()
 
 
 def validate_config():
@@ -54,8 +110,12 @@ def validate_config():
         errors.append("ORDER_API_KEY is required")
     if not app.config.get("ORDER_API_URL"):
         errors.append("ORDER_API_URL is required")
+    if app.config.get("AGREE_DISPATCH_MODE") not in ("outbox", "inline", "concurrent"):
+        errors.append("AGREE_DISPATCH_MODE must be 'outbox', 'inline' or 'concurrent'")
     if app.config.get("SECRET_KEY") == "change-me":
         print("WARNING: SECRET_KEY is set to default value 'change-me'")
+    if not app.config.get("METRICS_TOKEN"):
+        print("WARNING: METRICS_TOKEN is not set; GET /metrics is open to anyone who can reach the app")
     base_url = app.config.get("BASE_URL", "")
     if not base_url or base_url == "http://localhost:5000":
         print("WARNING: BASE_URL is set to default 'http://localhost:5000'")
@@ -97,16 +157,33 @@ def inject_version():
 
 from flask import g
 
+request_timing.init_app(app)
+
 @app.before_request
 def assign_request_id():
     rid = request.headers.get("X-Request-ID") or str(uuid.uuid4())
     g.request_id = rid
+    request_timing.start()
 
 @app.after_request
 def add_request_id_hdr(resp):
     rid = getattr(g, 'request_id', None)
     if rid:
         resp.headers['X-Request-ID'] = rid
+    timings = request_timing.finish()
+    if timings is not None:
+        if app.config["SERVER_TIMING"]:
+            resp.headers['Server-Timing'] = request_timing.server_timing(timings)
+        if app.config["ACCESS_LOG_TIMINGS"]:
+            logging.info("access " + json.dumps({
+                "request_id": rid,
+                "method": request.method,
+                "path": request.path,
+                "endpoint": request.endpoint,
+                "status": resp.status_code,
+                "total_ms": round(timings.total_seconds * 1000, 1),
+                **request_timing.phase_ms(timings),
+            }, ensure_ascii=False))
     return resp
 
 # ---------- Jinja filters ----------
@@ -132,6 +209,9 @@ def force_https(url):
 # ---------- Admin ----------
 app.register_blueprint(admin_bp)
 
+# ---------- Metrics (GET /metrics) ----------
+metrics.init_app(app)
+
 # ---------- Version API ----------
 @app.get("/api/version")
 def api_version():
@@ -159,10 +239,14 @@ def root_redirect():
     return "Not found", 404
 
 # ---------- Public Landing (Agree/Reject) ----------
+def _verify_token(token):
+    with request_timing.phase(request_timing.TOKEN):
+        return signer.loads(token, max_age=app.config["TOKEN_MAX_AGE_SECONDS"])
+
 @app.get("/l/<token>")
 def landing(token):
     try:
-        data = signer.loads(token, max_age=app.config["TOKEN_MAX_AGE_SECONDS"])
+        data = _verify_token(token)
     except SignatureExpired:
         return "Link expired.", 410
     except BadSignature:
@@ -181,82 +265,24 @@ def landing(token):
     with db() as conn:
         c = conn.cursor()
         # Fetch link with user data
-        c.execute("""SELECT l.*, u.customer_account_id 
-                     FROM links l 
-                     JOIN users u ON u.id = l.user_id 
-                     WHERE l.id=?""", (data["lid"],))
+        c.execute(f"""SELECT l.*, u.customer_account_id, {LINK_SNAPSHOT_COLUMNS}
+                      FROM links l
+                      JOIN users u ON u.id = l.user_id
+                      {LINK_SNAPSHOT_JOIN}
+                      WHERE l.id=?""", (data["lid"],))
         link = c.fetchone()
         if not link: return "Not found.", 404
 
-        # Expired?
-        if link["expires_at"]:
-            exp = datetime.datetime.fromisoformat(link["expires_at"])
-            if exp < datetime.datetime.now(datetime.timezone.utc):
-                c.execute("UPDATE links SET status='EXPIRED' WHERE id=?", (link["id"],))
-                conn.commit()
-                return "Link expired.", 410
+        # Expired? (status change is written behind, see tracking.py)
+        if decisions.is_expired(link["expires_at"]):
+            if link["status"] in ("NEW", "OPENED"):
+                link_tracker.record_expired(link["id"])
+            return "Link expired.", 410
 
-        # Mark opened once
+        # Mark opened once (written behind, repeated opens before a flush coalesce)
         if not link["opened_at"]:
-            c.execute("UPDATE links SET opened_at=?, status='OPENED' WHERE id=?", (now_iso(), link["id"]))
-            conn.commit()
+            link_tracker.record_open(link["id"])
 
-        offer = json.loads(link["offer_snapshot_json"])
-        
-        # Apply translations to offer if available
-        if offer.get("details") and offer["details"].get("translations"):
-            translations_data = offer["details"]["translations"]
-            
-            # For Kazakh language, use Russian as fallback
-            if lang == "kk":
-                # Get Russian translations as fallback
-                ru_translations = translations_data.get("ru", {})
-                kk_translations = translations_data.get("kk", {})
-                
-                # Override title: use Kazakh if available, otherwise Russian, otherwise keep original
-                if "title" in kk_translations:
-                    offer["title"] = kk_translations["title"]
-                elif "title" in ru_translations:
-                    offer["title"] = ru_translations["title"]
-                
-                # Override badges: use Kazakh if available, otherwise Russian
-                if "badges" in kk_translations:
-                    offer["details"]["badges"] = kk_translations["badges"]
-                elif "badges" in ru_translations:
-                    offer["details"]["badges"] = ru_translations["badges"]
-                
-                # Override component titles: use Kazakh if available, otherwise Russian
-                if offer["details"].get("components"):
-                    kk_components = kk_translations.get("components", [])
-                    ru_components = ru_translations.get("components", [])
-                    
-                    # Create lookup dictionaries for faster access
-                    kk_comp_map = {c.get("type"): c for c in kk_components if c.get("type")}
-                    ru_comp_map = {c.get("type"): c for c in ru_components if c.get("type")}
-                    
-                    for comp in offer["details"]["components"]:
-                        comp_type = comp.get("type")
-                        if comp_type:
-                            # Try Kazakh first, then Russian
-                            if comp_type in kk_comp_map and "title" in kk_comp_map[comp_type]:
-                                comp["title"] = kk_comp_map[comp_type]["title"]
-                            elif comp_type in ru_comp_map and "title" in ru_comp_map[comp_type]:
-                                comp["title"] = ru_comp_map[comp_type]["title"]
-            elif lang == "ru" and "ru" in translations_data:
-                # For Russian, use Russian translations directly
-                ru_translations = translations_data["ru"]
-                if "title" in ru_translations:
-                    offer["title"] = ru_translations["title"]
-                if "badges" in ru_translations:
-                    offer["details"]["badges"] = ru_translations["badges"]
-                if "components" in ru_translations and offer["details"].get("components"):
-                    ru_components = ru_translations["components"]
-                    ru_comp_map = {c.get("type"): c for c in ru_components if c.get("type")}
-                    for comp in offer["details"]["components"]:
-                        comp_type = comp.get("type")
-                        if comp_type and comp_type in ru_comp_map and "title" in ru_comp_map[comp_type]:
-                            comp["title"] = ru_comp_map[comp_type]["title"]
-        
         # Parse address from link
         address = None
         if link["address_json"]:
@@ -267,21 +293,45 @@ def landing(token):
         
         # Get all translations for current language
         translations = get_all_translations(lang)
-        
-        # Компоненты предложения (для героя Baige: фон и блок показываются при одном компоненте — интернет)
-        comps = (offer.get("details") or {}).get("components") or []
         debug = request.args.get("debug") == "1"
-        
-        template_response = render_template("landing.html", 
-                             offer=offer, 
-                             token=token, 
-                             link_id=link["id"],
-                             customer_account_id=link["customer_account_id"],
-                             address=address,
-                             current_lang=lang,
-                             translations=translations,
-                             comps=comps,
-                             debug=debug)
+        snapshot_id = link["resolved_snapshot_id"]
+
+        def render_landing(**per_link):
+            # Localized view is materialized per (snapshot, lang); legacy inline snapshots are localized here
+            if snapshot_id is not None:
+                offer = offer_view(c, snapshot_id, lang)
+            else:
+                offer = localize_offer(link_offer(link), lang)
+            # Компоненты предложения (для героя Baige: фон и блок показываются при одном компоненте — интернет)
+            comps = (offer.get("details") or {}).get("components") or []
+            return render_template("landing.html",
+                                   offer=offer,
+                                   link_id=link["id"],
+                                   current_lang=lang,
+                                   translations=translations,
+                                   comps=comps,
+                                   debug=debug,
+                                   **per_link)
+
+        # Debug banner and legacy inline snapshots are rendered in full, uncached
+        if app.config["LANDING_RENDER_CACHE"] and not debug and snapshot_id is not None:
+            shell_key = (snapshot_id, lang)
+            shell = landing_cache.get(shell_key)
+            if shell is None:
+                shell = render_landing(**landing_cache.shell_context())
+                landing_cache.put(shell_key, link["offer_id"], shell, app.config["LANDING_RENDER_CACHE_SIZE"])
+            template_response = landing_cache.fill(
+                shell, token=token, page_url=force_https(request.url),
+                customer_html=lambda variant: render_template("_landing_customer.html",
+                                                              customer_variant=variant,
+                                                              customer_account_id=link["customer_account_id"],
+                                                              address=address,
+                                                              current_lang=lang,
+                                                              translations=translations))
+        else:
+            template_response = render_landing(token=token,
+                                               customer_account_id=link["customer_account_id"],
+                                               address=address)
         
         # Set cookie if language was changed via URL parameter
         if set_lang_cookie:
@@ -297,82 +347,45 @@ def api_agree():
     token = request.form.get("token") or (request.json or {}).get("token")
     if not token: abort(400, "Missing token")
     try:
-        data = signer.loads(token, max_age=app.config["TOKEN_MAX_AGE_SECONDS"])
+        data = _verify_token(token)
     except SignatureExpired:
         return jsonify({"status":"expired"}), 410
     except BadSignature:
         return jsonify({"status":"invalid"}), 400
 
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-    ua = request.headers.get("User-Agent", "")
-    now = now_iso()
-
-    with db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM links WHERE id=?", (data["lid"],))
-        link = c.fetchone()
-        if not link: return jsonify({"status":"not_found"}), 404
-        if link["status"] == "AGREED":
-            return jsonify({"status":"already_agreed"}), 200
-
-        offer = json.loads(link["offer_snapshot_json"])
-        consent_text = f"Agreed to '{offer['title']}' ({offer['bundle']}) at {now}"
-        c.execute("""INSERT INTO consents (link_id, consent_text, choice, created_at, ip, user_agent)
-                     VALUES (?, ?, 'AGREED', ?, ?, ?)""",
-                  (link["id"], consent_text, now, ip, ua))
-        c.execute("UPDATE links SET agreed_at=?, status='AGREED' WHERE id=?", (now, link["id"]))
-        conn.commit()
-
-    # Optional: create order
-    try:
-        create_order_from_offer(link_id=link["id"])
-    except Exception as e:
-        print("Order API error:", e)
-        import traceback
-        traceback.print_exc()
-        # Error is already stored in database by create_order_from_offer
+    d = decisions.decide(data["lid"], decisions.AGREED, blocked_statuses=("AGREED",),
+                         check_expiry=False, mark_opened=False,
+                         ip=request.headers.get("X-Forwarded-For", request.remote_addr),
+                         user_agent=request.headers.get("User-Agent", ""),
+                         in_transaction=_enqueue_integrations)
+    if d.outcome == decisions.NOT_FOUND: return jsonify({"status":"not_found"}), 404
+    if d.outcome == decisions.ALREADY:
+        return jsonify({"status":"already_agreed"}), 200
 
-    try:
-        create_communication_from_agree(link_id=link["id"])
-    except Exception as e:
-        print("Communication API error:", e)
-        import traceback
-        traceback.print_exc()
+    _dispatch_integrations(d.link["id"])
 
-    return jsonify({"status":"ok", "message":"Consent recorded", "agreed_at": now})
+    return jsonify({"status":"ok", "message":"Consent recorded", "agreed_at": d.at})
 
 @app.post("/api/reject")
 def api_reject():
     token = request.form.get("token") or (request.json or {}).get("token")
     if not token: abort(400, "Missing token")
     try:
-        data = signer.loads(token, max_age=app.config["TOKEN_MAX_AGE_SECONDS"])
+        data = _verify_token(token)
     except SignatureExpired:
         return jsonify({"status":"expired"}), 410
     except BadSignature:
         return jsonify({"status":"invalid"}), 400
 
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-    ua = request.headers.get("User-Agent", "")
-    now = now_iso()
-
-    with db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM links WHERE id=?", (data["lid"],))
-        link = c.fetchone()
-        if not link: return jsonify({"status":"not_found"}), 404
-        if link["status"] in ("AGREED","REJECTED"):
-            return jsonify({"status":"already_final"}), 200
-
-        offer = json.loads(link["offer_snapshot_json"])
-        consent_text = f"Rejected '{offer['title']}' ({offer['bundle']}) at {now}"
-        c.execute("""INSERT INTO consents (link_id, consent_text, choice, created_at, ip, user_agent)
-                     VALUES (?, ?, 'REJECTED', ?, ?, ?)""",
-                  (link["id"], consent_text, now, ip, ua))
-        c.execute("UPDATE links SET rejected_at=?, status='REJECTED' WHERE id=?", (now, link["id"]))
-        conn.commit()
+    d = decisions.decide(data["lid"], decisions.REJECTED, blocked_statuses=("AGREED", "REJECTED"),
+                         check_expiry=False, mark_opened=False,
+                         ip=request.headers.get("X-Forwarded-For", request.remote_addr),
+                         user_agent=request.headers.get("User-Agent", ""))
+    if d.outcome == decisions.NOT_FOUND: return jsonify({"status":"not_found"}), 404
+    if d.outcome == decisions.ALREADY:
+        return jsonify({"status":"already_final"}), 200
 
-    return jsonify({"status":"ok", "message":"Rejection recorded", "rejected_at": now})
+    return jsonify({"status":"ok", "message":"Rejection recorded", "rejected_at": d.at})
 
 from flask import render_template  # (already imported above in your app)
 
@@ -388,68 +401,34 @@ def agree_page():
         return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ошибка"), message=translations.get("decision_error_message_default","Отсутствует токен."), translations=translations), 400
 
     try:
-        data = signer.loads(token, max_age=app.config["TOKEN_MAX_AGE_SECONDS"])
+        data = _verify_token(token)
     except SignatureExpired:
         return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ссылка истекла"), message=translations.get("decision_error_message_default","Срок действия ссылки закончился."), translations=translations), 410
     except BadSignature:
         return render_template("decision_error.html", title=translations.get("decision_error_title_default","Неверная ссылка"), message=translations.get("decision_error_message_default","Недействительный токен."), translations=translations), 400
 
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-    ua = request.headers.get("User-Agent", "")
-    now = now_iso()
-
-    with db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM links WHERE id=?", (data["lid"],))
-        link = c.fetchone()
-        if not link:
-            return render_template("decision_error.html", title=translations.get("decision_error_title_default","Не найдено"), message=translations.get("decision_error_message_default","Ссылка не найдена."), translations=translations), 404
-
-        # expired?
-        if link["expires_at"]:
-            exp = datetime.datetime.fromisoformat(link["expires_at"])
-            if exp < datetime.datetime.now(datetime.timezone.utc):
-                c.execute("UPDATE links SET status='EXPIRED' WHERE id=?", (link["id"],))
-                conn.commit()
-                return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ссылка истекла"), message=translations.get("decision_error_message_default","Срок действия ссылки закончился."), translations=translations), 410
-
-        offer = json.loads(link["offer_snapshot_json"])
-
-        # already final?
-        if link["status"] == "REJECTED":
-            return render_template("rejected.html", offer=offer, when=link["rejected_at"], already=True, translations=translations)
-        if link["status"] == "AGREED":
-            return render_template("accepted.html", offer=offer, when=link["agreed_at"], already=True, translations=translations)
-
-        # mark opened if first time
-        if not link["opened_at"]:
-            c.execute("UPDATE links SET opened_at=? WHERE id=?", (now, link["id"]))
-
-        # store consent & update status
-        consent_text = f"Agreed to '{offer['title']}' ({offer.get('bundle')}) at {now}"
-        c.execute("""INSERT INTO consents (link_id, consent_text, choice, created_at, ip, user_agent)
-                     VALUES (?, ?, 'AGREED', ?, ?, ?)""",
-                  (link["id"], consent_text, now, ip, ua))
-        c.execute("UPDATE links SET agreed_at=?, status='AGREED' WHERE id=?", (now, link["id"]))
-        conn.commit()
+    d = decisions.decide(data["lid"], decisions.AGREED, blocked_statuses=("AGREED", "REJECTED"),
+                         check_expiry=True, mark_opened=True,
+                         ip=request.headers.get("X-Forwarded-For", request.remote_addr),
+                         user_agent=request.headers.get("User-Agent", ""),
+                         in_transaction=_enqueue_integrations)
+    if d.outcome == decisions.NOT_FOUND:
+        return render_template("decision_error.html", title=translations.get("decision_error_title_default","Не найдено"), message=translations.get("decision_error_message_default","Ссылка не найдена."), translations=translations), 404
+    if d.outcome == decisions.EXPIRED:
+        if d.link["status"] in ("NEW", "OPENED"):
+            link_tracker.record_expired(d.link["id"])
+        return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ссылка истекла"), message=translations.get("decision_error_message_default","Срок действия ссылки закончился."), translations=translations), 410
 
-    # Optional: create order (same as /api/agree)
-    try:
-        create_order_from_offer(link_id=link["id"])
-    except Exception as e:
-        print("Order API error:", e)
-        import traceback
-        traceback.print_exc()
-        # Error is already stored in database by create_order_from_offer
+    # already final?
+    if d.outcome == decisions.ALREADY:
+        if d.link["status"] == "REJECTED":
+            return render_template("rejected.html", offer=d.offer, when=d.link["rejected_at"], already=True, translations=translations)
+        return render_template("accepted.html", offer=d.offer, when=d.link["agreed_at"], already=True, translations=translations)
 
-    try:
-        create_communication_from_agree(link_id=link["id"])
-    except Exception as e:
-        print("Communication API error:", e)
-        import traceback
-        traceback.print_exc()
+    # Create order + communication (same as /api/agree)
+    _dispatch_integrations(d.link["id"])
 
-    return render_template("accepted.html", offer=offer, when=now, already=False, translations=translations)
+    return render_template("accepted.html", offer=d.offer, when=d.at, already=False, translations=translations)
 
 
 # --------- Page: Reject (renders HTML) ----------
@@ -464,66 +443,160 @@ def reject_page():
         return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ошибка"), message=translations.get("decision_error_message_default","Отсутствует токен."), translations=translations), 400
 
     try:
-        data = signer.loads(token, max_age=app.config["TOKEN_MAX_AGE_SECONDS"])
+        data = _verify_token(token)
     except SignatureExpired:
         return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ссылка истекла"), message=translations.get("decision_error_message_default","Срок действия ссылки закончился."), translations=translations), 410
     except BadSignature:
         return render_template("decision_error.html", title=translations.get("decision_error_title_default","Неверная ссылка"), message=translations.get("decision_error_message_default","Недействительный токен."), translations=translations), 400
 
-    ip = request.headers.get("X-Forwarded-For", request.remote_addr)
-    ua = request.headers.get("User-Agent", "")
-    now = now_iso()
+    d = decisions.decide(data["lid"], decisions.REJECTED, blocked_statuses=("AGREED", "REJECTED"),
+                         check_expiry=True, mark_opened=True,
+                         ip=request.headers.get("X-Forwarded-For", request.remote_addr),
+                         user_agent=request.headers.get("User-Agent", ""))
+    if d.outcome == decisions.NOT_FOUND:
+        return render_template("decision_error.html", title=translations.get("decision_error_title_default","Не найдено"), message=translations.get("decision_error_message_default","Ссылка не найдена."), translations=translations), 404
+    if d.outcome == decisions.EXPIRED:
+        if d.link["status"] in ("NEW", "OPENED"):
+            link_tracker.record_expired(d.link["id"])
+        return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ссылка истекла"), message=translations.get("decision_error_message_default","Срок действия ссылки закончился."), translations=translations), 410
+
+    # already final?
+    if d.outcome == decisions.ALREADY:
+        if d.link["status"] == "AGREED":
+            return render_template("accepted.html", offer=d.offer, when=d.link["agreed_at"], already=True, translations=translations)
+        return render_template("rejected.html", offer=d.offer, when=d.link["rejected_at"], already=True, translations=translations)
 
-    with db() as conn:
-        c = conn.cursor()
-        c.execute("SELECT * FROM links WHERE id=?", (data["lid"],))
-        link = c.fetchone()
-        if not link:
-            return render_template("decision_error.html", title=translations.get("decision_error_title_default","Не найдено"), message=translations.get("decision_error_message_default","Ссылка не найдена."), translations=translations), 404
-
-        # expired?
-        if link["expires_at"]:
-            exp = datetime.datetime.fromisoformat(link["expires_at"])
-            if exp < datetime.datetime.now(datetime.timezone.utc):
-                c.execute("UPDATE links SET status='EXPIRED' WHERE id=?", (link["id"],))
-                conn.commit()
-                return render_template("decision_error.html", title=translations.get("decision_error_title_default","Ссылка истекла"), message=translations.get("decision_error_message_default","Срок действия ссылки закончился."), translations=translations), 410
+    return render_template("rejected.html", offer=d.offer, when=d.at, already=False, translations=translations)
 
-        offer = json.loads(link["offer_snapshot_json"])
 
-        # already final?
-        if link["status"] == "AGREED":
-            return render_template("accepted.html", offer=offer, when=link["agreed_at"], already=True, translations=translations)
-        if link["status"] == "REJECTED":
-            return render_template("rejected.html", offer=offer, when=link["rejected_at"], already=True, translations=translations)
+# ---------- Internal: Integration dispatch ----------
+def _integration_kinds():
+    """Outbox kinds to run after an agree (communication only when COMM_API_URL is set)."""
+    kinds = ["order"]
+    if (app.config.get("COMM_API_URL") or "").strip():
+        kinds.append("communication")
+    return kinds
 
-        # mark opened if first time
-        if not link["opened_at"]:
-            c.execute("UPDATE links SET opened_at=? WHERE id=?", (now, link["id"]))
 
-        # store decision & update status
-        consent_text = f"Rejected '{offer['title']}' ({offer.get('bundle')}) at {now}"
-        c.execute("""INSERT INTO consents (link_id, consent_text, choice, created_at, ip, user_agent)
-                     VALUES (?, ?, 'REJECTED', ?, ?, ?)""",
-                  (link["id"], consent_text, now, ip, ua))
-        c.execute("UPDATE links SET rejected_at=?, status='REJECTED' WHERE id=?", (now, link["id"]))
-        conn.commit()
+def _enqueue_integrations(cur, link_id: int):
+    """In outbox mode, add integration jobs to the consent transaction (caller commits)."""
+    if app.config["AGREE_DISPATCH_MODE"] == "outbox":
+        outbox.enqueue(cur, link_id, _integration_kinds())
+
+
+def _integration_handlers():
+    return {
+        "order": create_order_from_offer,
+        "communication": create_communication_from_agree,
+    }
+
+
+_INTEGRATION_ERROR_LABELS = {"order": "Order API error:", "communication": "Communication API error:"}
+_integration_pool = None
+_integration_pool_lock = threading.Lock()
+
+
+def _get_integration_pool() -> ThreadPoolExecutor:
+    """The worker's pool for concurrent agree calls, created on first use (one per process)."""
+    global _integration_pool
+    if _integration_pool is None:
+        with _integration_pool_lock:
+            # Two first agrees can arrive together on different threads
+            if _integration_pool is None:
+                _integration_pool = ThreadPoolExecutor(
+                    max_workers=max(2, int(app.config.get("AGREE_CONCURRENT_WORKERS") or 4)),
+                    thread_name_prefix="agree-integration",
+                )
+    return _integration_pool
+
+
+def _run_integrations_concurrently(link_id: int):
+    """Run order + communication for one link in parallel under AGREE_DEADLINE_SECONDS.
+
+    Each integration still records its own attempt (integration_results.py);
+    HTTP timeouts and tenacity retries are capped by the shared deadline, so
+    the request waits at most about that long.
+    """
+    pool = _get_integration_pool()
+    deadline = time.monotonic() + float(app.config.get("AGREE_DEADLINE_SECONDS") or 20)
+    handlers = _integration_handlers()
+
+    def _call(kind):
+        with app.app_context():
+            handlers[kind](link_id=link_id, deadline=deadline)
+
+    # Each call runs in a copy of the request's context so its API time lands in Server-Timing
+    futures = {pool.submit(contextvars.copy_context().run, _call, kind): kind
+               for kind in _integration_kinds()}
+    done, not_done = futures_wait(futures, timeout=max(0.0, deadline - time.monotonic()))
+    for fut in done:
+        err = fut.exception()
+        if err is not None:
+            print(_INTEGRATION_ERROR_LABELS[futures[fut]], err)
+    for fut in not_done:
+        print(f"{_INTEGRATION_ERROR_LABELS[futures[fut]]} still running after agree deadline (link {link_id})")
+
+
+def _dispatch_integrations(link_id: int):
+    """After the consent commit: wake the outbox dispatcher, or call the APIs in-request."""
+    mode = app.config["AGREE_DISPATCH_MODE"]
+    if mode == "outbox":
+        outbox_dispatcher.wake()
+        return
+    if mode == "concurrent":
+        _run_integrations_concurrently(link_id)
+        return
+
+    # Optional: create order
+    try:
+        create_order_from_offer(link_id=link_id)
+    except Exception as e:
+        print("Order API error:", e)
+        import traceback
+        traceback.print_exc()
+        # Error is already stored in database by create_order_from_offer
 
-    return render_template("rejected.html", offer=offer, when=now, already=False, translations=translations)
+    try:
+        create_communication_from_agree(link_id=link_id)
+    except Exception as e:
+        print("Communication API error:", e)
+        import traceback
+        traceback.print_exc()
 
 
 # ---------- Internal: Order mapping ----------
-def _post_order(url: str, payload: dict, timeout: int, idem_key: str):
+def _retry_stop(deadline):
+    """3 attempts, and never past `deadline` (time.monotonic() value) when one is given."""
+    stop = stop_after_attempt(3)
+    if deadline is not None:
+        stop = stop | stop_after_delay(max(0.0, deadline - time.monotonic()))
+    return stop
+
+
+def _attempt_timeout(timeout, deadline):
+    """Per-attempt HTTP timeout, shortened to the time left before `deadline`."""
+    if deadline is None:
+        return timeout
+    remaining = deadline - time.monotonic()
+    if remaining <= 0:
+        raise requests.Timeout("Agree deadline exceeded")
+    return min(timeout, remaining)
+
+
+def _post_order(url: str, payload: dict, timeout: int, idem_key: str, deadline=None):
     from flask import current_app
     api_key = current_app.config.get("ORDER_API_KEY")
     if not api_key:
         raise ValueError("ORDER_API_KEY is not configured. Please set ORDER_API_KEY in your .env file.")
-    
+    # Pooled keep-alive session: retries below reuse the same connection pool
+    session = http_client.get_session("order", current_app.config)
+
     @retry(
         reraise=True,
-        stop=stop_after_attempt(3),
+        stop=_retry_stop(deadline),
         wait=wait_exponential(multiplier=0.5, min=0.5, max=4),
-        retry=retry_if_exception_type((requests.Timeout, requests.ConnectionError))
+        retry=retry_if_exception_type((requests.Timeout, requests.ConnectionError)),
+        before_sleep=metrics.count_retry(ORDER),
     )
     def _inner():
         headers = {
@@ -532,23 +605,26 @@ def _post_order(url: str, payload: dict, timeout: int, idem_key: str):
             "AUTHORIZATION": f"Bearer {api_key}",
             "Idempotency-Key": idem_key
         }
-        return requests.post(url, json=payload, headers=headers, timeout=timeout)
-    return _inner()
+        return session.post(url, json=payload, headers=headers, timeout=_attempt_timeout(timeout, deadline))
+    with request_timing.phase(request_timing.ORDER_API):
+        return _inner()
 
 
-def _post_communication(url: str, payload: dict, timeout: int, idem_key: str):
+def _post_communication(url: str, payload: dict, timeout: int, idem_key: str, deadline=None):
     from flask import current_app
     api_key = (current_app.config.get("COMM_API_KEY") or "").strip() or (
         current_app.config.get("ORDER_API_KEY") or ""
     ).strip()
     if not api_key:
         raise ValueError("COMM_API_KEY and ORDER_API_KEY are empty")
+    session = http_client.get_session("communication", current_app.config)
 
     @retry(
         reraise=True,
-        stop=stop_after_attempt(3),
+        stop=_retry_stop(deadline),
         wait=wait_exponential(multiplier=0.5, min=0.5, max=4),
         retry=retry_if_exception_type((requests.Timeout, requests.ConnectionError)),
+        before_sleep=metrics.count_retry(COMMUNICATION),
     )
     def _inner():
         # Communication API on this contour expects raw token value in AUTHORIZATION header
@@ -559,12 +635,13 @@ def _post_communication(url: str, payload: dict, timeout: int, idem_key: str):
             "AUTHORIZATION": api_key,
             "Idempotency-Key": idem_key,
         }
-        return requests.post(url, json=payload, headers=headers, timeout=timeout)
+        return session.post(url, json=payload, headers=headers, timeout=_attempt_timeout(timeout, deadline))
 
-    return _inner()
+    with request_timing.phase(request_timing.COMMUNICATION_API):
+        return _inner()
 
 
-def create_communication_from_agree(link_id: int):
+def create_communication_from_agree(link_id: int, deadline=None):
     """POST Communication API /communications (потенциальная сделка при нужном COMMUNICATION_TYPE_ID)."""
     from flask import current_app
 
@@ -577,19 +654,15 @@ def create_communication_from_agree(link_id: int):
     if ch_id <= 0 or ct_id <= 0:
         with db() as conn:
             c = conn.cursor()
-            c.execute(
-                """UPDATE links SET communication_response_json=? WHERE id=?""",
-                (
-                    json.dumps(
-                        {
-                            "skipped": True,
-                            "reason": "Set COMM_CHANNEL_ID and COMMUNICATION_TYPE_ID in .env",
-                            "timestamp": datetime.datetime.now().isoformat(),
-                        },
-                        ensure_ascii=False,
-                    ),
-                    link_id,
-                ),
+            store_result(
+                c,
+                COMMUNICATION,
+                link_id,
+                {
+                    "skipped": True,
+                    "reason": "Set COMM_CHANNEL_ID and COMMUNICATION_TYPE_ID in .env",
+                    "timestamp": datetime.datetime.now().isoformat(),
+                },
             )
             conn.commit()
         return
@@ -597,18 +670,19 @@ def create_communication_from_agree(link_id: int):
     with db() as conn:
         c = conn.cursor()
         c.execute(
-            """SELECT l.*, u.filial_id, u.customer_account_id, u.phone, u.customer_id, u.name, u.identification_number,
-                      u.id AS uid
-               FROM links l
-               JOIN users u ON u.id = l.user_id
-               WHERE l.id=?""",
+            f"""SELECT l.*, u.filial_id, u.customer_account_id, u.phone, u.customer_id, u.name, u.identification_number,
+                       u.id AS uid, {LINK_SNAPSHOT_COLUMNS}
+                FROM links l
+                JOIN users u ON u.id = l.user_id
+                {LINK_SNAPSHOT_JOIN}
+                WHERE l.id=?""",
             (link_id,),
         )
         row = c.fetchone()
         if not row:
             return
         row_dict = dict(row)
-        offer = json.loads(row_dict["offer_snapshot_json"] or "{}")
+        offer = link_offer(row)
 
         cust_id = row_dict.get("customer_id")
         try:
@@ -616,19 +690,15 @@ def create_communication_from_agree(link_id: int):
         except (TypeError, ValueError):
             cust_id_int = None
         if cust_id_int is None or cust_id_int <= 0:
-            c.execute(
-                """UPDATE links SET communication_response_json=? WHERE id=?""",
-                (
-                    json.dumps(
-                        {
-                            "skipped": True,
-                            "reason": "customer_id is missing or invalid (add customer_id to segment upload)",
-                            "timestamp": datetime.datetime.now().isoformat(),
-                        },
-                        ensure_ascii=False,
-                    ),
-                    link_id,
-                ),
+            store_result(
+                c,
+                COMMUNICATION,
+                link_id,
+                {
+                    "skipped": True,
+                    "reason": "customer_id is missing or invalid (add customer_id to segment upload)",
+                    "timestamp": datetime.datetime.now().isoformat(),
+                },
             )
             conn.commit()
             return
@@ -726,8 +796,10 @@ def create_communication_from_agree(link_id: int):
         }
         timeout = int(current_app.config.get("COMM_API_TIMEOUT") or 15)
 
+        started, recorded = time.monotonic(), False
         try:
-            r = _post_communication(comm_url, payload, timeout, idem_key=f"link-comm-{link_id}")
+            r = _post_communication(comm_url, payload, timeout, idem_key=f"link-comm-{link_id}", deadline=deadline)
+            latency_ms = int((time.monotonic() - started) * 1000)
             response_json = None
             try:
                 response_json = r.json()
@@ -756,13 +828,14 @@ def create_communication_from_agree(link_id: int):
             if comm_id is not None:
                 response_data["communication_id"] = comm_id
 
-            c.execute(
-                "UPDATE links SET communication_response_json=? WHERE id=?",
-                (json.dumps(response_data, ensure_ascii=False), link_id),
-            )
+            store_result(c, COMMUNICATION, link_id, response_data, latency_ms=latency_ms)
             conn.commit()
+            recorded = True
             r.raise_for_status()
         except Exception as e:
+            if recorded:
+                raise  # HTTP error status: the response above is this call's attempt
+            latency_ms = int((time.monotonic() - started) * 1000)
             error_data = {
                 "request": request_data,
                 "error": str(e),
@@ -771,26 +844,21 @@ def create_communication_from_agree(link_id: int):
                 "success": False,
             }
             try:
-                c.execute(
-                    "UPDATE links SET communication_response_json=? WHERE id=?",
-                    (json.dumps(error_data, ensure_ascii=False), link_id),
-                )
+                store_result(c, COMMUNICATION, link_id, error_data, latency_ms=latency_ms)
                 conn.commit()
             except Exception as db_err:
                 print(f"Failed to store communication error: {db_err}")
                 try:
                     with db() as conn2:
                         c2 = conn2.cursor()
-                        c2.execute(
-                            "UPDATE links SET communication_response_json=? WHERE id=?",
-                            (json.dumps(error_data, ensure_ascii=False), link_id),
-                        )
+                        store_result(c2, COMMUNICATION, link_id, error_data, latency_ms=latency_ms)
                         conn2.commit()
                 except Exception:
                     pass
+            raise
 
 
-def create_order_from_offer(link_id: int):
+def create_order_from_offer(link_id: int, deadline=None):
     with db() as conn:
         c = conn.cursor()
         c.execute("""SELECT l.*, u.filial_id, u.customer_account_id, u.phone, u.id AS uid,
@@ -926,13 +994,16 @@ def create_order_from_offer(link_id: int):
             "timestamp": datetime.datetime.now().isoformat()
         }
         
+        started, recorded = time.monotonic(), False
         try:
             r = _post_order(
                     order_api_url,
                 payload,
                     order_api_timeout,
-                idem_key=f"link-order-{link_id}"
+                idem_key=f"link-order-{link_id}",
+                deadline=deadline,
             )
+            latency_ms = int((time.monotonic() - started) * 1000)
             print("Order response:", r.status_code, r.text)
             
             # Parse response JSON to check for ORDER_ID
@@ -965,12 +1036,15 @@ def create_order_from_offer(link_id: int):
                 response_data["response_json"] = response_json
             
             # Store response using the existing connection
-            c.execute("UPDATE links SET order_response_json=? WHERE id=?", 
-                     (json.dumps(response_data, ensure_ascii=False), link_id))
+            store_result(c, ORDER, link_id, response_data, latency_ms=latency_ms)
             conn.commit()
+            recorded = True
             
             r.raise_for_status()
         except Exception as e:
+            if recorded:
+                raise  # HTTP error status: the response above is this call's attempt
+            latency_ms = int((time.monotonic() - started) * 1000)
             # Store error response with request data using existing connection
             error_data = {
                 "request": request_data,
@@ -980,8 +1054,7 @@ def create_order_from_offer(link_id: int):
                 "success": False
             }
             try:
-                c.execute("UPDATE links SET order_response_json=? WHERE id=?", 
-                         (json.dumps(error_data, ensure_ascii=False), link_id))
+                store_result(c, ORDER, link_id, error_data, latency_ms=latency_ms)
                 conn.commit()
             except Exception as db_err:
                 print(f"Failed to store error in database: {db_err}")
@@ -989,14 +1062,46 @@ def create_order_from_offer(link_id: int):
                 try:
                     with db() as conn2:
                         c2 = conn2.cursor()
-                        c2.execute("UPDATE links SET order_response_json=? WHERE id=?", 
-                                 (json.dumps(error_data, ensure_ascii=False), link_id))
+                        store_result(c2, ORDER, link_id, error_data, latency_ms=latency_ms)
                         conn2.commit()
                 except Exception:
                     pass  # Don't fail if we can't store the error
             raise
 
 
+# Upload pool processes (parallel.py) started under `python app.py` re-import this module as
+# their __main__; background threads only run in the serving process
+_RUN_BACKGROUND_TASKS = multiprocessing.parent_process() is None
+
+# ---------- Landing open/expiry tracking ----------
+link_tracker = tracking.LinkTracker(app)
+if _RUN_BACKGROUND_TASKS:
+    link_tracker.start()
+
+
+# ---------- Background uploads ----------
+upload_job_runner = upload_jobs.UploadJobRunner(app)
+if _RUN_BACKGROUND_TASKS:
+    upload_job_runner.start()
+
+
+# ---------- Outbox dispatcher ----------
+outbox_dispatcher = outbox.OutboxDispatcher(app, _integration_handlers())
+if app.config["AGREE_DISPATCH_MODE"] == "outbox" and _RUN_BACKGROUND_TASKS:
+    outbox_dispatcher.start()
+
+
+def shutdown_background_tasks():
+    """Called from gunicorn's worker_exit hook: let in-flight outbox jobs finish, flush link tracking,
+    hand a running upload back to the queue."""
+    outbox_dispatcher.stop()
+    link_tracker.stop()
+    upload_job_runner.stop()
+    if _integration_pool is not None:
+        _integration_pool.shutdown(wait=True)
+    http_client.close_all()
+
+
 # ---------- Health ----------
 # in app.py (or wherever you create app = Flask(__name__))
 @app.get("/healthz")
@@ -0,0 +1,274 @@
+"""
+Local stand-in for the order and communication APIs, for load and failure
+testing of the agree flow without the real CRM.
+
+  POST .../communications  -> {"ERR_CODE": 0, "DATA": {"COMMUNICATION_ID": n}}
+  POST <any other path>    -> {"ORDER_ID": n}
+  GET  /stats              -> requests per API and outcome, retried idempotency keys
+
+Point the app at it with ORDER_API_URL=http://127.0.0.1:8090/order and
+COMM_API_URL=http://127.0.0.1:8090/communications. Repeated requests with
+the same Idempotency-Key get the same id back, as a retry would.
+
+Each API draws an outcome per request (Behaviour):
+
+  latency       const:MS, uniform:LO-HI, normal:MEAN,SD, lognormal:MEDIAN,SIGMA or exp:MEAN (ms),
+                applied before every answer
+  error_rate    HTTP error_status (default 500) with a JSON error body
+  reject_rate   business rejection: order -> 400 without ORDER_ID, communication -> ERR_CODE 1
+  timeout_rate  no answer for hang_seconds, then the connection is closed
+  reset_rate    the connection is reset (TCP RST) without an answer
+
+  python crm_stub.py --port 8090 --latency lognormal:80,0.6 --error-rate 0.02 --comm-reset-rate 0.01
+"""
+import argparse
+import dataclasses
+import itertools
+import json
+import math
+import random
+import socket
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Optional
+
+ORDER = "order"
+COMMUNICATION = "communication"
+
+SUCCESS = "success"
+ERROR = "error"
+REJECTED = "rejected"
+TIMEOUT = "timeout"
+RESET = "reset"
+
+
+def parse_latency(spec: str):
+    """Latency spec (milliseconds) -> function(rng) returning seconds."""
+    kind, _, params = (spec or "const:0").partition(":")
+    kind = kind.strip().lower()
+    try:
+        if kind == "const":
+            value = float(params or 0)
+            return lambda rng: value / 1000
+        if kind == "uniform":
+            lo, hi = (float(v) for v in params.split("-"))
+            return lambda rng: rng.uniform(lo, hi) / 1000
+        if kind == "normal":
+            mean, sd = (float(v) for v in params.split(","))
+            return lambda rng: max(0.0, rng.gauss(mean, sd)) / 1000
+        if kind == "lognormal":
+            median, sigma = (float(v) for v in params.split(","))
+            return lambda rng: rng.lognormvariate(math.log(median), sigma) / 1000
+        if kind == "exp":
+            mean = float(params)
+            return lambda rng: rng.expovariate(1 / mean) / 1000 if mean > 0 else 0.0
+    except ValueError:
+        pass
+    raise ValueError(f"Invalid latency spec {spec!r} (const:MS, uniform:LO-HI, normal:MEAN,SD, "
+                     f"lognormal:MEDIAN,SIGMA, exp:MEAN)")
+
+
+@dataclasses.dataclass
+class Behaviour:
+    latency: str = "const:0"
+    error_rate: float = 0.0
+    error_status: int = 500
+    reject_rate: float = 0.0
+    timeout_rate: float = 0.0
+    reset_rate: float = 0.0
+    hang_seconds: float = 120.0
+
+    def __post_init__(self):
+        self.delay = parse_latency(self.latency)
+        if self.error_rate + self.reject_rate + self.timeout_rate + self.reset_rate > 1:
+            raise ValueError("error, reject, timeout and reset rates add up to more than 1")
+
+    def outcome(self, rng) -> str:
+        draw = rng.random()
+        for outcome, rate in ((RESET, self.reset_rate), (TIMEOUT, self.timeout_rate),
+                              (ERROR, self.error_rate), (REJECTED, self.reject_rate)):
+            if draw < rate:
+                return outcome
+            draw -= rate
+        return SUCCESS
+
+
+class StubCRM:
+    """Threaded HTTP server answering as the order and communication APIs."""
+
+    def __init__(self, order: Optional[Behaviour] = None, communication: Optional[Behaviour] = None,
+                 seed=None, api_key: str = ""):
+        self.behaviour = {ORDER: order or Behaviour(), COMMUNICATION: communication or Behaviour()}
+        self.api_key = api_key
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._by_key: dict[tuple[str, str], int] = {}  # (api, Idempotency-Key) -> id
+        self._key_requests: dict[tuple[str, str], int] = {}
+        self._counts: dict[str, dict[str, int]] = {ORDER: {}, COMMUNICATION: {}}
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    @property
+    def url(self) -> str:
+        if self._server is None:
+            raise RuntimeError("the stub is not started")
+        host, port = self._server.socket.getsockname()[:2]
+        return f"http://{host}:{port}"
+
+    def start(self, host: str = "127.0.0.1", port: int = 0) -> str:
+        """Serve in a background thread; returns the base URL."""
+        stub = self
+
+        class Handler(_Handler):
+            crm = stub
+
+        server = self._server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name="crm-stub", daemon=True).start()
+        return self.url
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        if self._server is None:
+            self.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "requests": {api: dict(counts) for api, counts in self._counts.items()},
+                "retried_keys": sum(1 for n in self._key_requests.values() if n > 1),
+            }
+
+    def _draw(self, api: str, key: str):
+        """(outcome, delay seconds, id to answer with) for one request."""
+        behaviour = self.behaviour[api]
+        with self._lock:
+            outcome = behaviour.outcome(self._rng)
+            delay = behaviour.delay(self._rng)
+            self._counts[api][outcome] = self._counts[api].get(outcome, 0) + 1
+            external_id = None
+            if key:
+                self._key_requests[(api, key)] = self._key_requests.get((api, key), 0) + 1
+            if outcome == SUCCESS:
+                if key:
+                    external_id = self._by_key.setdefault((api, key), next(self._ids))
+                else:
+                    external_id = next(self._ids)
+        return outcome, delay, external_id
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, as the app's pooled sessions expect
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+    crm: StubCRM
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/stats":
+            self._send(200, self.crm.stats())
+        else:
+            self._send(404, {"ERR_CODE": 404, "ERR_TEXT": "Not found"})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        api = COMMUNICATION if self.path.rstrip("/").endswith("/communications") else ORDER
+        if self.crm.api_key and not self._authorized(api):
+            self._send(401, {"ERR_CODE": 401, "ERR_TEXT": "Unauthorized"})
+            return
+        outcome, delay, external_id = self.crm._draw(api, self.headers.get("Idempotency-Key", ""))
+
+        if outcome == TIMEOUT:
+            time.sleep(self.crm.behaviour[api].hang_seconds)
+            self.close_connection = True
+            return
+        time.sleep(delay)
+        if outcome == RESET:
+            # SO_LINGER 0: close() sends RST instead of FIN
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER, struct.pack("ii", 1, 0))
+            self.connection.close()
+            self.close_connection = True
+        elif outcome == ERROR:
+            self._send(self.crm.behaviour[api].error_status,
+                       {"ERR_CODE": -1, "ERR_TEXT": "Stub internal error"})
+        elif outcome == REJECTED:
+            if api == ORDER:
+                self._send(400, {"ERR_CODE": 400, "ERR_TEXT": "Stub rejected the order"})
+            else:
+                self._send(200, {"ERR_CODE": 1, "ERR_TEXT": "Stub rejected the communication",
+                                 "DATA": None})
+        elif api == ORDER:
+            self._send(200, {"ORDER_ID": external_id})
+        else:
+            self._send(200, {"ERR_CODE": 0, "DATA": {"COMMUNICATION_ID": external_id}})
+
+    def _authorized(self, api: str) -> bool:
+        # Order API takes "Bearer <key>", the communication API the raw key (see app._post_*)
+        expected = f"Bearer {self.crm.api_key}" if api == ORDER else self.crm.api_key
+        return self.headers.get("AUTHORIZATION") == expected
+
+    def _send(self, status: int, body: dict):
+        data = json.dumps(body, ensure_ascii=False).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+_BEHAVIOUR_OPTIONS = (("latency", str), ("error_rate", float), ("error_status", int),
+                      ("reject_rate", float), ("timeout_rate", float), ("reset_rate", float),
+                      ("hang_seconds", float))
+
+
+def main():
+    p = argparse.ArgumentParser(description="Local order / communication API stub.")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8090)
+    p.add_argument("--seed", type=int)
+    p.add_argument("--api-key", default="",
+                   help="require this key (as ORDER_API_KEY / COMM_API_KEY)")
+    # --latency etc. set both APIs; --order-latency / --comm-latency etc. override one of them
+    for name, type_ in _BEHAVIOUR_OPTIONS:
+        flag = name.replace("_", "-")
+        p.add_argument(f"--{flag}", type=type_)
+        p.add_argument(f"--order-{flag}", type=type_)
+        p.add_argument(f"--comm-{flag}", type=type_)
+    args = p.parse_args()
+
+    def behaviour(prefix):
+        values = {}
+        for name, _ in _BEHAVIOUR_OPTIONS:
+            value = getattr(args, f"{prefix}_{name}")
+            value = getattr(args, name) if value is None else value
+            if value is not None:
+                values[name] = value
+        return Behaviour(**values)
+
+    stub = StubCRM(order=behaviour("order"), communication=behaviour("comm"), seed=args.seed,
+                   api_key=args.api_key)
+    url = stub.start(args.host, args.port)
+    print(f"[ok] CRM stub on {url}: ORDER_API_URL={url}/order COMM_API_URL={url}/communications")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(stub.stats()))
+        stub.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,10 @@
 import os, sqlite3, json, datetime
+import threading, time
 from contextlib import contextmanager
 from pathlib import Path
 
+import sql_trace
+
 # DB_PATH = "app.db"
 
 # db.py
@@ -23,142 +26,213 @@ if db_dir and not os.path.exists(db_dir):
     Path(db_dir).mkdir(parents=True, exist_ok=True)
 
 
-@contextmanager
-def db():
-    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES)
+# Connection pool & PRAGMAs
+# Each thread keeps up to DB_POOL_SIZE idle connections (sqlite3 connections are
+# bound to the thread that opened them). PRAGMAs are applied once per connection.
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "4"))  # 0 disables pooling
+DB_JOURNAL_MODE = os.getenv("DB_JOURNAL_MODE", "WAL").strip().upper()
+DB_SYNCHRONOUS = os.getenv("DB_SYNCHRONOUS", "NORMAL").strip().upper()
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_CACHE_SIZE_KB = int(os.getenv("DB_CACHE_SIZE_KB", "20000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(256 * 1024 * 1024)))
+# Idle connections older than this are checked with "SELECT 1" before reuse
+DB_HEALTHCHECK_IDLE_SECONDS = float(os.getenv("DB_HEALTHCHECK_IDLE_SECONDS", "30"))
+# Trace every db() statement by default (sql_trace.py); db(trace=True) traces a single block
+SQL_TRACE = os.getenv("SQL_TRACE", "0").strip().lower() in ("1", "true", "yes", "on")
+
+_JOURNAL_MODES = {"DELETE", "TRUNCATE", "PERSIST", "MEMORY", "WAL", "OFF"}
+_SYNCHRONOUS_MODES = {"OFF", "NORMAL", "FULL", "EXTRA"}
+
+_local = threading.local()
+_stats_lock = threading.Lock()
+_stats = {"opened": 0, "reused": 0, "closed": 0, "health_check_failures": 0}
+
+
+def _count(key, n=1):
+    with _stats_lock:
+        _stats[key] += n
+
+
+# Statement observers, fn(cursor, sql, seconds, executed), called after every execute
+# (executed=True) and fetch (executed=False) on db() connections. The list is replaced,
+# never changed in place, so cursors iterate it without the lock.
+_statement_observers: list = []
+_observers_lock = threading.Lock()
+
+
+def add_statement_observer(fn):
+    """Register fn(cursor, sql, seconds, executed); fetches report the statement they read from."""
+    global _statement_observers
+    with _observers_lock:
+        if fn not in _statement_observers:
+            _statement_observers = [*_statement_observers, fn]
+
+
+class _TimedCursor(sqlite3.Cursor):
+    """Cursor that reports statement time (execute plus fetches: SQLite steps rows lazily)."""
+    _sql = ""
+    # Statement text with the parameters bound, while the connection is traced (see SQL_TRACE)
+    traced_sql = None
+
+    def _timed(self, call, args, executed):
+        if not _statement_observers:
+            return call(*args)
+        started = time.perf_counter()
+        try:
+            return call(*args)
+        finally:
+            seconds = time.perf_counter() - started
+            if executed:
+                self.traced_sql = self.connection.traced_sql
+            for fn in _statement_observers:
+                fn(self, self._sql, seconds, executed)
+
+    def execute(self, sql, parameters=()):
+        self._sql = sql
+        return self._timed(super().execute, (sql, parameters), True)
+
+    def executemany(self, sql, seq_of_parameters):
+        self._sql = sql
+        return self._timed(super().executemany, (sql, seq_of_parameters), True)
+
+    def fetchone(self):
+        return self._timed(super().fetchone, (), False)
+
+    def fetchmany(self, *args):
+        return self._timed(super().fetchmany, args, False)
+
+    def fetchall(self):
+        return self._timed(super().fetchall, (), False)
+
+
+class _TimedConnection(sqlite3.Connection):
+    traced = False
+    traced_sql = None
+
+    # Connection.execute() would bypass the cursor class's execute()
+    def cursor(self, factory=_TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def set_traced(self, traced: bool):
+        """sqlite3 trace callback on/off; it keeps the last statement started, parameters bound."""
+        if traced != self.traced:
+            self.traced, self.traced_sql = traced, None
+            self.set_trace_callback(self._trace if traced else None)
+
+    def _trace(self, statement):
+        self.traced_sql = statement
+
+
+def _apply_pragmas(conn):
+    if DB_JOURNAL_MODE in _JOURNAL_MODES:
+        conn.execute(f"PRAGMA journal_mode={DB_JOURNAL_MODE}")
+    if DB_SYNCHRONOUS in _SYNCHRONOUS_MODES:
+        conn.execute(f"PRAGMA synchronous={DB_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+    conn.execute(f"PRAGMA cache_size={-int(DB_CACHE_SIZE_KB)}")  # negative = KiB
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+
+
+def _connect():
+    conn = sqlite3.connect(DB_PATH, detect_types=sqlite3.PARSE_DECLTYPES,
+                           timeout=max(DB_BUSY_TIMEOUT_MS, 0) / 1000, factory=_TimedConnection)
     conn.row_factory = sqlite3.Row
+    _apply_pragmas(conn)
+    _count("opened")
+    return conn
+
+
+def _close(conn):
     try:
-        yield conn
-    finally:
         conn.close()
+    except sqlite3.Error:
+        pass
+    _count("closed")
 
-def now_iso():
-    return datetime.datetime.now(datetime.timezone.utc).isoformat()
 
-def init_db():
-    with db() as conn:
-        c = conn.cursor()
-        # users (customer master)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS users (
-          id INTEGER PRIMARY KEY,
-          name TEXT,
-          phone TEXT,
-          identification_number TEXT,
-          email TEXT,
-          filial_id INTEGER,
-          customer_account_id INTEGER UNIQUE
-        )""")
-
-        # offers (product catalog)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS offers (
-          id INTEGER PRIMARY KEY,
-          title TEXT NOT NULL,
-          bundle TEXT NOT NULL,      -- 'internet' | 'fms' | 'tv' | 'bundle'
-          price NUMERIC,
-          currency TEXT,
-          details_json TEXT,
-          product_offer_id INTEGER,
-          product_offer_struct_id INTEGER,
-          po_struct_element_id INTEGER,
-          product_num TEXT,
-          resource_spec_id INTEGER
-        )""")
-
-        # bulk uploads (a batch of suggested links)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS bulk_uploads (
-          id INTEGER PRIMARY KEY,
-          filename TEXT,
-          uploaded_at TEXT,
-          offer_id INTEGER,
-          expires_at TEXT,
-          count_total INTEGER DEFAULT 0,
-          notes TEXT,
-          FOREIGN KEY(offer_id) REFERENCES offers(id)
-        )""")
-
-        # links (one per user/offer)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS links (
-          id INTEGER PRIMARY KEY,
-          upload_id INTEGER,
-          user_id INTEGER,
-          offer_id INTEGER,
-          external_id TEXT,
-          token TEXT UNIQUE,
-          created_at TEXT,
-          expires_at TEXT,
-          opened_at TEXT,
-          agreed_at TEXT,
-          rejected_at TEXT,
-          status TEXT DEFAULT 'NEW',    -- NEW | OPENED | AGREED | REJECTED | EXPIRED | USED
-          offer_snapshot_json TEXT,
-          product_key TEXT,
-          address_json TEXT,
-          FOREIGN KEY(user_id) REFERENCES users(id),
-          FOREIGN KEY(offer_id) REFERENCES offers(id),
-          FOREIGN KEY(upload_id) REFERENCES bulk_uploads(id)
-        )""")
-        
-        # Add address_json column if it doesn't exist (for existing databases)
-        try:
-            c.execute("ALTER TABLE links ADD COLUMN address_json TEXT")
-        except sqlite3.OperationalError:
-            pass  # Column already exists
+def _idle_connections():
+    # threading.local survives fork in the forking thread: never reuse the parent's connections
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.pid = os.getpid()
+        _local.idle = []
+    return _local.idle
 
-        # Add product_key column if it doesn't exist (for existing databases)
-        try:
-            c.execute("ALTER TABLE links ADD COLUMN product_key TEXT")
-        except sqlite3.OperationalError:
-            pass  # Column already exists
-        
-        # Add order_response_json column if it doesn't exist (for existing databases)
-        try:
-            c.execute("ALTER TABLE links ADD COLUMN order_response_json TEXT")
-        except sqlite3.OperationalError:
-            pass  # Column already exists
 
-        # CRM customer id (from segment upload) — optional
-        try:
-            c.execute("ALTER TABLE users ADD COLUMN customer_id INTEGER")
-        except sqlite3.OperationalError:
-            pass
+def _checkout():
+    idle = _idle_connections()
+    while idle:
+        conn, last_used = idle.pop()
+        if time.monotonic() - last_used > DB_HEALTHCHECK_IDLE_SECONDS:
+            try:
+                conn.execute("SELECT 1").fetchone()
+            except sqlite3.Error:
+                _count("health_check_failures")
+                _close(conn)
+                continue
+        _count("reused")
+        return conn
+    return _connect()
 
-        # Optional identification number (IIN/BIN) for communication extensions
-        try:
-            c.execute("ALTER TABLE users ADD COLUMN identification_number TEXT")
-        except sqlite3.OperationalError:
-            pass
 
-        # Communication API response (potential deal / communication)
-        try:
-            c.execute("ALTER TABLE links ADD COLUMN communication_response_json TEXT")
-        except sqlite3.OperationalError:
-            pass
-
-        # consents (audit trail)
-        c.execute("""
-        CREATE TABLE IF NOT EXISTS consents (
-          id INTEGER PRIMARY KEY,
-          link_id INTEGER,
-          consent_text TEXT,
-          choice TEXT,                -- 'AGREED' or 'REJECTED'
-          created_at TEXT,
-          ip TEXT,
-          user_agent TEXT,
-          FOREIGN KEY(link_id) REFERENCES links(id)
-        )""")
-        conn.commit()
-
-        # Indexes (idempotent)
-        c.execute("CREATE INDEX IF NOT EXISTS idx_users_customer_account_id ON users(customer_account_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_links_upload_id ON links(upload_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_links_user_id ON links(user_id)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_links_status ON links(status)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_consents_link_id ON consents(link_id)")
-        conn.commit()
+def _checkin(conn):
+    # Same semantics as the old close(): anything not committed is discarded
+    try:
+        if conn.in_transaction:
+            conn.rollback()
+        conn.row_factory = sqlite3.Row
+    except sqlite3.Error:
+        _close(conn)
+        return
+    idle = _idle_connections()
+    if len(idle) < DB_POOL_SIZE:
+        idle.append((conn, time.monotonic()))
+    else:
+        _close(conn)
+
+
+@contextmanager
+def db(trace=None):
+    """Pooled connection; trace=True/False overrides SQL_TRACE for this block."""
+    conn = _checkout()
+    traced = SQL_TRACE if trace is None else trace
+    # Registered by the first traced block, so untraced processes keep the no-observer fast path
+    if traced and sql_trace.record not in _statement_observers:
+        add_statement_observer(sql_trace.record)
+    conn.set_traced(traced)
+    try:
+        yield conn
+    finally:
+        _checkin(conn)
+
+
+def db_stats():
+    """Connection pool counters for this process (all threads)."""
+    with _stats_lock:
+        out = dict(_stats)
+    out["idle_in_current_thread"] = len(_idle_connections())
+    out["pool_size_per_thread"] = DB_POOL_SIZE
+    out["pragmas"] = {
+        "journal_mode": DB_JOURNAL_MODE,
+        "synchronous": DB_SYNCHRONOUS,
+        "busy_timeout_ms": DB_BUSY_TIMEOUT_MS,
+        "cache_size_kb": DB_CACHE_SIZE_KB,
+        "mmap_size": DB_MMAP_SIZE,
+    }
+    return out
+
+def now_iso():
+    return datetime.datetime.now(datetime.timezone.utc).isoformat()
+
+def init_db():
+    """Apply pending schema migrations (a single PRAGMA read when already up to date)."""
+    from migrations import migrate
+    return migrate()
 
 def fetch_offer_snapshot(cur, offer_id: int):
     cur.execute("SELECT * FROM offers WHERE id=?", (offer_id,))
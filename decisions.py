@@ -0,0 +1,88 @@
+"""
+Agree/reject state transitions shared by /api/agree, /api/reject, /agree and /reject.
+
+The transition itself is one conditional UPDATE guarded by the link's current
+status (UPDATE ... WHERE status NOT IN (...) RETURNING). The consent row and,
+for agree, the outbox jobs are written in the same short transaction, so two
+concurrent clicks can never both record a decision: the second UPDATE matches
+no row and is reported as "already decided". The link and its snapshot are
+read before the write transaction starts, which keeps the write lock to the
+UPDATE + INSERTs + COMMIT.
+"""
+import datetime
+from collections import namedtuple
+
+from db import db, now_iso
+from snapshots import LINK_SNAPSHOT_COLUMNS, LINK_SNAPSHOT_JOIN, link_offer
+
+AGREED = "AGREED"
+REJECTED = "REJECTED"
+
+# Outcomes
+OK = "ok"
+NOT_FOUND = "not_found"
+EXPIRED = "expired"
+ALREADY = "already"
+
+# outcome: one of the above; link: row (current status for ALREADY); offer: link snapshot;
+# at: decision time
+Decision = namedtuple("Decision", "outcome link offer at")
+
+_TIMESTAMP_COLUMN = {AGREED: "agreed_at", REJECTED: "rejected_at"}
+_CONSENT_TEXT = {AGREED: "Agreed to '{title}' ({bundle}) at {at}",
+                 REJECTED: "Rejected '{title}' ({bundle}) at {at}"}
+
+
+def is_expired(expires_at) -> bool:
+    if not expires_at:
+        return False
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return datetime.datetime.fromisoformat(expires_at) < now
+
+
+def decide(link_id: int, choice: str, *, blocked_statuses, check_expiry: bool, mark_opened: bool,
+           ip=None, user_agent=None, in_transaction=None) -> Decision:
+    """Record `choice` (AGREED / REJECTED) for a link unless its status is in `blocked_statuses`.
+
+    check_expiry: report EXPIRED for links past expires_at (decision pages; the JSON API never did).
+    mark_opened: also set opened_at if the link was never opened.
+    in_transaction: optional callable(cur, link_id) run before COMMIT, e.g. outbox enqueue.
+    """
+    at = now_iso()
+    blocked = tuple(blocked_statuses)
+    with db() as conn:
+        c = conn.cursor()
+        c.execute(f"""SELECT l.*, {LINK_SNAPSHOT_COLUMNS}
+                        FROM links l {LINK_SNAPSHOT_JOIN}
+                       WHERE l.id=?""", (link_id,))
+        link = c.fetchone()
+        if not link:
+            return Decision(NOT_FOUND, None, None, at)
+        offer = link_offer(link)
+        if check_expiry and is_expired(link["expires_at"]):
+            return Decision(EXPIRED, link, offer, at)
+        # Fast path without taking the write lock; the UPDATE guard below is what enforces it
+        if link["status"] in blocked:
+            return Decision(ALREADY, link, offer, at)
+
+        opened_sql = ", opened_at=COALESCE(opened_at, ?)" if mark_opened else ""
+        params = [choice, at] + ([at] if mark_opened else []) + [link_id] + list(blocked)
+        c.execute(f"""UPDATE links SET status=?, {_TIMESTAMP_COLUMN[choice]}=?{opened_sql}
+                       WHERE id=? AND status NOT IN ({",".join("?" * len(blocked))})
+                   RETURNING id""", params)
+        if c.fetchone() is None:
+            # Lost the race to a concurrent decision: report the state it left behind
+            conn.rollback()
+            c.execute("SELECT * FROM links WHERE id=?", (link_id,))
+            return Decision(ALREADY, c.fetchone(), offer, at)
+
+        consent_text = _CONSENT_TEXT[choice].format(title=offer.get("title"),
+                                                    bundle=offer.get("bundle"), at=at)
+        c.execute("""INSERT INTO consents
+                       (link_id, consent_text, choice, created_at, ip, user_agent)
+                     VALUES (?, ?, ?, ?, ?, ?)""",
+                  (link_id, consent_text, choice, at, ip, user_agent))
+        if in_transaction is not None:
+            in_transaction(c, link_id)
+        conn.commit()
+    return Decision(OK, link, offer, at)
@@ -1,3 +1,6 @@
+import os
+import tempfile
+
 bind = "0.0.0.0:5000"
 workers = 3
 threads = 2
@@ -7,3 +10,35 @@ keepalive = 10
 loglevel = "info"
 accesslog = "-"
 errorlog = "-"
+
+# Workers write Prometheus samples here so /metrics can aggregate all of them (see metrics.py);
+# set before the app is imported in the workers
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "landing-prometheus"))
+
+
+def on_starting(server):
+    # Apply schema migrations once per deploy in the master; workers then only read PRAGMA user_version
+    from dotenv import load_dotenv
+    load_dotenv()
+    import migrations
+    migrations.migrate()
+    # Samples of a previous run would be added to this one's
+    metrics_dir = os.environ["PROMETHEUS_MULTIPROC_DIR"]
+    os.makedirs(metrics_dir, exist_ok=True)
+    for name in os.listdir(metrics_dir):
+        if name.endswith(".db"):
+            os.remove(os.path.join(metrics_dir, name))
+
+
+def worker_exit(server, worker):
+    # Finish background work (outbox dispatcher, queued link opens) before the worker goes away
+    import sys
+    app_module = sys.modules.get("app")
+    if app_module is not None and hasattr(app_module, "shutdown_background_tasks"):
+        app_module.shutdown_background_tasks()
+
+
+def child_exit(server, worker):
+    # Drop the exited worker's live gauges; its counters and histograms stay in the totals
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
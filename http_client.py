@@ -0,0 +1,94 @@
+"""
+Pooled keep-alive HTTP sessions for upstream APIs (order API, communication API).
+
+Each gunicorn worker keeps one requests.Session per upstream, so the TCP/TLS
+handshake to the CRM is paid once per pooled connection instead of once per
+agree click and per tenacity retry. Pool sizes come from app config
+(HTTP_POOL_CONNECTIONS / HTTP_POOL_MAXSIZE / HTTP_POOL_BLOCK).
+"""
+import os
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+_lock = threading.Lock()
+_sessions: dict[str, requests.Session] = {}
+_owner_pid: Optional[int] = None
+
+
+def _new_session(config) -> requests.Session:
+    adapter = HTTPAdapter(
+        pool_connections=max(1, int(config.get("HTTP_POOL_CONNECTIONS") or 4)),
+        pool_maxsize=max(1, int(config.get("HTTP_POOL_MAXSIZE") or 10)),
+        pool_block=bool(config.get("HTTP_POOL_BLOCK")),
+        max_retries=0,  # retries are handled by tenacity in app.py
+    )
+    s = requests.Session()
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+
+def get_session(upstream: str, config) -> requests.Session:
+    """Session for an upstream name ('order', 'communication'), created on first use."""
+    global _owner_pid
+    with _lock:
+        # Never share pooled sockets with a forked child
+        if _owner_pid != os.getpid():
+            _sessions.clear()
+            _owner_pid = os.getpid()
+        s = _sessions.get(upstream)
+        if s is None:
+            s = _new_session(config)
+            _sessions[upstream] = s
+        return s
+
+
+def close_all():
+    with _lock:
+        for s in _sessions.values():
+            s.close()
+        _sessions.clear()
+
+
+def pool_stats() -> dict:
+    """Per-upstream connection pool counters.
+
+    misses = new connections opened (handshakes), hits = requests served on an
+    already-open keep-alive connection.
+    """
+    out = {}
+    with _lock:
+        items = list(_sessions.items())
+    for upstream, s in items:
+        adapter = s.get_adapter("https://")
+        if not isinstance(adapter, HTTPAdapter):  # always ours, see _new_session()
+            continue
+        pools = []
+        requests_total = connections_total = 0
+        for key in list(adapter.poolmanager.pools.keys()):
+            pool = adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            n_req = getattr(pool, "num_requests", 0)
+            n_conn = getattr(pool, "num_connections", 0)
+            requests_total += n_req
+            connections_total += n_conn
+            pools.append({
+                "host": f"{pool.scheme}://{pool.host}:{pool.port}",
+                "requests": n_req,
+                "connections_opened": n_conn,
+                # The pool queue is pre-filled with None placeholders; count real sockets only
+                "idle": (sum(1 for conn in list(pool.pool.queue) if conn is not None)
+                         if pool.pool is not None else 0),
+                "maxsize": pool.pool.maxsize if pool.pool is not None else 0,
+            })
+        out[upstream] = {
+            "requests": requests_total,
+            "hits": max(0, requests_total - connections_total),
+            "misses": connections_total,
+            "pools": pools,
+        }
+    return out
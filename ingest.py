@@ -0,0 +1,108 @@
+"""
+Set-based ingest of validated upload rows.
+
+upload_new used to run a SELECT, up to five UPDATEs or an INSERT into users,
+and an INSERT into links for every row. The clean frame from
+upload_validation.validate_frame() is now bulk-loaded into a per-connection
+staging table with one executemany, and users/links are written with a few
+INSERT ... SELECT statements in the caller's transaction.
+
+The user upsert keeps the old row-by-row outcome when an account appears
+several times (or already exists): filial_id comes from the last row, the
+optional fields from the last row where they are set, otherwise the stored
+value is kept (for a new user: the value of its first row).
+
+Links get their token in the same pass: the new link ids come back from the
+INSERT (RETURNING) and the signed tokens are written with one executemany, so
+an upload no longer needs the separate "assign tokens" step. A row whose link
+already exists (same upload, same external_id) is not linked again, so
+ingesting a chunk twice creates its links once.
+"""
+from db import now_iso
+
+STAGING_TABLE = "upload_staging"
+
+_STAGING_COLUMNS = ("row", "customer_account_id", "filial_id", "customer_id", "phone", "name",
+                    "identification_number", "address_json")
+
+
+def _last(column: str, present_sql: str) -> str:
+    """Correlated subquery: the account's `column` from its last row where it is present."""
+    return f"""(SELECT x.{column} FROM temp.{STAGING_TABLE} x
+                 WHERE x.customer_account_id = s.customer_account_id AND {present_sql}
+                 ORDER BY x.row DESC LIMIT 1)"""
+
+
+def ingest_rows(cur, clean, *, upload_id: int, offer_id: int, expires_at: str, snapshot_id: int,
+                product_key, external_prefix: str, sign_tokens=None) -> int:
+    """Upsert users and insert one NEW link per clean row. Returns the number of links created.
+
+    sign_tokens(link_ids) -> tokens, when given, signs the new links in the same transaction.
+    Runs in the caller's transaction; the staging table is dropped before returning
+    (pooled connections outlive the request).
+    """
+    if clean.empty:
+        return 0
+    cur.execute(f"DROP TABLE IF EXISTS temp.{STAGING_TABLE}")
+    cur.execute(f"""CREATE TEMP TABLE {STAGING_TABLE} (
+                      row INTEGER PRIMARY KEY,              -- 1-based row in the uploaded file
+                      customer_account_id INTEGER NOT NULL,
+                      filial_id INTEGER NOT NULL,
+                      customer_id INTEGER,
+                      phone TEXT,
+                      name TEXT,
+                      identification_number TEXT,
+                      address_json TEXT)""")
+    try:
+        # tolist() yields Python ints/str (sqlite3 cannot bind numpy scalars)
+        columns = [clean[name].tolist() for name in _STAGING_COLUMNS]
+        cur.executemany(f"INSERT INTO temp.{STAGING_TABLE} VALUES ({','.join('?' * len(columns))})",
+                        zip(*columns))
+        cur.execute(f"CREATE INDEX temp.{STAGING_TABLE}_account "
+                    f"ON {STAGING_TABLE}(customer_account_id, row)")
+
+        # One statement for all accounts; new users are inserted in order of first appearance.
+        # phone may be '' (whitespace-only cell): kept for a new user, never replaces a stored one.
+        cur.execute(f"""
+            INSERT INTO users (name, phone, identification_number, email, filial_id,
+                               customer_account_id, customer_id)
+            SELECT {_last("name", "x.name <> ''")},
+                   COALESCE({_last("phone", "x.phone <> ''")}, s.phone),
+                   {_last("identification_number", "x.identification_number <> ''")},
+                   NULL,
+                   {_last("filial_id", "1")},
+                   s.customer_account_id,
+                   {_last("customer_id", "x.customer_id IS NOT NULL")}
+              FROM temp.{STAGING_TABLE} s
+             WHERE s.row = (SELECT MIN(f.row) FROM temp.{STAGING_TABLE} f
+                             WHERE f.customer_account_id = s.customer_account_id)
+             ORDER BY s.row
+            ON CONFLICT(customer_account_id) DO UPDATE SET
+                   filial_id = excluded.filial_id,
+                   phone = CASE WHEN excluded.phone <> '' THEN excluded.phone ELSE users.phone END,
+                   customer_id = COALESCE(excluded.customer_id, users.customer_id),
+                   name = COALESCE(excluded.name, users.name),
+                   identification_number = COALESCE(excluded.identification_number,
+                                                    users.identification_number)""")
+
+        # external_id names the file row: rows already linked (a chunk run again) are skipped
+        row_prefix = f"{external_prefix}-{upload_id}-"
+        cur.execute(f"""
+            INSERT INTO links (upload_id, user_id, offer_id, external_id, created_at, expires_at,
+                               status, snapshot_id, product_key, address_json)
+            SELECT ?, u.id, ?, ? || s.row, ?, ?, 'NEW', ?, ?, s.address_json
+              FROM temp.{STAGING_TABLE} s
+              JOIN users u ON u.customer_account_id = s.customer_account_id
+             WHERE NOT EXISTS (SELECT 1 FROM links l
+                                WHERE l.upload_id = ? AND l.external_id = ? || s.row)
+             ORDER BY s.row
+            RETURNING id""",
+                    (upload_id, offer_id, row_prefix, now_iso(), expires_at, snapshot_id,
+                     product_key, upload_id, row_prefix))
+        link_ids = [r[0] for r in cur.fetchall()]
+        if sign_tokens is not None and link_ids:
+            cur.executemany("UPDATE links SET token=? WHERE id=?",
+                            zip(sign_tokens(link_ids), link_ids))
+        return len(link_ids)
+    finally:
+        cur.execute(f"DROP TABLE IF EXISTS temp.{STAGING_TABLE}")
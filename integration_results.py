@@ -0,0 +1,166 @@
+"""
+Results of the order / communication calls.
+
+Every call is recorded as a row of integration_attempts (append-only: retries
+and resends add attempts, nothing is overwritten) holding the request, a
+compact response (the parsed JSON, or the text when the body is not JSON),
+status, HTTP status and latency. The link keeps only a pointer to its latest
+attempt per kind plus the values the admin pages and reports filter on, in
+indexed columns written by the same transaction:
+
+  order_attempt_id, order_id, order_success, order_attempted_at
+  communication_attempt_id, communication_id, communication_success, communication_attempted_at
+
+*_success is 1/0 once a call was made or skipped (a skipped communication
+counts as not successful) and NULL while it never was; *_attempted_at is the
+UTC time of the latest attempt. order_response_json /
+communication_response_json on links are no longer written (migration 7
+moved them into integration_attempts).
+"""
+import datetime
+import json
+
+import metrics
+from db import now_iso
+
+ORDER = "order"
+COMMUNICATION = "communication"
+
+# integration_attempts.status
+SUCCESS = "SUCCESS"
+FAILED = "FAILED"
+SKIPPED = "SKIPPED"
+
+# Response bodies that are not JSON are kept up to this many characters per attempt
+RESPONSE_TEXT_LIMIT = 4000
+
+
+def order_id(result: dict):
+    response = result.get("response_json")
+    return response.get("ORDER_ID") if isinstance(response, dict) else None
+
+
+def communication_id(result: dict):
+    comm_id = None
+    response = result.get("response_json")
+    if isinstance(response, dict):
+        data = response.get("DATA") or response.get("data")
+        if isinstance(data, dict):
+            comm_id = data.get("COMMUNICATION_ID", data.get("communicationId"))
+    if comm_id is None:
+        comm_id = result.get("communication_id")
+    return comm_id
+
+
+_EXTERNAL_ID = {ORDER: order_id, COMMUNICATION: communication_id}
+
+
+def _column_id(value):
+    # ids go into TEXT columns; "" / {} etc. are not ids
+    if value is None or value == "" or isinstance(value, (dict, list)):
+        return None
+    return str(value)
+
+
+def result_columns(kind: str, result: dict) -> tuple:
+    """(external id, success) as stored in the extracted columns."""
+    return _column_id(_EXTERNAL_ID[kind](result)), 1 if result.get("success") else 0
+
+
+def _compact(value) -> str:
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def attempt_values(kind: str, result: dict) -> dict:
+    """integration_attempts columns (besides link, numbering and timing) of a call result."""
+    external_id, success = result_columns(kind, result)
+    if result.get("skipped"):
+        status = SKIPPED
+    else:
+        status = SUCCESS if success else FAILED
+    response = result.get("response_json")
+    # The raw text duplicates a parsed JSON body; other bodies are kept up to RESPONSE_TEXT_LIMIT
+    text = None if response else result.get("response_text")
+    return {
+        "status": status,
+        "http_status": result.get("status_code"),
+        "external_id": external_id,
+        "request_json": _compact(result["request"]) if result.get("request") else None,
+        "response_json": _compact(response) if response else None,
+        "response_text": text[:RESPONSE_TEXT_LIMIT] if text else None,
+        "error": result.get("reason") if status == SKIPPED else result.get("error"),
+        "error_type": result.get("error_type"),
+    }
+
+
+def insert_attempt(c, kind: str, link_id: int, values: dict, attempted_at: str,
+                   latency_ms=None) -> int:
+    """Append an attempt (next attempt_no of the link and kind); returns its id."""
+    c.execute("""INSERT INTO integration_attempts
+                   (link_id, kind, attempt_no, status, http_status, latency_ms, external_id,
+                    attempted_at, request_json, response_json, response_text, error, error_type)
+                 VALUES (?, ?, COALESCE((SELECT MAX(attempt_no) FROM integration_attempts
+                                          WHERE link_id=? AND kind=?), 0) + 1,
+                         ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                 RETURNING id""",
+              (link_id, kind, link_id, kind, values["status"], values["http_status"], latency_ms,
+               values["external_id"], attempted_at, values["request_json"], values["response_json"],
+               values["response_text"], values["error"], values["error_type"]))
+    return c.fetchone()[0]
+
+
+def store_result(c, kind: str, link_id: int, result: dict, latency_ms=None):
+    """Record a call result as a new attempt and point the link at it; the caller commits."""
+    values = attempt_values(kind, result)
+    attempted_at = now_iso()
+    attempt_id = insert_attempt(c, kind, link_id, values, attempted_at, latency_ms)
+    c.execute(f"""UPDATE links
+                     SET {kind}_attempt_id=?, {kind}_id=?, {kind}_success=?, {kind}_attempted_at=?
+                   WHERE id=?""",
+              (attempt_id, values["external_id"], 1 if values["status"] == SUCCESS else 0,
+               attempted_at, link_id))
+    metrics.integration_attempt(kind, values["status"], latency_ms)
+
+
+def result_from_attempt(row) -> dict:
+    """An integration_attempts row in the shape of the stored call result (for display)."""
+    result = {
+        "success": row["status"] == SUCCESS,
+        "status_code": row["http_status"],
+        "timestamp": row["attempted_at"],
+        "attempt_no": row["attempt_no"],
+        "latency_ms": row["latency_ms"],
+    }
+    if row["request_json"]:
+        result["request"] = json.loads(row["request_json"])
+    if row["response_json"]:
+        result["response_json"] = json.loads(row["response_json"])
+    if row["response_text"]:
+        result["response_text"] = row["response_text"]
+    if row["status"] == SKIPPED:
+        result.update(skipped=True, reason=row["error"])
+    elif row["error"]:
+        result.update(error=row["error"], error_type=row["error_type"])
+    return {key: value for key, value in result.items() if value is not None}
+
+
+def backfill_columns(kind: str, raw):
+    """(external id, success, attempted_at) of a stored JSON result; None if there is none.
+
+    attempted_at comes from the result's own timestamp (server local time) converted to UTC.
+    """
+    if not raw or not str(raw).strip():
+        return None
+    try:
+        result = json.loads(raw)
+    except (TypeError, ValueError):
+        return None, 0, None
+    if not isinstance(result, dict):
+        return None, 0, None
+    attempted_at = None
+    try:
+        attempted_at = datetime.datetime.fromisoformat(result["timestamp"]).astimezone(
+            datetime.timezone.utc).isoformat()
+    except (KeyError, TypeError, ValueError):
+        pass
+    return (*result_columns(kind, result), attempted_at)
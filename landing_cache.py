@@ -0,0 +1,88 @@
+"""
+Render cache for the public landing page.
+
+landing.html depends on the offer snapshot and the language; only the token,
+the page URL and the customer block (account number, address) differ between
+recipients of the same offer. The page is rendered once per (snapshot_id, lang)
+into a shell whose per-link parts are slot markers, and each open only fills
+the slots (the customer block is the small _landing_customer.html partial).
+
+The cache is per worker. Keys are snapshot ids, which are immutable, so an
+offer edit never serves stale content; offer save evicts the offer's shells to
+free memory right away.
+"""
+import re
+import threading
+from collections import OrderedDict
+
+from markupsafe import escape
+
+CUSTOMER_VARIANTS = ("plain", "subscriber")
+
+_SLOT = "@@landing-slot:{}@@"   # no HTML-special characters, survives autoescaping
+_SLOT_RE = re.compile(r"@@landing-slot:(\w+)@@")
+
+_lock = threading.Lock()
+# (snapshot_id, lang) -> (offer_id, html)
+_shells: OrderedDict[tuple[int, str], tuple[int, str]] = OrderedDict()
+_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+
+def shell_context() -> dict:
+    """Template variables that turn per-link values into slot markers."""
+    return {
+        "token": _SLOT.format("token"),
+        "page_url": _SLOT.format("page_url"),
+        "customer_slots": {v: _SLOT.format(f"customer_{v}") for v in CUSTOMER_VARIANTS},
+    }
+
+
+def get(key):
+    with _lock:
+        entry = _shells.get(key)
+        if entry is None:
+            _stats["misses"] += 1
+            return None
+        _shells.move_to_end(key)
+        _stats["hits"] += 1
+        return entry[1]
+
+
+def put(key, offer_id, html: str, max_size: int):
+    with _lock:
+        _shells[key] = (offer_id, html)
+        _shells.move_to_end(key)
+        while len(_shells) > max(1, max_size):
+            _shells.popitem(last=False)
+            _stats["evictions"] += 1
+
+
+def evict_offer(offer_id) -> int:
+    """Drop every cached shell of an offer (all snapshots, all languages)."""
+    with _lock:
+        keys = [k for k, (oid, _) in _shells.items() if oid == offer_id]
+        for k in keys:
+            del _shells[k]
+        _stats["evictions"] += len(keys)
+    return len(keys)
+
+
+def fill(shell: str, token: str, page_url: str, customer_html) -> str:
+    """Insert per-link values; `customer_html(variant)` returns the rendered customer block."""
+    values = {"token": str(escape(token)), "page_url": str(escape(page_url))}
+
+    def _sub(m):
+        name = m.group(1)
+        if name not in values and name.startswith("customer_"):
+            values[name] = customer_html(name[len("customer_"):])
+        return values.get(name, "")
+
+    return _SLOT_RE.sub(_sub, shell)
+
+
+def stats() -> dict:
+    with _lock:
+        out: dict = dict(_stats, size=len(_shells))
+    lookups = out["hits"] + out["misses"]
+    out["hit_ratio"] = round(out["hits"] / lookups, 4) if lookups else None
+    return out
@@ -0,0 +1,130 @@
+"""
+Prometheus metrics, exposed at GET /metrics.
+
+Under gunicorn every worker writes its samples to files in
+PROMETHEUS_MULTIPROC_DIR (set and cleaned up in gunicorn.conf.py), and
+/metrics aggregates all live workers, whichever one serves the scrape.
+Without that variable (python app.py) it reports this process only.
+
+With METRICS_TOKEN set, a scrape must send "Authorization: Bearer <token>"
+(Prometheus: authorization.credentials in the scrape config); anything else
+gets 401. Without it /metrics is open, so block it at the proxy instead.
+
+  http_request_duration_seconds{method,endpoint,status}  request latency
+  http_request_db_seconds{endpoint}                      SQLite time per request (db() statements)
+  crm_request_duration_seconds{integration,status}       order / communication call latency
+  crm_attempts_total{integration,status}                 recorded calls, incl. skipped ones
+  crm_retries_total{integration}                         retries after timeouts / connection errors
+  upload_rows_total{result}                              upload rows read, valid / rejected
+  upload_links_created_total                             links created by uploads
+  upload_chunk_seconds                                   read + validate + commit of an upload chunk
+"""
+import hmac
+import os
+import threading
+import time
+
+from flask import Response, current_app, request
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+import db
+
+# Landing opens and admin pages: most under 100 ms, uploads and CSV exports can take much longer
+_REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+_CRM_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30)
+
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency",
+                            ["method", "endpoint", "status"], buckets=_REQUEST_BUCKETS)
+REQUEST_DB_SECONDS = Histogram("http_request_db_seconds",
+                               "Time spent in SQLite statements per request",
+                               ["endpoint"], buckets=_REQUEST_BUCKETS)
+CRM_SECONDS = Histogram("crm_request_duration_seconds", "Order / communication API call latency",
+                        ["integration", "status"], buckets=_CRM_BUCKETS)
+CRM_ATTEMPTS = Counter("crm_attempts_total", "Recorded order / communication calls",
+                       ["integration", "status"])
+CRM_RETRIES = Counter("crm_retries_total", "Retried order / communication API requests",
+                      ["integration"])
+UPLOAD_ROWS = Counter("upload_rows_total", "Upload rows read", ["result"])
+UPLOAD_LINKS = Counter("upload_links_created_total", "Links created by uploads")
+UPLOAD_CHUNK_SECONDS = Histogram("upload_chunk_seconds",
+                                 "Read, validation and commit time of one upload chunk",
+                                 buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120))
+
+_request = threading.local()
+
+
+def _add_db_time(cursor, sql, seconds, executed):
+    # Only statements of the request being served by this thread; background threads have no total
+    if getattr(_request, "db_seconds", None) is not None:
+        _request.db_seconds += seconds
+
+
+def _before_request():
+    _request.started = time.perf_counter()
+    _request.db_seconds = 0.0
+
+
+def _after_request(response):
+    started = getattr(_request, "started", None)
+    if started is not None:
+        endpoint = request.endpoint or "unmatched"
+        REQUEST_SECONDS.labels(request.method, endpoint, str(response.status_code)).observe(
+            time.perf_counter() - started)
+        REQUEST_DB_SECONDS.labels(endpoint).observe(_request.db_seconds)
+        _request.started = _request.db_seconds = None
+    return response
+
+
+def _authorized() -> bool:
+    token = current_app.config.get("METRICS_TOKEN")
+    if not token:
+        return True
+    scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(),
+                                                              token.encode())
+
+
+def _metrics_view():
+    if not _authorized():
+        return Response("Unauthorized\n", status=401, mimetype="text/plain",
+                        headers={"WWW-Authenticate": 'Bearer realm="metrics"'})
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return Response(generate_latest(registry), mimetype=CONTENT_TYPE_LATEST)
+
+
+def init_app(app):
+    """Time every request and serve GET /metrics."""
+    db.add_statement_observer(_add_db_time)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.add_url_rule("/metrics", "metrics", _metrics_view, methods=["GET"])
+
+
+def count_retry(integration: str):
+    """tenacity before_sleep callback counting a retry of `integration`."""
+    return lambda retry_state: CRM_RETRIES.labels(integration).inc()
+
+
+def integration_attempt(integration: str, status: str, latency_ms=None):
+    CRM_ATTEMPTS.labels(integration, status).inc()
+    if latency_ms is not None:
+        CRM_SECONDS.labels(integration, status).observe(latency_ms / 1000)
+
+
+def upload_chunk(valid: int, rejected: int, links_created: int, seconds: float):
+    UPLOAD_ROWS.labels("valid").inc(valid)
+    UPLOAD_ROWS.labels("rejected").inc(rejected)
+    UPLOAD_LINKS.inc(links_created)
+    UPLOAD_CHUNK_SECONDS.observe(seconds)
@@ -0,0 +1,522 @@
+"""
+Versioned schema migrations.
+
+The applied schema version is stored in PRAGMA user_version. migrate() is a
+single read when the database is up to date, so gunicorn workers booting
+together do no DDL and take no write lock. Pending migrations run inside one
+BEGIN IMMEDIATE transaction, which also serializes concurrent callers: the
+first one applies them, the others re-read the version and find nothing to do.
+
+To change the schema, append a new (version, description, function) entry to
+MIGRATIONS. Never edit a migration that has already shipped.
+"""
+import copy
+import datetime
+import hashlib
+import json
+import logging
+import os
+
+from db import DB_BUSY_TIMEOUT_MS, db, now_iso
+
+# Startup waits this long for another process that is applying migrations
+MIGRATION_LOCK_TIMEOUT_MS = int(os.getenv("MIGRATION_LOCK_TIMEOUT_MS", "600000"))
+
+
+def _columns(c, table):
+    c.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in c.fetchall()}
+
+
+def _add_column(c, table, column, decl):
+    if column not in _columns(c, table):
+        c.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _m0001_baseline(c):
+    """Schema as created by the old init_db(); idempotent so old databases upgrade in place."""
+    # users (customer master)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS users (
+      id INTEGER PRIMARY KEY,
+      name TEXT,
+      phone TEXT,
+      identification_number TEXT,
+      email TEXT,
+      filial_id INTEGER,
+      customer_account_id INTEGER UNIQUE
+    )""")
+
+    # offers (product catalog)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS offers (
+      id INTEGER PRIMARY KEY,
+      title TEXT NOT NULL,
+      bundle TEXT NOT NULL,      -- 'internet' | 'fms' | 'tv' | 'bundle'
+      price NUMERIC,
+      currency TEXT,
+      details_json TEXT,
+      product_offer_id INTEGER,
+      product_offer_struct_id INTEGER,
+      po_struct_element_id INTEGER,
+      product_num TEXT,
+      resource_spec_id INTEGER
+    )""")
+
+    # bulk uploads (a batch of suggested links)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS bulk_uploads (
+      id INTEGER PRIMARY KEY,
+      filename TEXT,
+      uploaded_at TEXT,
+      offer_id INTEGER,
+      expires_at TEXT,
+      count_total INTEGER DEFAULT 0,
+      notes TEXT,
+      FOREIGN KEY(offer_id) REFERENCES offers(id)
+    )""")
+
+    # links (one per user/offer)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS links (
+      id INTEGER PRIMARY KEY,
+      upload_id INTEGER,
+      user_id INTEGER,
+      offer_id INTEGER,
+      external_id TEXT,
+      token TEXT UNIQUE,
+      created_at TEXT,
+      expires_at TEXT,
+      opened_at TEXT,
+      agreed_at TEXT,
+      rejected_at TEXT,
+      status TEXT DEFAULT 'NEW',    -- NEW | OPENED | AGREED | REJECTED | EXPIRED | USED
+      offer_snapshot_json TEXT,
+      product_key TEXT,
+      address_json TEXT,
+      FOREIGN KEY(user_id) REFERENCES users(id),
+      FOREIGN KEY(offer_id) REFERENCES offers(id),
+      FOREIGN KEY(upload_id) REFERENCES bulk_uploads(id)
+    )""")
+
+    # Columns added over time (present in CREATE above only for some of them)
+    _add_column(c, "links", "address_json", "TEXT")
+    _add_column(c, "links", "product_key", "TEXT")
+    _add_column(c, "links", "order_response_json", "TEXT")
+    _add_column(c, "users", "customer_id", "INTEGER")  # CRM customer id (segment upload)
+    _add_column(c, "users", "identification_number", "TEXT")  # IIN/BIN
+    _add_column(c, "links", "communication_response_json", "TEXT")
+
+    # consents (audit trail)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS consents (
+      id INTEGER PRIMARY KEY,
+      link_id INTEGER,
+      consent_text TEXT,
+      choice TEXT,                -- 'AGREED' or 'REJECTED'
+      created_at TEXT,
+      ip TEXT,
+      user_agent TEXT,
+      FOREIGN KEY(link_id) REFERENCES links(id)
+    )""")
+
+    # outbox (pending order/communication API calls, drained by outbox.py)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS outbox (
+      id INTEGER PRIMARY KEY,
+      link_id INTEGER NOT NULL,
+      kind TEXT NOT NULL,            -- 'order' | 'communication'
+      status TEXT DEFAULT 'PENDING', -- PENDING | IN_PROGRESS | DONE | FAILED
+      attempts INTEGER DEFAULT 0,
+      next_attempt_at TEXT,
+      claim_token TEXT,
+      claimed_at TEXT,
+      last_error TEXT,
+      created_at TEXT,
+      updated_at TEXT,
+      UNIQUE(link_id, kind),
+      FOREIGN KEY(link_id) REFERENCES links(id)
+    )""")
+
+    c.execute("CREATE INDEX IF NOT EXISTS idx_users_customer_account_id "
+              "ON users(customer_account_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_upload_id ON links(upload_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_user_id ON links(user_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_status ON links(status)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_consents_link_id ON consents(link_id)")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_outbox_due ON outbox(status, next_attempt_at)")
+
+
+def _m0002_offer_snapshots(c):
+    """Move per-link offer_snapshot_json copies into content-addressed offer_snapshots."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS offer_snapshots (
+      id INTEGER PRIMARY KEY,
+      content_hash TEXT NOT NULL UNIQUE,   -- sha256 of canonical snapshot JSON
+      offer_id INTEGER,
+      snapshot_json TEXT NOT NULL,
+      created_at TEXT,
+      FOREIGN KEY(offer_id) REFERENCES offers(id)
+    )""")
+    # Current snapshot for links bound to a product (links.product_key)
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS offer_snapshot_heads (
+      offer_id INTEGER NOT NULL,
+      product_key TEXT NOT NULL,
+      snapshot_id INTEGER NOT NULL,
+      updated_at TEXT,
+      PRIMARY KEY(offer_id, product_key),
+      FOREIGN KEY(snapshot_id) REFERENCES offer_snapshots(id)
+    )""")
+    _add_column(c, "links", "snapshot_id", "INTEGER")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_offer_product ON links(offer_id, product_key)")
+
+    # Backfill: one snapshot row per distinct blob, then drop the per-link copies
+    c.execute("""SELECT DISTINCT offer_snapshot_json FROM links
+                 WHERE offer_snapshot_json IS NOT NULL AND snapshot_id IS NULL""")
+    blobs = [r[0] for r in c.fetchall()]
+    for blob in blobs:
+        try:
+            snap = json.loads(blob)
+        except (TypeError, ValueError):
+            continue
+        body = json.dumps(snap, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        h = hashlib.sha256(body.encode("utf-8")).hexdigest()
+        c.execute("""INSERT OR IGNORE INTO offer_snapshots
+                       (content_hash, offer_id, snapshot_json, created_at)
+                     VALUES (?, ?, ?, datetime('now'))""",
+                  (h, snap.get("id") if isinstance(snap, dict) else None, body))
+        c.execute("SELECT id FROM offer_snapshots WHERE content_hash=?", (h,))
+        snapshot_id = c.fetchone()[0]
+        c.execute("""UPDATE links SET snapshot_id=?, offer_snapshot_json=NULL
+                     WHERE offer_snapshot_json=? AND snapshot_id IS NULL""",
+                  (snapshot_id, blob))
+
+    # Heads: the newest link of each (offer_id, product_key) carries the current snapshot
+    c.execute("""INSERT OR IGNORE INTO offer_snapshot_heads
+                   (offer_id, product_key, snapshot_id, updated_at)
+                 SELECT offer_id, product_key, snapshot_id, datetime('now') FROM links
+                 WHERE id IN (SELECT MAX(id) FROM links
+                              WHERE product_key IS NOT NULL AND snapshot_id IS NOT NULL
+                              GROUP BY offer_id, product_key)""")
+
+
+# Migrations keep their own copies of the application helpers they used when they shipped,
+# so later changes to snapshots.py / integration_results.py cannot change what an old
+# migration writes.
+
+def _m0003_localize(offer: dict, lang: str) -> dict:
+    """snapshots.localize_offer() as of migration 3."""
+    offer = copy.deepcopy(offer)
+    if not (offer.get("details") and offer["details"].get("translations")):
+        return offer
+    translations_data = offer["details"]["translations"]
+    if lang == "kk":
+        ru_translations = translations_data.get("ru", {})
+        kk_translations = translations_data.get("kk", {})
+        if "title" in kk_translations:
+            offer["title"] = kk_translations["title"]
+        elif "title" in ru_translations:
+            offer["title"] = ru_translations["title"]
+        if "badges" in kk_translations:
+            offer["details"]["badges"] = kk_translations["badges"]
+        elif "badges" in ru_translations:
+            offer["details"]["badges"] = ru_translations["badges"]
+        if offer["details"].get("components"):
+            kk_comp_map = {c.get("type"): c for c in kk_translations.get("components", [])
+                           if c.get("type")}
+            ru_comp_map = {c.get("type"): c for c in ru_translations.get("components", [])
+                           if c.get("type")}
+            for comp in offer["details"]["components"]:
+                comp_type = comp.get("type")
+                if comp_type:
+                    if comp_type in kk_comp_map and "title" in kk_comp_map[comp_type]:
+                        comp["title"] = kk_comp_map[comp_type]["title"]
+                    elif comp_type in ru_comp_map and "title" in ru_comp_map[comp_type]:
+                        comp["title"] = ru_comp_map[comp_type]["title"]
+    elif lang == "ru" and "ru" in translations_data:
+        ru_translations = translations_data["ru"]
+        if "title" in ru_translations:
+            offer["title"] = ru_translations["title"]
+        if "badges" in ru_translations:
+            offer["details"]["badges"] = ru_translations["badges"]
+        if "components" in ru_translations and offer["details"].get("components"):
+            ru_comp_map = {c.get("type"): c for c in ru_translations["components"] if c.get("type")}
+            for comp in offer["details"]["components"]:
+                comp_type = comp.get("type")
+                if comp_type and comp_type in ru_comp_map and "title" in ru_comp_map[comp_type]:
+                    comp["title"] = ru_comp_map[comp_type]["title"]
+    return offer
+
+
+def _m0003_offer_snapshot_views(c):
+    """Per-language landing views of each snapshot (see snapshots.store_views)."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS offer_snapshot_views (
+      snapshot_id INTEGER NOT NULL,
+      lang TEXT NOT NULL,             -- 'ru' | 'kk'
+      view_json TEXT NOT NULL,
+      PRIMARY KEY(snapshot_id, lang),
+      FOREIGN KEY(snapshot_id) REFERENCES offer_snapshots(id)
+    )""")
+    c.execute("SELECT id, snapshot_json FROM offer_snapshots")
+    for snapshot_id, body in c.fetchall():
+        snap = json.loads(body)
+        for lang in ("ru", "kk"):
+            c.execute("""INSERT OR REPLACE INTO offer_snapshot_views (snapshot_id, lang, view_json)
+                         VALUES (?, ?, ?)""",
+                      (snapshot_id, lang,
+                       json.dumps(_m0003_localize(snap, lang), ensure_ascii=False)))
+
+
+def _m0004_upload_jobs(c):
+    """Uploads become background jobs: status, progress and claim state on bulk_uploads."""
+    # status: QUEUED | RUNNING | DONE | FAILED; file_path: saved upload, removed when finished
+    _add_column(c, "bulk_uploads", "status", "TEXT DEFAULT 'DONE'")
+    _add_column(c, "bulk_uploads", "file_path", "TEXT")
+    _add_column(c, "bulk_uploads", "external_prefix", "TEXT")
+    _add_column(c, "bulk_uploads", "snapshot_id", "INTEGER")
+    _add_column(c, "bulk_uploads", "product_key", "TEXT")
+    _add_column(c, "bulk_uploads", "rows_parsed", "INTEGER DEFAULT 0")
+    _add_column(c, "bulk_uploads", "rows_valid", "INTEGER DEFAULT 0")
+    _add_column(c, "bulk_uploads", "rows_rejected", "INTEGER DEFAULT 0")
+    _add_column(c, "bulk_uploads", "links_created", "INTEGER DEFAULT 0")
+    _add_column(c, "bulk_uploads", "messages_json", "TEXT")  # first row errors, shown on the page
+    _add_column(c, "bulk_uploads", "error", "TEXT")
+    _add_column(c, "bulk_uploads", "started_at", "TEXT")
+    _add_column(c, "bulk_uploads", "finished_at", "TEXT")
+    _add_column(c, "bulk_uploads", "claim_token", "TEXT")
+    _add_column(c, "bulk_uploads", "heartbeat_at", "TEXT")
+    c.execute("CREATE INDEX IF NOT EXISTS idx_bulk_uploads_status ON bulk_uploads(status)")
+    c.execute("""UPDATE bulk_uploads
+                    SET rows_parsed=count_total,
+                        links_created=(SELECT COUNT(*) FROM links
+                                        WHERE links.upload_id=bulk_uploads.id),
+                        finished_at=uploaded_at""")
+    c.execute("UPDATE bulk_uploads SET rows_valid=links_created")
+
+
+def _m0005_links_missing_token(c):
+    """Partial index over links still waiting for a token, so "assign tokens" only reads the gap."""
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_missing_token ON links(upload_id, id) "
+              "WHERE token IS NULL")
+
+
+def _m0006_result_columns(kind: str, result: dict) -> tuple:
+    """integration_results.result_columns() as of migration 6: (external id, success)."""
+    response = result.get("response_json")
+    if kind == "order":
+        external_id = response.get("ORDER_ID") if isinstance(response, dict) else None
+    else:
+        external_id = None
+        if isinstance(response, dict):
+            data = response.get("DATA") or response.get("data")
+            if isinstance(data, dict):
+                external_id = data.get("COMMUNICATION_ID", data.get("communicationId"))
+        if external_id is None:
+            external_id = result.get("communication_id")
+    if external_id is None or external_id == "" or isinstance(external_id, (dict, list)):
+        external_id = None
+    else:
+        external_id = str(external_id)
+    return external_id, 1 if result.get("success") else 0
+
+
+def _m0006_backfill_columns(kind: str, raw):
+    """integration_results.backfill_columns() as of migration 6: (external id, success, time)."""
+    if not raw or not str(raw).strip():
+        return None
+    try:
+        result = json.loads(raw)
+    except (TypeError, ValueError):
+        return None, 0, None
+    if not isinstance(result, dict):
+        return None, 0, None
+    attempted_at = None
+    try:
+        attempted_at = datetime.datetime.fromisoformat(result["timestamp"]).astimezone(
+            datetime.timezone.utc).isoformat()
+    except (KeyError, TypeError, ValueError):
+        pass
+    return (*_m0006_result_columns(kind, result), attempted_at)
+
+
+def _m0006_integration_result_columns(c):
+    """order_id / communication_id / success / attempt time as indexed columns.
+
+    See integration_results.py.
+    """
+    for prefix in ("order", "communication"):
+        _add_column(c, "links", f"{prefix}_id", "TEXT")
+        _add_column(c, "links", f"{prefix}_success", "INTEGER")  # 1/0; NULL = never called
+        _add_column(c, "links", f"{prefix}_attempted_at", "TEXT")
+    last_id = 0
+    while True:  # in batches: the JSON columns can be several KB per link
+        c.execute("""SELECT id, order_response_json, communication_response_json FROM links
+                      WHERE id > ?
+                        AND (order_response_json IS NOT NULL
+                             OR communication_response_json IS NOT NULL)
+                      ORDER BY id LIMIT 5000""", (last_id,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        orders, communications = [], []
+        for link_id, order_json, comm_json in rows:
+            for kind, raw, out in (("order", order_json, orders),
+                                   ("communication", comm_json, communications)):
+                values = _m0006_backfill_columns(kind, raw)
+                if values is not None:
+                    out.append((*values, link_id))
+        c.executemany("""UPDATE links SET order_id=?, order_success=?, order_attempted_at=?
+                          WHERE id=?""", orders)
+        c.executemany("""UPDATE links
+                            SET communication_id=?, communication_success=?,
+                                communication_attempted_at=?
+                          WHERE id=?""", communications)
+    # Partial: links without a result (every freshly uploaded link) are not in these indexes
+    for prefix in ("order", "communication"):
+        c.execute(f"""CREATE INDEX IF NOT EXISTS idx_links_{prefix}_id ON links({prefix}_id)
+                      WHERE {prefix}_id IS NOT NULL""")
+        c.execute(f"""CREATE INDEX IF NOT EXISTS idx_links_upload_{prefix}_success
+                      ON links(upload_id, {prefix}_success) WHERE {prefix}_success IS NOT NULL""")
+        c.execute(f"""CREATE INDEX IF NOT EXISTS idx_links_{prefix}_failed
+                      ON links({prefix}_attempted_at)
+                      WHERE {prefix}_success = 0""")
+
+
+def _m0007_insert_attempt(c, kind: str, link_id: int, result: dict, attempted_at: str) -> int:
+    """integration_results.attempt_values() + insert_attempt() as of migration 7."""
+    external_id, success = _m0006_result_columns(kind, result)
+    status = "SKIPPED" if result.get("skipped") else ("SUCCESS" if success else "FAILED")
+    response = result.get("response_json")
+    text = None if response else result.get("response_text")
+    compact = lambda value: json.dumps(value, ensure_ascii=False, separators=(",", ":"))  # noqa: E731
+    c.execute("""INSERT INTO integration_attempts
+                   (link_id, kind, attempt_no, status, http_status, latency_ms, external_id,
+                    attempted_at, request_json, response_json, response_text, error, error_type)
+                 VALUES (?, ?, COALESCE((SELECT MAX(attempt_no) FROM integration_attempts
+                                          WHERE link_id=? AND kind=?), 0) + 1,
+                         ?, ?, NULL, ?, ?, ?, ?, ?, ?, ?)
+                 RETURNING id""",
+              (link_id, kind, link_id, kind, status, result.get("status_code"), external_id,
+               attempted_at,
+               compact(result["request"]) if result.get("request") else None,
+               compact(response) if response else None,
+               text[:4000] if text else None,
+               result.get("reason") if status == "SKIPPED" else result.get("error"),
+               result.get("error_type")))
+    return c.fetchone()[0]
+
+
+def _m0007_integration_attempts(c):
+    """Append-only history of order/communication calls; links point at their latest attempt."""
+    c.execute("""
+    CREATE TABLE IF NOT EXISTS integration_attempts (
+      id INTEGER PRIMARY KEY,
+      link_id INTEGER NOT NULL,
+      kind TEXT NOT NULL,             -- 'order' | 'communication'
+      attempt_no INTEGER NOT NULL,    -- 1, 2, ... per (link_id, kind)
+      status TEXT NOT NULL,           -- 'SUCCESS' | 'FAILED' | 'SKIPPED'
+      http_status INTEGER,
+      latency_ms INTEGER,
+      external_id TEXT,               -- ORDER_ID / COMMUNICATION_ID
+      attempted_at TEXT NOT NULL,
+      request_json TEXT,
+      response_json TEXT,             -- compact; response_text only when the body is not JSON
+      response_text TEXT,
+      error TEXT,                     -- error message, or the reason a call was skipped
+      error_type TEXT,
+      UNIQUE(link_id, kind, attempt_no),
+      FOREIGN KEY(link_id) REFERENCES links(id)
+    )""")
+    _add_column(c, "links", "order_attempt_id", "INTEGER")
+    _add_column(c, "links", "communication_attempt_id", "INTEGER")
+
+    # Each stored result becomes attempt 1 of its link; the JSON on links is cleared
+    # (run VACUUM afterwards to reclaim the space)
+    last_id = 0
+    while True:
+        c.execute("""SELECT id, created_at, order_response_json, order_attempted_at,
+                            communication_response_json, communication_attempted_at
+                       FROM links
+                      WHERE id > ?
+                        AND (order_response_json IS NOT NULL
+                             OR communication_response_json IS NOT NULL)
+                      ORDER BY id LIMIT 2000""", (last_id,))
+        rows = c.fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        for link_id, created_at, order_json, order_at, comm_json, comm_at in rows:
+            for kind, raw, attempted_at in (("order", order_json, order_at),
+                                            ("communication", comm_json, comm_at)):
+                if raw is None:
+                    continue
+                if raw.strip():
+                    try:
+                        result = json.loads(raw)
+                    except ValueError:
+                        result = None
+                    if not isinstance(result, dict):
+                        result = {"success": False, "error": "Stored result is not valid JSON",
+                                  "response_text": raw}
+                    attempt_id = _m0007_insert_attempt(c, kind, link_id, result,
+                                                       attempted_at or created_at or now_iso())
+                else:
+                    attempt_id = None
+                c.execute(f"""UPDATE links SET {kind}_attempt_id=?, {kind}_response_json=NULL
+                               WHERE id=?""", (attempt_id, link_id))
+
+
+def _m0008_links_upload_external_id(c):
+    """Index of links by (upload_id, external_id): ingest skips rows that already have a link."""
+    c.execute("CREATE INDEX IF NOT EXISTS idx_links_upload_external_id "
+              "ON links(upload_id, external_id)")
+
+
+MIGRATIONS = [
+    (1, "baseline schema", _m0001_baseline),
+    (2, "content-addressed offer snapshots", _m0002_offer_snapshots),
+    (3, "materialized per-language offer views", _m0003_offer_snapshot_views),
+    (4, "background upload jobs", _m0004_upload_jobs),
+    (5, "index of links missing a token", _m0005_links_missing_token),
+    (6, "indexed integration result columns", _m0006_integration_result_columns),
+    (7, "integration attempt history", _m0007_integration_attempts),
+    (8, "index of links by upload row", _m0008_links_upload_external_id),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+def schema_version(conn) -> int:
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate() -> int:
+    """Bring the database to LATEST_VERSION; returns the resulting version."""
+    with db() as conn:
+        current = schema_version(conn)
+        if current >= LATEST_VERSION:
+            return current
+
+        conn.execute(f"PRAGMA busy_timeout={int(MIGRATION_LOCK_TIMEOUT_MS)}")
+        try:
+            # Take the write lock first, then re-check: another worker may have migrated meanwhile
+            conn.execute("BEGIN IMMEDIATE")
+            current = schema_version(conn)
+            c = conn.cursor()
+            for version, description, fn in MIGRATIONS:
+                if version <= current:
+                    continue
+                logging.info(f"Applying schema migration {version}: {description}")
+                fn(c)
+                c.execute(f"PRAGMA user_version={int(version)}")
+                current = version
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.execute(f"PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT_MS)}")
+        return current
@@ -0,0 +1,161 @@
+"""
+Durable outbox for CRM integrations (order / communication API).
+
+Agree handlers call enqueue() inside the same transaction that stores the
+consent, so a recorded agreement always has its integration jobs. The
+OutboxDispatcher (one per gunicorn worker) drains due rows in the background
+with a bounded thread pool; rows are claimed atomically, so several workers
+can poll the same table without double-dispatching.
+"""
+import datetime
+import logging
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+from db import db, now_iso
+
+OUTBOX_KINDS = ("order", "communication")
+
+
+def enqueue(cur, link_id: int, kinds):
+    """Insert one PENDING job per integration kind (caller commits)."""
+    now = now_iso()
+    for kind in kinds:
+        cur.execute("""INSERT OR IGNORE INTO outbox
+                         (link_id, kind, status, attempts, next_attempt_at, created_at, updated_at)
+                       VALUES (?, ?, 'PENDING', 0, ?, ?, ?)""",
+                    (link_id, kind, now, now, now))
+
+
+def _iso_in(seconds: float) -> str:
+    at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+    return at.isoformat()
+
+
+class OutboxDispatcher:
+    """Background poller + thread pool that runs outbox jobs inside an app context.
+
+    `handlers` maps outbox kind -> callable(link_id=...). A handler that raises
+    is retried with exponential backoff until OUTBOX_MAX_ATTEMPTS is reached,
+    then the row is left in FAILED for manual resend from the admin panel.
+    """
+
+    def __init__(self, app, handlers: dict):
+        self.app = app
+        self.handlers = handlers
+        self.workers = max(1, int(app.config.get("OUTBOX_WORKERS") or 4))
+        self.poll_interval = float(app.config.get("OUTBOX_POLL_INTERVAL") or 2)
+        self.max_attempts = max(1, int(app.config.get("OUTBOX_MAX_ATTEMPTS") or 5))
+        self.retry_base = float(app.config.get("OUTBOX_RETRY_BASE_SECONDS") or 5)
+        self.retry_max = float(app.config.get("OUTBOX_RETRY_MAX_SECONDS") or 600)
+        # A claimed job whose worker died is re-claimed after this many seconds.
+        # Must exceed the longest handler run (timeouts x tenacity retries).
+        self.lease_seconds = float(app.config.get("OUTBOX_LEASE_SECONDS") or 300)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._inflight = 0
+
+    # ----- lifecycle -----
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="outbox")
+        self._thread = threading.Thread(target=self._loop, name="outbox-poller", daemon=True)
+        self._thread.start()
+        logging.info(f"Outbox dispatcher started ({self.workers} workers, "
+                     f"poll {self.poll_interval}s)")
+
+    def stop(self, wait: bool = True):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+
+    def wake(self):
+        """Ask the poller to look for due jobs now (e.g. right after an agree commit)."""
+        self._wake.set()
+
+    # ----- polling -----
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                with self._lock:
+                    free = self.workers - self._inflight
+                if free > 0:
+                    for job in self._claim(free):
+                        with self._lock:
+                            self._inflight += 1
+                        self._executor.submit(self._run, job)
+            except Exception:
+                logging.exception("Outbox poll failed")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _claim(self, limit: int):
+        now = now_iso()
+        stale_before = _iso_in(-self.lease_seconds)
+        token = uuid.uuid4().hex
+        with db() as conn:
+            c = conn.cursor()
+            c.execute("""UPDATE outbox
+                            SET status='IN_PROGRESS', claim_token=?, claimed_at=?,
+                                attempts=attempts+1, updated_at=?
+                          WHERE id IN (
+                                SELECT id FROM outbox
+                                 WHERE (status='PENDING' AND next_attempt_at<=?)
+                                    OR (status='IN_PROGRESS' AND claimed_at<=?)
+                                 ORDER BY next_attempt_at, id
+                                 LIMIT ?)
+                      RETURNING id, link_id, kind, attempts, claim_token""",
+                      (token, now, now, now, stale_before, limit))
+            jobs = [dict(r) for r in c.fetchall()]
+            conn.commit()
+        return jobs
+
+    # ----- execution -----
+    def _run(self, job: dict):
+        try:
+            handler = self.handlers.get(job["kind"])
+            if handler is None:
+                raise ValueError(f"No outbox handler for kind '{job['kind']}'")
+            with self.app.app_context():
+                handler(link_id=job["link_id"])
+        except Exception as e:
+            logging.warning(f"Outbox job {job['id']} ({job['kind']}, link {job['link_id']}) "
+                            f"attempt {job['attempts']} failed: {e}")
+            self._finish(job, error=e)
+        else:
+            self._finish(job)
+        finally:
+            with self._lock:
+                self._inflight -= 1
+            self._wake.set()
+
+    def _finish(self, job: dict, error: Optional[Exception] = None):
+        now = now_iso()
+        with db() as conn:
+            c = conn.cursor()
+            if error is None:
+                c.execute("""UPDATE outbox SET status='DONE', last_error=NULL, updated_at=?
+                              WHERE id=? AND claim_token=? AND status='IN_PROGRESS'""",
+                          (now, job["id"], job["claim_token"]))
+            elif job["attempts"] >= self.max_attempts:
+                c.execute("""UPDATE outbox SET status='FAILED', last_error=?, updated_at=?
+                              WHERE id=? AND claim_token=? AND status='IN_PROGRESS'""",
+                          (f"{type(error).__name__}: {error}", now, job["id"], job["claim_token"]))
+            else:
+                delay = min(self.retry_max, self.retry_base * (2 ** (job["attempts"] - 1)))
+                c.execute("""UPDATE outbox
+                                SET status='PENDING', last_error=?, next_attempt_at=?, updated_at=?
+                              WHERE id=? AND claim_token=? AND status='IN_PROGRESS'""",
+                          (f"{type(error).__name__}: {error}", _iso_in(delay), now,
+                           job["id"], job["claim_token"]))
+            conn.commit()
@@ -0,0 +1,72 @@
+"""
+Optional process pool for the CPU-bound parts of uploads.
+
+With UPLOAD_PROCESSES > 1, an upload job validates its chunks
+(upload_validation.validate_frame) in worker processes while the job thread
+keeps reading the file and writing finished chunks in file order. Token
+signing (itsdangerous, ~25 µs per link) is split into batches signed in
+parallel and merged back in the order of the link ids.
+
+Pools use the forkserver start method where available (spawn elsewhere):
+gunicorn workers run several threads, and forking such a process directly is
+unsafe. Children import only the modules of the functions they run, never the
+Flask app. A pool is created per job and shut down when it finishes, so idle
+workers hold no extra processes.
+"""
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+from itsdangerous import URLSafeTimedSerializer
+
+# Links signed per pool task; smaller sets are signed in the calling thread
+TOKEN_SIGN_BATCH = 20000
+
+
+def process_pool(processes: int) -> ProcessPoolExecutor:
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    return ProcessPoolExecutor(max_workers=processes, mp_context=context)
+
+
+class LazyPool:
+    """Process pool started on first get(); get() is None when processes <= 1."""
+
+    def __init__(self, processes: int):
+        self.processes = int(processes or 0)
+        self._pool = None
+
+    def get(self):
+        if self.processes <= 1:
+            return None
+        if self._pool is None:
+            self._pool = process_pool(self.processes)
+        return self._pool
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+
+
+def _sign_batch(secret_key: str, link_ids) -> list:
+    # Same serializer as app.signer (default salt), so landing/decision pages accept the tokens
+    signer = URLSafeTimedSerializer(secret_key)
+    return [signer.dumps({"lid": link_id}) for link_id in link_ids]
+
+
+def sign_link_tokens(secret_key: str, link_ids, pool: Optional[LazyPool] = None) -> list:
+    """Tokens for link_ids, in the same order; several batches are signed in the pool."""
+    link_ids = [int(i) for i in link_ids]
+    executor = pool.get() if pool is not None and len(link_ids) >= 2 * TOKEN_SIGN_BATCH else None
+    if executor is None:
+        return _sign_batch(secret_key, link_ids)
+    batches = [link_ids[i:i + TOKEN_SIGN_BATCH] for i in range(0, len(link_ids), TOKEN_SIGN_BATCH)]
+    signed = executor.map(_sign_batch, [secret_key] * len(batches), batches)
+    return [token for batch in signed for token in batch]
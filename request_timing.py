@@ -0,0 +1,121 @@
+"""
+Phase timings of the current request, for the Server-Timing header and the
+access log line (app.py request hooks).
+
+The collector lives in a contextvar set by the before_request hook; code
+outside a request (outbox dispatcher, upload jobs) has none and records
+nothing. Threads that work for the request (concurrent agree) get it by
+running in a copy of the request's context.
+
+  token              token signature check
+  db_read, db_write  SQLite statements through db() (execute + fetches), by statement kind
+  render             render_template
+  order_api          order API call, retries included
+  communication_api  communication API call, retries included
+"""
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+from typing import Optional
+
+from flask import before_render_template, template_rendered
+
+import db
+
+TOKEN = "token"
+DB_READ = "db_read"
+DB_WRITE = "db_write"
+RENDER = "render"
+ORDER_API = "order_api"
+COMMUNICATION_API = "communication_api"
+PHASES = (TOKEN, DB_READ, DB_WRITE, RENDER, ORDER_API, COMMUNICATION_API)
+
+_READ_STATEMENTS = ("SELECT", "PRAGMA", "EXPLAIN", "WITH")
+
+
+class Timings:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.total_seconds = None  # set by finish()
+        self.seconds = {}
+        self.renders = []  # start times of templates being rendered
+        self._lock = threading.Lock()  # concurrent agree adds from two threads
+
+    def add(self, phase: str, seconds: float):
+        with self._lock:
+            self.seconds[phase] = self.seconds.get(phase, 0.0) + seconds
+
+
+_current: contextvars.ContextVar[Optional[Timings]] = contextvars.ContextVar("request_timings",
+                                                                          default=None)
+
+
+def start() -> Timings:
+    timings = Timings()
+    _current.set(timings)
+    return timings
+
+
+def finish():
+    """The request's Timings (None outside a timed request); stops collecting."""
+    timings = _current.get()
+    _current.set(None)
+    if timings is not None:
+        timings.total_seconds = time.perf_counter() - timings.started
+    return timings
+
+
+def add(phase: str, seconds: float):
+    timings = _current.get()
+    if timings is not None:
+        timings.add(phase, seconds)
+
+
+@contextmanager
+def phase(name: str):
+    """Time the block into `name` of the current request, if any."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(name, time.perf_counter() - started)
+
+
+def server_timing(timings: Timings) -> str:
+    """Server-Timing header value: recorded phases plus total, in milliseconds."""
+    parts = [f"{name};dur={timings.seconds[name] * 1000:.1f}"
+             for name in PHASES if name in timings.seconds]
+    parts.append(f"total;dur={timings.total_seconds * 1000:.1f}")
+    return ", ".join(parts)
+
+
+def phase_ms(timings: Timings) -> dict:
+    return {name: round(timings.seconds[name] * 1000, 1)
+            for name in PHASES if name in timings.seconds}
+
+
+def _db_statement(cursor, sql, seconds, executed):
+    timings = _current.get()
+    if timings is not None:
+        kind = sql.lstrip()[:7].upper()
+        timings.add(DB_READ if kind.startswith(_READ_STATEMENTS) else DB_WRITE, seconds)
+
+
+def _before_render(sender, template, context, **extra):
+    timings = _current.get()
+    if timings is not None:
+        timings.renders.append(time.perf_counter())
+
+
+def _rendered(sender, template, context, **extra):
+    timings = _current.get()
+    if timings is not None and timings.renders:
+        timings.add(RENDER, time.perf_counter() - timings.renders.pop())
+
+
+def init_app(app):
+    """Collect db and render_template time; the request hooks call start() / finish()."""
+    db.add_statement_observer(_db_statement)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
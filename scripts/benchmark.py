@@ -0,0 +1,463 @@
+# scripts/benchmark.py
+# Benchmarks of the hot paths on a synthetic database in a temporary directory
+# (the app is imported in-process and driven through Flask's test client):
+#
+#   landing  GET /l/<token> for each offer shape x language (throughput, latency)
+#   agree    POST /agree against the local CRM stub (crm_stub.py; ORDER_API_URL / COMM_API_URL
+#            point at it)
+#   upload   upload_new of generated CSV / XLSX files, until the background job is done
+#   detail   upload_detail pages and the CSV export of the largest upload
+#
+#   python scripts/benchmark.py                                  # everything, JSON to stdout
+#   python scripts/benchmark.py --only landing,agree --output bench-1.1.0.json
+#   python scripts/benchmark.py --sizes 10000 --formats csv --only upload,detail
+#   python scripts/benchmark.py --compare bench-1.1.0.json bench-1.2.0.json
+#
+# The JSON is tagged with VERSION, the git commit and the settings that shape the
+# numbers; --compare prints the change of each result between two such files.
+# Other settings (UPLOAD_PROCESSES, UPLOAD_CHUNK_ROWS, DB_* ...) are taken from
+# the environment as the app would.
+import argparse
+import contextlib
+import csv
+import datetime
+import json
+import logging
+import os
+import pathlib
+import platform
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+from crm_stub import Behaviour, StubCRM  # noqa: E402
+
+LANGS = ("ru", "kk")
+UPLOAD_COLUMNS = ["customer_account_id", "filial_id", "customer_id", "phone", "name", "iin",
+                  "town_name", "street_name", "house", "flat", "zip_code"]
+# Offer form fields per shape; every offer is product-bound and has an order item
+_OFFER_BASE = {
+    "title_kk": "Ұсыныс", "price": "9990", "product_offer_id": "1", "product_offer_struct_id": "2",
+    "po_struct_element_id": "3",
+    "cust_order_items[0][external_id]": "{link_external_id}-1",
+    "cust_order_items[0][product_offer_struct_id]": "2",
+    "cust_order_items[0][po_struct_elements][0][po_struct_element_id]": "9",
+}
+OFFER_SHAPES = {
+    "internet": {"bundle": "internet", "has_internet": "1", "internet_max_speed_mbps": "100"},
+    "internet_tv": {"bundle": "bundle", "has_internet": "1", "internet_max_speed_mbps": "500",
+                    "has_tv": "1", "tv_channels": "200", "tv_ott": "Kinopoisk, Megogo"},
+    "full": {"bundle": "bundle", "has_internet": "1", "internet_max_speed_mbps": "1000",
+             "has_tv": "1", "tv_channels": "250", "tv_ott": "Kinopoisk, Megogo, Start",
+             "has_mobile": "1", "mobile_sims": "4", "mobile_data_gb": "50",
+             "mobile_onnet_minutes": "1000", "mobile_offnet_minutes": "300", "mobile_sms": "100",
+             "mobile_tv_plus_included": "1",
+             "has_home_phone": "1", "phone_onnet_minutes": "500",
+             "has_sim_devices": "1", "iot_sims": "2", "iot_data_gb": "10",
+             "badge_text": "Хит, Выгодно", "badge_text_kk": "Хит, Тиімді"},
+}
+# Settings recorded with the results
+CONFIG_KEYS = ("AGREE_DISPATCH_MODE", "LANDING_RENDER_CACHE", "TRACKING_WRITE_BEHIND",
+               "UPLOAD_CHUNK_ROWS", "UPLOAD_PROCESSES", "UPLOAD_PAGE_SIZE", "HTTP_POOL_MAXSIZE")
+
+
+# ---------- Measurements ----------
+def _percentile(ordered, q):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 3) if seconds is not None else None
+
+
+def summarize(latencies, wall_seconds, server_timings=()):
+    ordered = sorted(latencies)
+    out = {
+        "requests": len(ordered),
+        "throughput_rps": round(len(ordered) / wall_seconds, 1) if wall_seconds else None,
+        "mean_ms": _ms(sum(ordered) / len(ordered)) if ordered else None,
+        "p50_ms": _ms(_percentile(ordered, 50)),
+        "p90_ms": _ms(_percentile(ordered, 90)),
+        "p99_ms": _ms(_percentile(ordered, 99)),
+        "max_ms": _ms(ordered[-1]) if ordered else None,
+    }
+    # Mean of each Server-Timing phase over the responses
+    phases = {}
+    for header in server_timings:
+        for part in (header or "").split(","):
+            name, _, dur = part.strip().partition(";dur=")
+            if dur:
+                phases.setdefault(name, []).append(float(dur))
+    if phases:
+        out["server_timing_mean_ms"] = {name: round(sum(v) / len(ordered), 3)
+                                        for name, v in phases.items()}
+    return out
+
+
+def run_requests(app, send, count, concurrency):
+    """send(client, i) -> response, for i in range(count) over `concurrency` threads."""
+    lock = threading.Lock()
+    next_index = iter(range(count))
+    latencies, timings, errors = [], [], {}
+
+    def worker():
+        client = app.test_client()
+        login(client)
+        while True:
+            with lock:
+                i = next(next_index, None)
+            if i is None:
+                return
+            started = time.perf_counter()
+            response = send(client, i)
+            response.get_data()
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                timings.append(response.headers.get("Server-Timing"))
+                if response.status_code >= 400:
+                    errors[response.status_code] = errors.get(response.status_code, 0) + 1
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, concurrency))]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    out = summarize(latencies, time.perf_counter() - started, timings)
+    out["concurrency"] = concurrency
+    out["errors"] = {str(code): n for code, n in errors.items()}
+    return out
+
+
+# ---------- Synthetic data ----------
+def login(client):
+    client.post("/admin/login", data={"password": os.environ.get("ADMIN_PASSWORD", "admin")})
+
+
+def write_upload_file(path, rows, first_account, fmt):
+    def row(i):
+        n = first_account + i
+        return [n, 17, n, f"770{n % 10**8:08d}", f"Клиент {n}", f"{n % 10**12:012d}", "Алматы",
+                "Абая", str(1 + n % 200), str(1 + n % 90), "050000"]
+
+    if fmt == "csv":
+        with open(path, "w", encoding="utf-8", newline="") as fh:
+            w = csv.writer(fh)
+            w.writerow(UPLOAD_COLUMNS)
+            for i in range(rows):
+                w.writerow(row(i))
+    else:
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet()
+        ws.append(UPLOAD_COLUMNS)
+        for i in range(rows):
+            ws.append(row(i))
+        wb.save(path)
+
+
+def create_offer(client, shape):
+    client.post("/admin/offers/save",
+                data={"title": f"Bench {shape}", **_OFFER_BASE, **OFFER_SHAPES[shape]})
+    from db import db
+    with db() as conn:
+        return conn.execute("SELECT MAX(id) FROM offers").fetchone()[0]
+
+
+def upload(client, path, offer_id, timeout=3600):
+    """Upload a file; (upload id, request seconds, seconds until the job ends, final progress)."""
+    started = time.perf_counter()
+    with open(path, "rb") as fh:
+        r = client.post("/admin/uploads/new",
+                        data={"offer_id": str(offer_id), "file": (fh, os.path.basename(path))},
+                        content_type="multipart/form-data")
+    request_seconds = time.perf_counter() - started
+    if r.status_code != 302 or "/uploads/" not in r.headers.get("Location", ""):
+        raise RuntimeError(f"upload of {path} failed: {r.status_code}")
+    upload_id = int(r.headers["Location"].rstrip("/").split("/")[-1])
+    while True:
+        progress = client.get(f"/admin/uploads/{upload_id}/progress").get_json()
+        if progress["status"] in ("DONE", "FAILED"):
+            return upload_id, request_seconds, time.perf_counter() - started, progress
+        if time.perf_counter() - started > timeout:
+            raise RuntimeError(f"upload {upload_id} not finished after {timeout}s")
+        time.sleep(0.05)
+
+
+def link_tokens(upload_id):
+    from db import db
+    with db() as conn:
+        rows = conn.execute("SELECT token FROM links WHERE upload_id=? ORDER BY id", (upload_id,))
+        return [r[0] for r in rows]
+
+
+def wait_for_outbox(upload_id, timeout):
+    """Wait until the outbox jobs of the upload's links are DONE or FAILED, at most `timeout` s."""
+    from db import db
+    started = time.perf_counter()
+    while True:
+        with db() as conn:
+            statuses = dict(conn.execute("""SELECT o.status, COUNT(*)
+                                              FROM outbox o JOIN links l ON l.id = o.link_id
+                                             WHERE l.upload_id=? GROUP BY o.status""",
+                                         (upload_id,)).fetchall())
+        drained = not set(statuses) - {"DONE", "FAILED"}
+        seconds = time.perf_counter() - started
+        if drained or seconds > timeout:
+            return {"outbox_drain_seconds": round(seconds, 3) if drained else None,
+                    "outbox_jobs": statuses}
+        time.sleep(0.05)
+
+
+# ---------- Scenarios ----------
+def bench_landing(app, client, tmp, args, accounts):
+    results = []
+    for shape in OFFER_SHAPES:
+        path = os.path.join(tmp, f"landing-{shape}.csv")
+        write_upload_file(path, args.landing_links, next(accounts), "csv")
+        upload_id, *_ = upload(client, path, create_offer(client, shape))
+        tokens = link_tokens(upload_id)
+        for lang in LANGS:
+            def send(c, i):
+                return c.get(f"/l/{tokens[i % len(tokens)]}?lang={lang}")
+
+            run_requests(app, send, args.warmup, 1)
+            results.append({"scenario": "landing", "offer_shape": shape, "lang": lang,
+                            **run_requests(app, send, args.requests, args.concurrency)})
+    return results
+
+
+def bench_agree(app, client, tmp, args, accounts, crm):
+    path = os.path.join(tmp, "agree.csv")
+    write_upload_file(path, args.agree_requests, next(accounts), "csv")
+    upload_id, *_ = upload(client, path, create_offer(client, "internet_tv"))
+    tokens = link_tokens(upload_id)  # one link per request: a decided link shows "already agreed"
+
+    def send(c, i):
+        return c.post("/agree", data={"token": tokens[i]})
+
+    before = crm.stats()["requests"]
+    result = {"scenario": "agree", "crm_latency": args.crm_latency,
+              "dispatch_mode": app.config["AGREE_DISPATCH_MODE"],
+              **run_requests(app, send, len(tokens), args.concurrency)}
+    if result["dispatch_mode"] == "outbox":
+        # The requests only enqueued the CRM calls: their latency is the enqueue latency,
+        # the calls themselves are timed by waiting for the dispatcher to drain the jobs
+        result.update(wait_for_outbox(upload_id, args.outbox_timeout))
+    # CRM requests per API and outcome during the run (retries included)
+    result["crm_requests"] = {
+        api: {outcome: n - before.get(api, {}).get(outcome, 0) for outcome, n in counts.items()}
+        for api, counts in crm.stats()["requests"].items()}
+    return [result]
+
+
+def bench_upload(app, client, tmp, args, accounts):
+    results = []
+    offer_id = create_offer(client, "internet_tv")
+    for rows in args.sizes:
+        for fmt in args.formats:
+            path = os.path.join(tmp, f"upload-{rows}.{fmt}")
+            write_upload_file(path, rows, next(accounts), fmt)
+            upload_id, request_seconds, total_seconds, progress = upload(client, path, offer_id)
+            results.append({"scenario": "upload", "rows": rows, "format": fmt,
+                            "upload_id": upload_id, "file_bytes": os.path.getsize(path),
+                            "status": progress["status"],
+                            "links_created": progress.get("links_created"),
+                            "request_ms": round(request_seconds * 1000, 3),
+                            "total_seconds": round(total_seconds, 3),
+                            "rows_per_s": round(rows / total_seconds, 1)})
+            os.remove(path)
+    return results
+
+
+def bench_detail(app, client, tmp, args, largest_upload):
+    if largest_upload is None:
+        path = os.path.join(tmp, "detail.csv")
+        write_upload_file(path, max(args.sizes), 10**9, "csv")
+        largest_upload, *_ = upload(client, path, create_offer(client, "internet"))
+    from db import db
+    with db() as conn:
+        lo, hi, count = conn.execute(
+            "SELECT MIN(id), MAX(id), COUNT(*) FROM links WHERE upload_id=?", (largest_upload,)
+        ).fetchone()
+    base = f"/admin/uploads/{largest_upload}"
+    pages = {"first_page": base, "middle_page": f"{base}?after={(lo + hi) // 2}",
+             "last_page": f"{base}?before={hi + 1}", "status_filter": f"{base}?status=NEW"}
+    results = []
+    for name, url in pages.items():
+        def send(c, i):
+            return c.get(url)
+
+        run_requests(app, send, min(args.warmup, 5), 1)
+        results.append({"scenario": "detail", "page": name, "links": count,
+                        **run_requests(app, send, args.detail_requests, 1)})
+    login(client)
+    started = time.perf_counter()
+    r = client.get(f"{base}/download.csv")
+    size = sum(len(chunk) for chunk in r.response)
+    seconds = time.perf_counter() - started
+    results.append({"scenario": "csv_export", "links": count, "bytes": size,
+                    "seconds": round(seconds, 3), "rows_per_s": round(count / seconds, 1),
+                    "status": r.status_code})
+    return results
+
+
+# ---------- Compare ----------
+_RESULT_KEYS = ("scenario", "offer_shape", "lang", "rows", "format", "page", "crm_latency",
+                "dispatch_mode")
+_COMPARED = ("p50_ms", "p99_ms", "throughput_rps", "total_seconds", "rows_per_s", "seconds",
+             "outbox_drain_seconds")
+
+
+def compare(old_path, new_path):
+    old, new = (json.loads(pathlib.Path(p).read_text(encoding="utf-8"))
+                for p in (old_path, new_path))
+
+    def key(r):
+        return tuple((k, r[k]) for k in _RESULT_KEYS if k in r)
+
+    before = {key(r): r for r in old["results"]}
+    print(f"{old['version']} ({old.get('git_commit') or '?'}) -> "
+          f"{new['version']} ({new.get('git_commit') or '?'})")
+    for r in new["results"]:
+        base = before.get(key(r))
+        label = " ".join(str(v) for _, v in key(r))
+        if base is None:
+            print(f"{label}: new")
+            continue
+        changes = []
+        for metric in _COMPARED:
+            if base.get(metric) and r.get(metric) is not None:
+                change = (r[metric] / base[metric] - 1) * 100
+                changes.append(f"{metric} {base[metric]} -> {r[metric]} ({change:+.1f}%)")
+        print(f"{label}: {'; '.join(changes)}")
+
+
+# ---------- Main ----------
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                              capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _csv_ints(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main():
+    p = argparse.ArgumentParser(description="Benchmark landing, agree, upload and upload pages.")
+    p.add_argument("--only", default="landing,agree,upload,detail",
+                   help="comma-separated scenarios")
+    p.add_argument("--requests", type=int, default=500,
+                   help="landing requests per offer shape and language")
+    p.add_argument("--warmup", type=int, default=20)
+    p.add_argument("--concurrency", type=int, default=4, help="client threads")
+    p.add_argument("--landing-links", type=int, default=1000,
+                   help="links per offer shape for landing")
+    p.add_argument("--agree-requests", type=int, default=200)
+    p.add_argument("--agree-mode", default="inline", choices=("inline", "concurrent", "outbox"))
+    p.add_argument("--outbox-timeout", type=float, default=600,
+                   help="seconds to wait for the outbox to drain after the agree run "
+                        "(--agree-mode outbox)")
+    p.add_argument("--crm-latency", default="const:50",
+                   help="CRM stub latency spec, ms (see crm_stub.py)")
+    p.add_argument("--crm-error-rate", type=float, default=0.0)
+    p.add_argument("--crm-timeout-rate", type=float, default=0.0)
+    p.add_argument("--crm-reset-rate", type=float, default=0.0)
+    p.add_argument("--sizes", type=_csv_ints, default=[10_000, 100_000, 1_000_000],
+                   help="upload rows")
+    p.add_argument("--formats", default="csv,xlsx")
+    p.add_argument("--detail-requests", type=int, default=50)
+    p.add_argument("--output", help="write the JSON here instead of stdout")
+    p.add_argument("--keep", action="store_true", help="keep the temporary DB and files")
+    p.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"),
+                   help="compare two result files and exit")
+    args = p.parse_args()
+    if args.compare:
+        compare(*args.compare)
+        return
+    args.formats = [f for f in args.formats.split(",") if f in ("csv", "xlsx")]
+    scenarios = [s for s in args.only.split(",") if s]
+
+    tmp = tempfile.mkdtemp(prefix="landing-bench-")
+    crm_behaviour = dict(latency=args.crm_latency, error_rate=args.crm_error_rate,
+                         timeout_rate=args.crm_timeout_rate, reset_rate=args.crm_reset_rate)
+    crm = StubCRM(order=Behaviour(**crm_behaviour), communication=Behaviour(**crm_behaviour),
+                  seed=1)
+    crm_url = crm.start()
+    # The app reads its settings at import: point it at the temp DB and the stub CRM
+    os.environ.update(DB_PATH=os.path.join(tmp, "bench.db"),
+                      UPLOAD_DIR=os.path.join(tmp, "uploads"),
+                      ORDER_API_URL=f"{crm_url}/order", COMM_API_URL=f"{crm_url}/communications",
+                      AGREE_DISPATCH_MODE=args.agree_mode, UPLOAD_JOBS_POLL_INTERVAL="0.05")
+    for name, value in (("SECRET_KEY", "bench"), ("ORDER_API_KEY", "bench"),
+                        ("COMM_CHANNEL_ID", "1"), ("COMMUNICATION_TYPE_ID", "1"), ("BASE_URL", "https://bench.local"),
+                        ("ACCESS_LOG_TIMINGS", "0")):
+        os.environ.setdefault(name, value)
+
+    # The app prints order/communication payloads; keep stdout for the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        import app as app_module
+        from version import get_version
+        logging.getLogger().setLevel(logging.WARNING)
+        app = app_module.app
+        client = app.test_client()
+        login(client)
+        accounts = iter(range(1_000_000, 10**12, 10_000_000))  # disjoint account ranges per file
+        results = []
+        started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        try:
+            if "landing" in scenarios:
+                results += bench_landing(app, client, tmp, args, accounts)
+            if "agree" in scenarios:
+                results += bench_agree(app, client, tmp, args, accounts, crm)
+            largest = None
+            if "upload" in scenarios:
+                uploaded = bench_upload(app, client, tmp, args, accounts)
+                results += uploaded
+                done = [r for r in uploaded if r["status"] == "DONE"]
+                largest = max(done, key=lambda r: r["rows"])["upload_id"] if done else None
+            if "detail" in scenarios:
+                results += bench_detail(app, client, tmp, args, largest)
+        finally:
+            app_module.shutdown_background_tasks()
+            crm.stop()
+            if args.keep:
+                print(f"[ok] Kept {tmp}", file=sys.stderr)
+            else:
+                shutil.rmtree(tmp, ignore_errors=True)
+
+    report = {
+        "version": get_version(),
+        "git_commit": _git_commit(),
+        "started_at": started_at,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {key: app.config.get(key) for key in CONFIG_KEYS},
+        "crm_stub": crm_behaviour,
+        "results": results,
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        pathlib.Path(args.output).write_text(text + "\n", encoding="utf-8")
+        print(f"[ok] {len(results)} results in {args.output}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
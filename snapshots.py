@@ -0,0 +1,195 @@
+"""
+Content-addressed offer snapshots.
+
+A snapshot is the JSON produced by db.fetch_offer_snapshot(). Each distinct
+snapshot is stored once in offer_snapshots (keyed by the SHA-256 of its
+canonical JSON); links only keep snapshot_id.
+
+Links created with a product_key follow the current snapshot of their
+(offer_id, product_key) through offer_snapshot_heads, so refreshing snapshots
+after an offer edit is one head update instead of rewriting every link row.
+Links without product_key stay on the snapshot they were created with.
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+from db import now_iso
+
+# Landing languages with a materialized view per snapshot
+VIEW_LANGS = ("ru", "kk")
+# Parsed (snapshot_id, lang) views kept per worker; snapshots are immutable, so no invalidation
+OFFER_VIEW_CACHE_SIZE = int(os.getenv("OFFER_VIEW_CACHE_SIZE", "256"))
+
+# Use in "SELECT l.*, {LINK_SNAPSHOT_COLUMNS} FROM links l {LINK_SNAPSHOT_JOIN} ..."
+LINK_SNAPSHOT_JOIN = """
+  LEFT JOIN offer_snapshot_heads sh ON sh.offer_id = l.offer_id AND sh.product_key = l.product_key
+  LEFT JOIN offer_snapshots s ON s.id = COALESCE(sh.snapshot_id, l.snapshot_id)"""
+LINK_SNAPSHOT_COLUMNS = "s.id AS resolved_snapshot_id, s.snapshot_json AS resolved_snapshot_json"
+
+
+def canonical_json(snap) -> str:
+    return json.dumps(snap, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+
+
+def snapshot_hash(snap) -> str:
+    return hashlib.sha256(canonical_json(snap).encode("utf-8")).hexdigest()
+
+
+def product_key_for(snap):
+    """Binding key "product_offer_id:product_offer_struct_id:po_struct_element_id" or None."""
+    om = (snap or {}).get("order_mapping") or {}
+    try:
+        po_offer_id = om.get("product_offer_id")
+        po_struct_id = om.get("product_offer_struct_id")
+        po_elem_id = om.get("po_struct_element_id")
+        if po_offer_id is not None and po_struct_id is not None and po_elem_id is not None:
+            return f"{int(po_offer_id)}:{int(po_struct_id)}:{int(po_elem_id)}"
+    except (ValueError, TypeError):
+        pass
+    return None
+
+
+def store_snapshot(cur, snap) -> int:
+    """Insert the snapshot if its content is new; returns its id either way."""
+    body = canonical_json(snap)
+    h = hashlib.sha256(body.encode("utf-8")).hexdigest()
+    cur.execute("""INSERT OR IGNORE INTO offer_snapshots
+                     (content_hash, offer_id, snapshot_json, created_at)
+                   VALUES (?, ?, ?, ?)""",
+                (h, snap.get("id"), body, now_iso()))
+    created = cur.rowcount == 1
+    cur.execute("SELECT id FROM offer_snapshots WHERE content_hash=?", (h,))
+    snapshot_id = cur.fetchone()[0]
+    if created:
+        store_views(cur, snapshot_id, snap)
+    return snapshot_id
+
+
+def store_views(cur, snapshot_id: int, snap):
+    """Materialize the per-language landing views of a snapshot."""
+    for lang in VIEW_LANGS:
+        cur.execute("""INSERT OR REPLACE INTO offer_snapshot_views (snapshot_id, lang, view_json)
+                       VALUES (?, ?, ?)""",
+                    (snapshot_id, lang, json.dumps(localize_offer(snap, lang), ensure_ascii=False)))
+
+
+def set_head(cur, offer_id: int, product_key: str, snapshot_id: int):
+    """Point every link of (offer_id, product_key) at snapshot_id."""
+    cur.execute("""INSERT INTO offer_snapshot_heads (offer_id, product_key, snapshot_id, updated_at)
+                   VALUES (?, ?, ?, ?)
+                   ON CONFLICT(offer_id, product_key) DO UPDATE SET
+                     snapshot_id=excluded.snapshot_id, updated_at=excluded.updated_at""",
+                (offer_id, product_key, snapshot_id, now_iso()))
+
+
+def link_offer(row) -> dict:
+    """Offer snapshot of a link row read with LINK_SNAPSHOT_COLUMNS; falls back to legacy JSON."""
+    keys = row.keys()
+    raw = row["resolved_snapshot_json"] if "resolved_snapshot_json" in keys else None
+    if raw is None and "offer_snapshot_json" in keys:
+        raw = row["offer_snapshot_json"]
+    return json.loads(raw or "{}")
+
+
+def localize_offer(offer: dict, lang: str) -> dict:
+    """Copy of the snapshot with title, badges and component titles resolved for `lang`.
+
+    Uses details.translations; for Kazakh falls back to Russian, then to the original value.
+    """
+    offer = copy.deepcopy(offer)
+    if not (offer.get("details") and offer["details"].get("translations")):
+        return offer
+    translations_data = offer["details"]["translations"]
+
+    # For Kazakh language, use Russian as fallback
+    if lang == "kk":
+        ru_translations = translations_data.get("ru", {})
+        kk_translations = translations_data.get("kk", {})
+
+        # Override title: use Kazakh if available, otherwise Russian, otherwise keep original
+        if "title" in kk_translations:
+            offer["title"] = kk_translations["title"]
+        elif "title" in ru_translations:
+            offer["title"] = ru_translations["title"]
+
+        # Override badges: use Kazakh if available, otherwise Russian
+        if "badges" in kk_translations:
+            offer["details"]["badges"] = kk_translations["badges"]
+        elif "badges" in ru_translations:
+            offer["details"]["badges"] = ru_translations["badges"]
+
+        # Override component titles: use Kazakh if available, otherwise Russian
+        if offer["details"].get("components"):
+            kk_comp_map = {c.get("type"): c for c in kk_translations.get("components", [])
+                           if c.get("type")}
+            ru_comp_map = {c.get("type"): c for c in ru_translations.get("components", [])
+                           if c.get("type")}
+            for comp in offer["details"]["components"]:
+                comp_type = comp.get("type")
+                if comp_type:
+                    if comp_type in kk_comp_map and "title" in kk_comp_map[comp_type]:
+                        comp["title"] = kk_comp_map[comp_type]["title"]
+                    elif comp_type in ru_comp_map and "title" in ru_comp_map[comp_type]:
+                        comp["title"] = ru_comp_map[comp_type]["title"]
+    elif lang == "ru" and "ru" in translations_data:
+        # For Russian, use Russian translations directly
+        ru_translations = translations_data["ru"]
+        if "title" in ru_translations:
+            offer["title"] = ru_translations["title"]
+        if "badges" in ru_translations:
+            offer["details"]["badges"] = ru_translations["badges"]
+        if "components" in ru_translations and offer["details"].get("components"):
+            ru_comp_map = {c.get("type"): c for c in ru_translations["components"] if c.get("type")}
+            for comp in offer["details"]["components"]:
+                comp_type = comp.get("type")
+                if comp_type and comp_type in ru_comp_map and "title" in ru_comp_map[comp_type]:
+                    comp["title"] = ru_comp_map[comp_type]["title"]
+    return offer
+
+
+_view_cache: OrderedDict[tuple[int, str], dict] = OrderedDict()
+_view_cache_lock = threading.Lock()
+_view_stats = {"hits": 0, "db_loads": 0, "computed": 0}
+
+
+def offer_view(cur, snapshot_id: int, lang: str) -> dict:
+    """Localized offer for (snapshot, lang): worker cache, then offer_snapshot_views, then computed.
+
+    The returned dict is shared between requests and must not be mutated.
+    """
+    key = (snapshot_id, lang)
+    with _view_cache_lock:
+        view = _view_cache.get(key)
+        if view is not None:
+            _view_cache.move_to_end(key)
+            _view_stats["hits"] += 1
+            return view
+
+    cur.execute("SELECT view_json FROM offer_snapshot_views WHERE snapshot_id=? AND lang=?",
+                (snapshot_id, lang))
+    row = cur.fetchone()
+    if row:
+        view = json.loads(row[0])
+        stat = "db_loads"
+    else:
+        # Not materialized (e.g. a language added later): compute without writing on the read path
+        cur.execute("SELECT snapshot_json FROM offer_snapshots WHERE id=?", (snapshot_id,))
+        snap_row = cur.fetchone()
+        view = localize_offer(json.loads(snap_row[0]) if snap_row else {}, lang)
+        stat = "computed"
+
+    with _view_cache_lock:
+        _view_stats[stat] += 1
+        _view_cache[key] = view
+        while len(_view_cache) > OFFER_VIEW_CACHE_SIZE:
+            _view_cache.popitem(last=False)
+    return view
+
+
+def view_cache_stats() -> dict:
+    with _view_cache_lock:
+        return dict(_view_stats, size=len(_view_cache), max_size=OFFER_VIEW_CACHE_SIZE)
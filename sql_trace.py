@@ -0,0 +1,115 @@
+"""
+SQL trace mode for db() connections (SQL_TRACE=1, or db(trace=True) for one block).
+
+A traced connection has the sqlite3 trace callback set, which yields each
+statement's text with its parameters bound; the timed cursor of db.py
+reports how long its execute and fetch calls take. Per statement shape
+(the SQL with literals replaced by ? and whitespace collapsed) this keeps
+the number of executions, total and max time. A statement that takes
+SQL_SLOW_MS or longer (execute plus fetches) is logged as its shape, so no
+bound values reach the log, with its EXPLAIN QUERY PLAN, which is also kept
+for the shape.
+
+Aggregates are per process: under gunicorn /admin/sql shows the worker that
+served it.
+"""
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+SQL_SLOW_MS = float(os.getenv("SQL_SLOW_MS", "200"))
+# Shapes beyond this many are counted under OTHER (statements built with varying text)
+SQL_TRACE_MAX_SHAPES = int(os.getenv("SQL_TRACE_MAX_SHAPES", "1000"))
+
+OTHER = "(other statements)"
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)+\s*\)", re.IGNORECASE)
+_REPEATED_ROWS = re.compile(r"(\(\s*\?(?:\s*,\s*\?)*\s*\))(?:\s*,\s*\(\s*\?(?:\s*,\s*\?)*\s*\))+")
+_SPACE = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+
+_lock = threading.Lock()
+_shapes: dict[str, dict] = {}
+
+
+def statement_shape(sql: str) -> str:
+    """SQL with literals as ?, IN lists as (?, ...), VALUES rows as one row, spaces collapsed."""
+    shape = _SPACE.sub(" ", sql).strip()
+    shape = _STRING.sub("?", shape)
+    shape = _NUMBER.sub("?", shape)
+    shape = _IN_LIST.sub("IN (?, ...)", shape)
+    return _REPEATED_ROWS.sub(r"\1, ...", shape)
+
+
+def explain(conn, sql: str) -> list:
+    """EXPLAIN QUERY PLAN lines of `sql` (indented by depth); [] when it can't be explained."""
+    if not sql or not sql.lstrip().upper().startswith(_EXPLAINABLE):
+        return []
+    try:
+        # A plain cursor: the plan query itself is neither timed nor traced into the aggregates
+        rows = conn.cursor(sqlite3.Cursor).execute("EXPLAIN QUERY PLAN " + sql).fetchall()
+    except sqlite3.Error:
+        return []
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in rows:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return lines
+
+
+def record(cursor, sql, seconds, executed):
+    """db statement observer; records only connections in trace mode."""
+    conn = cursor.connection
+    if not conn.traced:
+        return
+    if executed:
+        cursor.trace_seconds, cursor.trace_logged = 0.0, False
+    elapsed = getattr(cursor, "trace_seconds", 0.0) + seconds
+    cursor.trace_seconds = elapsed
+    slow = elapsed * 1000 >= SQL_SLOW_MS and not getattr(cursor, "trace_logged", False)
+
+    shape = statement_shape(sql)
+    with _lock:
+        stats = _shapes.get(shape)
+        if stats is None:
+            if len(_shapes) >= SQL_TRACE_MAX_SHAPES:
+                shape = OTHER
+                stats = _shapes.get(OTHER)
+            if stats is None:
+                stats = _shapes[shape] = {"count": 0, "total_seconds": 0.0, "max_seconds": 0.0,
+                                          "slow": 0, "plan": None}
+        if executed:
+            stats["count"] += 1
+        stats["total_seconds"] += seconds
+        stats["max_seconds"] = max(stats["max_seconds"], elapsed)
+        if slow:
+            stats["slow"] += 1
+
+    if slow:
+        cursor.trace_logged = True
+        # The bound text (customer data in the values) is only used to get the plan, never logged
+        plan = explain(conn, cursor.traced_sql or sql)
+        with _lock:
+            stats["plan"] = plan
+        logging.warning(f"Slow SQL ({elapsed * 1000:.0f} ms): {statement_shape(sql)[:2000]}"
+                        + "".join(f"\n    {line}" for line in plan))
+
+
+def top(limit: int = 50, order: str = "total_seconds") -> list:
+    """Statement shapes with the largest `order` (total_seconds, max_seconds, count, slow) first."""
+    with _lock:
+        rows = [{"shape": shape, **stats} for shape, stats in _shapes.items()]
+    for row in rows:
+        row["avg_seconds"] = row["total_seconds"] / row["count"] if row["count"] else 0.0
+    rows.sort(key=lambda row: row[order], reverse=True)
+    return rows[:limit]
+
+
+def reset():
+    with _lock:
+        _shapes.clear()
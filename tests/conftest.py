@@ -0,0 +1,63 @@
+import os
+import sys
+import tempfile
+import uuid
+from pathlib import Path
+
+import pytest
+
+# Configure before the app modules are imported: db.py reads DB_PATH at import time
+_tmp = tempfile.mkdtemp(prefix="landing-tests-")
+os.environ["DB_PATH"] = os.path.join(_tmp, "app.db")
+os.environ["UPLOAD_DIR"] = os.path.join(_tmp, "uploads")
+os.environ.setdefault("SECRET_KEY", "test")
+os.environ.setdefault("ORDER_API_URL", "http://127.0.0.1:9/order")
+os.environ.setdefault("ORDER_API_KEY", "test")
+os.environ.setdefault("AGREE_DISPATCH_MODE", "outbox")
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+@pytest.fixture(scope="session")
+def schema():
+    """The test database with all migrations applied."""
+    from db import init_db
+    init_db()
+
+
+@pytest.fixture
+def offer(schema):
+    """An offer with its stored snapshot: (offer_id, snapshot_id)."""
+    from db import db, fetch_offer_snapshot
+    from snapshots import store_snapshot
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO offers (title, bundle, price, currency, details_json,
+                                         product_offer_id, product_offer_struct_id,
+                                         po_struct_element_id)
+                     VALUES ('Internet 100', 'internet', 5990, 'KZT', '{}', 1, 2, 3)""")
+        offer_id = c.lastrowid
+        snapshot_id = store_snapshot(c, fetch_offer_snapshot(c, offer_id))
+        conn.commit()
+    return offer_id, snapshot_id
+
+
+@pytest.fixture
+def make_link(offer):
+    """make_link(status="NEW", expires_at=None) -> id of a new link to `offer` for a new user."""
+    from db import db, now_iso
+    offer_id, snapshot_id = offer
+
+    def make(status="NEW", expires_at=None):
+        with db() as conn:
+            c = conn.cursor()
+            c.execute("INSERT INTO users (name, filial_id) VALUES ('Test', 1)")
+            c.execute("""INSERT INTO links
+                           (user_id, offer_id, token, created_at, expires_at, status, snapshot_id)
+                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                      (c.lastrowid, offer_id, uuid.uuid4().hex, now_iso(), expires_at, status,
+                       snapshot_id))
+            conn.commit()
+            return c.lastrowid
+
+    return make
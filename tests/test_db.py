@@ -0,0 +1,21 @@
+import threading
+
+import db
+import sql_trace
+
+
+def test_observer_is_registered_once_by_concurrent_traced_blocks(schema, monkeypatch):
+    monkeypatch.setattr(db, "_statement_observers", [])
+    start = threading.Barrier(8)
+
+    def traced_block():
+        start.wait()
+        with db.db(trace=True) as conn:
+            conn.execute("SELECT 1").fetchone()
+
+    threads = [threading.Thread(target=traced_block) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert db._statement_observers.count(sql_trace.record) == 1
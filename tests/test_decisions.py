@@ -0,0 +1,135 @@
+import datetime
+import threading
+
+import pytest
+
+import decisions
+import outbox
+from db import db
+
+PAGE = {"blocked_statuses": ("AGREED", "REJECTED"), "check_expiry": True, "mark_opened": True}
+API_AGREE = {"blocked_statuses": ("AGREED",), "check_expiry": False, "mark_opened": False}
+
+
+def _enqueue(cur, link_id):
+    outbox.enqueue(cur, link_id, outbox.OUTBOX_KINDS)
+
+
+def _state(link_id):
+    with db() as conn:
+        link = conn.execute("""SELECT status, agreed_at, rejected_at, opened_at
+                                 FROM links WHERE id=?""", (link_id,)).fetchone()
+        consents = [r[0] for r in conn.execute(
+            "SELECT choice FROM consents WHERE link_id=? ORDER BY id", (link_id,))]
+        jobs = [r[0] for r in conn.execute(
+            "SELECT kind FROM outbox WHERE link_id=? ORDER BY kind", (link_id,))]
+    return dict(link), consents, jobs
+
+
+def test_agree_records_consent_and_outbox_jobs(make_link):
+    link_id = make_link()
+    d = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, ip="10.0.0.1", **PAGE)
+    assert d.outcome == decisions.OK
+    assert d.offer["title"] == "Internet 100"
+    link, consents, jobs = _state(link_id)
+    assert link["status"] == "AGREED" and link["agreed_at"] == d.at and link["opened_at"] == d.at
+    assert consents == ["AGREED"]
+    assert jobs == ["communication", "order"]
+
+
+def test_double_agree_is_reported_once(make_link):
+    link_id = make_link()
+    first = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, **PAGE)
+    second = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, **PAGE)
+    assert (first.outcome, second.outcome) == (decisions.OK, decisions.ALREADY)
+    assert second.link["status"] == "AGREED"
+    link, consents, jobs = _state(link_id)
+    assert link["agreed_at"] == first.at
+    assert consents == ["AGREED"]
+    assert jobs == ["communication", "order"]
+
+
+def test_concurrent_agrees_record_one_decision(make_link):
+    link_id = make_link()
+    start = threading.Barrier(8)
+    outcomes = []
+
+    def agree():
+        start.wait()
+        decision = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, **PAGE)
+        outcomes.append(decision.outcome)
+
+    threads = [threading.Thread(target=agree) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert sorted(outcomes) == [decisions.ALREADY] * 7 + [decisions.OK]
+    _, consents, jobs = _state(link_id)
+    assert consents == ["AGREED"]
+    assert jobs == ["communication", "order"]
+
+
+def test_agree_after_reject(make_link):
+    link_id = make_link()
+    assert decisions.decide(link_id, decisions.REJECTED, **PAGE).outcome == decisions.OK
+
+    # Decision pages: a rejection is final
+    d = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, **PAGE)
+    assert d.outcome == decisions.ALREADY and d.link["status"] == "REJECTED"
+    link, consents, jobs = _state(link_id)
+    assert link["status"] == "REJECTED" and link["agreed_at"] is None
+    assert consents == ["REJECTED"] and jobs == []
+
+    # /api/agree only blocks AGREED, as before
+    d = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, **API_AGREE)
+    assert d.outcome == decisions.OK
+    link, consents, jobs = _state(link_id)
+    assert link["status"] == "AGREED"
+    assert consents == ["REJECTED", "AGREED"]
+    assert jobs == ["communication", "order"]
+
+
+def test_expired_link(make_link):
+    past = (datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=1)).isoformat()
+    link_id = make_link(expires_at=past)
+    d = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, **PAGE)
+    assert d.outcome == decisions.EXPIRED and d.link["status"] == "NEW"
+    link, consents, jobs = _state(link_id)
+    assert link["status"] == "NEW" and link["opened_at"] is None
+    assert consents == [] and jobs == []
+
+    # The JSON API never checked expiry
+    assert decisions.decide(link_id, decisions.AGREED, **API_AGREE).outcome == decisions.OK
+
+
+@pytest.mark.parametrize("status", ["AGREED", "REJECTED"])
+def test_blocked_status(make_link, status):
+    link_id = make_link(status=status)
+    d = decisions.decide(link_id, decisions.REJECTED, **PAGE)
+    assert d.outcome == decisions.ALREADY and d.link["status"] == status
+    link, consents, _ = _state(link_id)
+    assert link["status"] == status and link["rejected_at"] is None
+    assert consents == []
+
+
+def test_unknown_link(schema):
+    assert decisions.decide(-1, decisions.AGREED, **PAGE).outcome == decisions.NOT_FOUND
+
+
+def test_in_transaction_failure_rolls_back_the_decision(make_link):
+    link_id = make_link()
+
+    def enqueue_then_fail(cur, lid):
+        _enqueue(cur, lid)
+        raise RuntimeError("enqueue failed")
+
+    with pytest.raises(RuntimeError):
+        decisions.decide(link_id, decisions.AGREED, in_transaction=enqueue_then_fail, **PAGE)
+    link, consents, jobs = _state(link_id)
+    assert link["status"] == "NEW" and link["agreed_at"] is None
+    assert consents == [] and jobs == []
+    # and the link can still be agreed
+    decision = decisions.decide(link_id, decisions.AGREED, in_transaction=_enqueue, **PAGE)
+    assert decision.outcome == decisions.OK
+    assert _state(link_id)[2] == ["communication", "order"]
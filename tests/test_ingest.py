@@ -0,0 +1,139 @@
+import json
+
+import pandas as pd
+import pytest
+
+from db import db, now_iso
+from ingest import ingest_rows
+from upload_validation import resolve_columns, validate_frame
+
+_USER_FIELDS = ("filial_id", "phone", "customer_id", "name", "identification_number")
+
+
+@pytest.fixture
+def upload(offer):
+    offer_id, snapshot_id = offer
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO bulk_uploads (filename, uploaded_at, offer_id)
+                     VALUES ('segment.csv', ?, ?)""", (now_iso(), offer_id))
+        upload_id = c.lastrowid
+        base = c.execute("SELECT COALESCE(MAX(customer_account_id), 0) FROM users").fetchone()[0]
+        conn.commit()
+    return {"upload_id": upload_id, "offer_id": offer_id, "snapshot_id": snapshot_id, "base": base}
+
+
+def _ingest(upload, clean, sign_tokens=None):
+    with db() as conn:
+        c = conn.cursor()
+        created = ingest_rows(c, clean, upload_id=upload["upload_id"], offer_id=upload["offer_id"],
+                              expires_at=None, snapshot_id=upload["snapshot_id"],
+                              product_key="1:2:3", external_prefix="BATCH",
+                              sign_tokens=sign_tokens)
+        conn.commit()
+    return created
+
+
+def _legacy_users(clean, stored):
+    """The old upload_new() find-or-create-user step, applied row by row to `stored`."""
+    users = {k: dict(v) for k, v in stored.items()}
+    for r in clean.itertuples():
+        u = users.get(r.customer_account_id)
+        if u is None:
+            users[r.customer_account_id] = {field: getattr(r, field) for field in _USER_FIELDS}
+            continue
+        u["filial_id"] = r.filial_id
+        if r.phone and u["phone"] != r.phone:
+            u["phone"] = r.phone
+        if r.customer_id is not None:
+            u["customer_id"] = r.customer_id
+        if r.name:
+            u["name"] = r.name
+        if r.identification_number:
+            u["identification_number"] = r.identification_number
+    return users
+
+
+def _users(accounts):
+    with db() as conn:
+        rows = conn.execute(f"""SELECT customer_account_id, {", ".join(_USER_FIELDS)}
+                                  FROM users
+                                 WHERE customer_account_id IN ({",".join("?" * len(accounts))})""",
+                            list(accounts)).fetchall()
+    return {r[0]: dict(zip(_USER_FIELDS, r[1:])) for r in rows}
+
+
+def _links(upload_id):
+    with db() as conn:
+        return conn.execute("""SELECT l.external_id, u.customer_account_id, l.address_json, l.token
+                                 FROM links l JOIN users u ON u.id = l.user_id
+                                WHERE l.upload_id=? ORDER BY l.id""", (upload_id,)).fetchall()
+
+
+def _clean(base, rows):
+    columns = ["customer_account_id", "filial_id", "customer_id", "phone", "name", "iin",
+               "street_name", "house"]
+    df = pd.DataFrame(rows, columns=columns, dtype=object)
+    df["customer_account_id"] = [base + a for a in df["customer_account_id"]]
+    clean, errors = validate_frame(df, resolve_columns(df.columns))
+    assert errors.empty
+    return clean
+
+
+# Accounts 1-3 repeat with fields set, blank and missing in different rows; 4 already exists
+_ROWS = [
+    (1, 10, None, "77010000001", "", "", "Abay", 1),
+    (2, 20, 501, None, "Aigerim", None, "Abay", 2),
+    (1, 11, 301, " ", "Nurlan", "880101300001", "Abay", 3),
+    (3, 30, None, None, None, None, "Abay", 4),
+    (1, 12, None, None, None, "nan", "Abay", 5),
+    (4, 40, None, "", "", None, "Abay", 6),
+    (2, 21, "", "77010000002", " ", "890202400002", "Abay", 7),
+    (3, 31, 0, "77010000003.0", "Dana", None, "Abay", 8),
+    (1, 13, None, "77010000004", None, None, "Abay", 9),
+]
+
+
+def test_repeated_accounts_match_row_by_row_upsert(upload):
+    base = upload["base"]
+    stored = {base + 4: {"filial_id": 1, "phone": "77019999999", "customer_id": 777,
+                         "name": "Old name", "identification_number": "800101000000"}}
+    with db() as conn:
+        conn.execute(f"""INSERT INTO users (customer_account_id, {", ".join(_USER_FIELDS)})
+                         VALUES (?, 1, '77019999999', 777, 'Old name', '800101000000')""",
+                     (base + 4,))
+        conn.commit()
+    clean = _clean(base, _ROWS)
+
+    assert _ingest(upload, clean) == len(_ROWS)
+
+    expected = _legacy_users(clean, stored)
+    assert _users(expected) == expected
+    assert expected[base + 1] == {"filial_id": 13, "phone": "77010000004", "customer_id": 301,
+                                  "name": "Nurlan", "identification_number": "880101300001"}
+    assert expected[base + 4]["phone"] == "77019999999"
+    links = _links(upload["upload_id"])
+    prefix = f"BATCH-{upload['upload_id']}-"
+    assert [(ext, acc) for ext, acc, _, _ in links] == [
+        (f"{prefix}{i}", base + r[0]) for i, r in enumerate(_ROWS, 1)]
+    assert json.loads(links[0][2]) == {"STREET_NAME": "Abay", "HOUSE": 1}
+
+
+def test_rerunning_a_chunk_does_not_duplicate_links(upload):
+    base = upload["base"]
+    clean = _clean(base, _ROWS)
+    sign = lambda ids: [f"token-{i}" for i in ids]  # noqa: E731
+    assert _ingest(upload, clean.iloc[:5], sign) == 5
+    users = _users({base + a for a in (1, 2, 3)})
+
+    # The same chunk again (a job resumed before its progress was committed), then the next one
+    assert _ingest(upload, clean.iloc[:5], sign) == 0
+    assert _users({base + a for a in (1, 2, 3)}) == users
+    assert _ingest(upload, clean.iloc[3:], sign) == 4
+
+    links = _links(upload["upload_id"])
+    prefix = f"BATCH-{upload['upload_id']}-"
+    assert [ext for ext, _, _, _ in links] == [f"{prefix}{i}" for i in range(1, 10)]
+    assert all(token for _, _, _, token in links)
+    expected = _legacy_users(clean, {})
+    assert _users(expected) == expected
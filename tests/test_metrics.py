@@ -0,0 +1,27 @@
+import pytest
+from flask import Flask
+
+import metrics
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.delenv("PROMETHEUS_MULTIPROC_DIR", raising=False)
+    app = Flask(__name__)
+    metrics.init_app(app)
+    return app
+
+
+def test_metrics_token_required_when_set(client):
+    client.config["METRICS_TOKEN"] = "s3cret"
+    c = client.test_client()
+    for headers in ({}, {"Authorization": "Bearer wrong"}, {"Authorization": "Basic s3cret"}):
+        r = c.get("/metrics", headers=headers)
+        assert r.status_code == 401 and r.headers["WWW-Authenticate"].startswith("Bearer")
+    r = c.get("/metrics", headers={"Authorization": "Bearer s3cret"})
+    assert r.status_code == 200
+    assert "http_request_duration_seconds" in r.get_data(as_text=True)
+
+
+def test_metrics_open_without_token(client):
+    assert client.test_client().get("/metrics").status_code == 200
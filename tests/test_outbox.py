@@ -0,0 +1,106 @@
+import datetime
+
+import pytest
+from flask import Flask
+
+import outbox
+from db import db
+
+
+@pytest.fixture
+def dispatcher(schema):
+    with db() as conn:
+        conn.execute("DELETE FROM outbox")  # jobs left by other tests would be claimed too
+        conn.commit()
+    app = Flask(__name__)
+    app.config.update(OUTBOX_MAX_ATTEMPTS=3, OUTBOX_RETRY_BASE_SECONDS=5,
+                      OUTBOX_RETRY_MAX_SECONDS=8, OUTBOX_LEASE_SECONDS=300)
+    return outbox.OutboxDispatcher(app, handlers={})
+
+
+@pytest.fixture
+def job_link(make_link):
+    link_id = make_link(status="AGREED")
+    with db() as conn:
+        outbox.enqueue(conn.cursor(), link_id, ["order"])
+        conn.commit()
+    return link_id
+
+
+def _row(link_id):
+    with db() as conn:
+        return dict(conn.execute("SELECT * FROM outbox WHERE link_id=?", (link_id,)).fetchone())
+
+
+def _move(link_id, column, seconds):
+    """Shift a timestamp column of the link's job by `seconds`."""
+    with db() as conn:
+        at = (datetime.datetime.fromisoformat(_row(link_id)[column])
+              + datetime.timedelta(seconds=seconds))
+        conn.execute(f"UPDATE outbox SET {column}=? WHERE link_id=?", (at.isoformat(), link_id))
+        conn.commit()
+
+
+def _seconds_until(iso):
+    now = datetime.datetime.now(datetime.timezone.utc)
+    return (datetime.datetime.fromisoformat(iso) - now).total_seconds()
+
+
+def test_expired_lease_is_reclaimed(dispatcher, job_link):
+    [job] = dispatcher._claim(10)
+    assert (job["link_id"], job["kind"], job["attempts"]) == (job_link, "order", 1)
+    assert dispatcher._claim(10) == []  # leased
+
+    _move(job_link, "claimed_at", -299)
+    assert dispatcher._claim(10) == []
+    _move(job_link, "claimed_at", -2)
+    [again] = dispatcher._claim(10)
+    assert again["id"] == job["id"] and again["attempts"] == 2
+    assert again["claim_token"] != job["claim_token"]
+    assert _row(job_link)["status"] == "IN_PROGRESS"
+
+
+def test_stale_claim_token_does_not_overwrite(dispatcher, job_link):
+    [stale] = dispatcher._claim(10)
+    _move(job_link, "claimed_at", -301)
+    [current] = dispatcher._claim(10)
+
+    # The first worker finishes late: neither its success nor its failure is recorded
+    dispatcher._finish(stale)
+    dispatcher._finish(stale, error=RuntimeError("late"))
+    row = _row(job_link)
+    assert (row["status"], row["claim_token"], row["last_error"]) == (
+        "IN_PROGRESS", current["claim_token"], None)
+
+    dispatcher._finish(current)
+    assert _row(job_link)["status"] == "DONE"
+    dispatcher._finish(stale, error=RuntimeError("later"))
+    assert _row(job_link)["status"] == "DONE"
+
+
+def test_failures_back_off_then_fail(dispatcher, job_link):
+    def fail(link_id):
+        raise ConnectionError(f"upstream down for {link_id}")
+
+    dispatcher.handlers = {"order": fail}
+    # Backoff 5 s, then 10 s capped at OUTBOX_RETRY_MAX_SECONDS=8
+    for attempt, delay in ((1, 5), (2, 8)):
+        [job] = dispatcher._claim(10)
+        assert job["attempts"] == attempt
+        dispatcher._inflight += 1  # as the poller does before submitting
+        dispatcher._run(job)
+        row = _row(job_link)
+        assert row["status"] == "PENDING" and row["attempts"] == attempt
+        assert row["last_error"] == f"ConnectionError: upstream down for {job_link}"
+        assert delay - 2 < _seconds_until(row["next_attempt_at"]) <= delay
+        assert dispatcher._claim(10) == []  # not due yet
+        _move(job_link, "next_attempt_at", -delay)
+
+    [job] = dispatcher._claim(10)
+    assert job["attempts"] == 3
+    dispatcher._finish(job, error=ConnectionError("still down"))
+    row = _row(job_link)
+    assert (row["status"], row["attempts"], row["last_error"]) == (
+        "FAILED", 3, "ConnectionError: still down")
+    _move(job_link, "next_attempt_at", -3600)
+    assert dispatcher._claim(10) == []
@@ -0,0 +1,18 @@
+import logging
+
+import sql_trace
+from db import db
+
+
+def test_slow_statement_is_logged_without_bound_values(schema, monkeypatch, caplog):
+    monkeypatch.setattr(sql_trace, "SQL_SLOW_MS", 0)
+    sql_trace.reset()
+    with caplog.at_level(logging.WARNING), db(trace=True) as conn:
+        conn.execute("SELECT id FROM users WHERE phone=? AND customer_account_id IN (?, ?)",
+                     ("77011234567", 41, 42)).fetchall()
+    logged = "\n".join(r.getMessage() for r in caplog.records
+                       if r.getMessage().startswith("Slow SQL"))
+    assert "SELECT id FROM users WHERE phone=? AND customer_account_id IN (?, ...)" in logged
+    assert "77011234567" not in logged and "41" not in logged
+    [row] = [r for r in sql_trace.top() if r["shape"].startswith("SELECT id FROM users")]
+    assert row["plan"]  # explained with the bound text
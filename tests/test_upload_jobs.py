@@ -0,0 +1,40 @@
+from flask import Flask
+
+import upload_jobs
+from db import db, now_iso
+
+
+def test_failed_chunk_keeps_links_of_committed_chunks(offer, tmp_path):
+    offer_id, snapshot_id = offer
+    # Rows 1-4 are valid; row 5 opens a quote that never closes, so the third chunk fails to parse
+    path = tmp_path / "segment.csv"
+    path.write_text("customer_account_id,filial_id,street_name,house\n"
+                    "810001,1,Abay,1\n810002,1,Abay,2\n810003,1,Abay,3\n810004,1,Abay,4\n"
+                    "810005,1,\"Abay,5\n810006,1,Abay,6\n")
+    with db() as conn:
+        c = conn.cursor()
+        c.execute("""INSERT INTO bulk_uploads (filename, uploaded_at, offer_id, status, file_path,
+                                               external_prefix, snapshot_id, product_key)
+                     VALUES ('segment.csv', ?, ?, 'QUEUED', ?, 'BATCH', ?, '1:2:3')""",
+                  (now_iso(), offer_id, str(path), snapshot_id))
+        upload_id = c.lastrowid
+        conn.commit()
+    app = Flask(__name__)
+    app.config.update(SECRET_KEY="test", UPLOAD_CHUNK_ROWS=2)
+    runner = upload_jobs.UploadJobRunner(app)
+
+    job = runner._claim()
+    assert job["id"] == upload_id
+    runner._run(job)
+
+    with db() as conn:
+        row = conn.execute("SELECT * FROM bulk_uploads WHERE id=?", (upload_id,)).fetchone()
+        upload = dict(row)
+        links = conn.execute("SELECT external_id, token FROM links WHERE upload_id=? ORDER BY id",
+                             (upload_id,)).fetchall()
+    assert upload["status"] == upload_jobs.FAILED
+    assert upload["error"].startswith("Failed to parse file")
+    assert [ext for ext, _ in links] == [f"BATCH-{upload_id}-{row}" for row in range(1, 5)]
+    assert all(token for _, token in links)
+    assert (upload["links_created"], upload["rows_parsed"]) == (4, 4)
+    assert upload["file_path"] is None and not path.exists()
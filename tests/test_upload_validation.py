@@ -0,0 +1,159 @@
+"""validate_frame() error messages against the per-row loop upload_new() used before."""
+import io
+import random
+
+import pandas as pd
+
+from upload_reader import read_chunks
+from upload_validation import (
+    ADDRESS_COLUMNS,
+    REQUIRED_ADDRESS_COLUMNS,
+    resolve_columns,
+    validate_frame,
+)
+
+
+def _legacy_errors(df, cols):
+    """The validation part of the old df.iterrows() loop, messages verbatim.
+
+    Cells are read as Python objects (tolist()), which is what the loop
+    printed before numpy 2 changed the repr of numpy scalars; pandas 3's
+    iterrows() would also turn None into nan. The old "skip the row" check
+    after an address error raised TypeError (int in str); here it skips.
+    """
+    customer_col, filial_col = cols["customer_account_id"], cols["filial_id"]
+    column_mapping = cols["address"]
+    errors = []
+    records = zip(*(df[col].tolist() for col in df.columns))
+    for row_counter, row_data in enumerate((dict(zip(df.columns, r)) for r in records), start=1):
+        val = row_data.get(customer_col)
+        if row_counter == 1 and (pd.isna(val) or val == "" or val is None):
+            errors.append(f"Row {row_counter}: Missing customer_account_id. "
+                          f"Column '{customer_col}' found. First row value: {repr(val)}. "
+                          f"Available columns: {list(df.columns)[:5]}")
+            continue
+        if pd.isna(val) or val == "" or val is None:
+            errors.append(f"Row {row_counter}: Missing customer_account_id (empty or NaN)")
+            continue
+        val_str = str(val).strip()
+        if not val_str or val_str.lower() in ["nan", "none", "null", ""]:
+            errors.append(f"Row {row_counter}: Missing customer_account_id (value: '{val}')")
+            continue
+        try:
+            customer_account_id = int(float(val_str))
+        except (ValueError, TypeError) as e:
+            errors.append(f"Row {row_counter}: Invalid customer_account_id (value: '{val}', "
+                          f"type: {type(val).__name__}, error: {str(e)})")
+            continue
+        if customer_account_id <= 0:
+            errors.append(f"Row {row_counter}: Invalid customer_account_id (must be positive, "
+                          f"got: {customer_account_id})")
+            continue
+
+        filial_id_val = row_data.get(filial_col)
+        if pd.isna(filial_id_val) or filial_id_val == "":
+            errors.append(f"Row {row_counter}: Missing 'filial_id' for customer_account_id "
+                          f"{customer_account_id}")
+            continue
+        try:
+            int(filial_id_val)
+        except (ValueError, TypeError):
+            errors.append(f"Row {row_counter}: Invalid 'filial_id' for customer_account_id "
+                          f"{customer_account_id}")
+            continue
+
+        address = {}
+        failed = False
+        for excel_col, api_key in ADDRESS_COLUMNS.items():
+            if excel_col not in column_mapping:
+                continue
+            df_col = column_mapping[excel_col]
+            val = row_data.get(df_col)
+            if (pd.notna(val) and val != ""
+                    and str(val).strip().lower() not in ["nan", "none", "null"]):
+                if api_key in ("STREET_ID", "HOUSE", "FLAT", "ZIP_CODE"):
+                    try:
+                        address[api_key] = int(float(str(val)))
+                    except (ValueError, TypeError):
+                        errors.append(f"Row {row_counter}: Invalid '{excel_col}' value '{val}' "
+                                      f"for customer_account_id {customer_account_id} "
+                                      f"(must be a number)")
+                        failed = True
+                        break
+                else:
+                    address[api_key] = str(val).strip() or None
+            elif excel_col in REQUIRED_ADDRESS_COLUMNS:
+                val_repr = repr(val) if val is not None else "None"
+                errors.append(f"Row {row_counter}: Missing required address field '{excel_col}' "
+                              f"for customer_account_id {customer_account_id} "
+                              f"(column '{df_col}' value: {val_repr})")
+                failed = True
+                break
+        if failed:
+            continue
+        if "STREET_NAME" not in address or not address["STREET_NAME"]:
+            street_val = row_data.get(column_mapping.get("street_name", "N/A"), "N/A")
+            errors.append(f"Row {row_counter}: Missing or invalid 'street_name' "
+                          f"for customer_account_id {customer_account_id} "
+                          f"(found value: {repr(street_val)})")
+    return errors
+
+
+def _messages(df):
+    cols = resolve_columns(df.columns)
+    _, errors = validate_frame(df, cols)
+    return list(errors["message"]), _legacy_errors(df, cols)
+
+
+def test_numeric_columns_read_from_csv():
+    # Blank cells in numeric columns come back from pandas as numpy float64 NaN
+    csv = (
+        "customer_account_id,filial_id,street_name,house,flat\n"
+        ",1,Abay,10,\n"
+        "2,1,Abay,,3\n"
+        "3,1, ,11,\n"
+        "4,,Abay,12,\n"
+        "-5,1,Abay,13,\n"
+        "6,1,Abay,14,7\n"
+    )
+    df = next(read_chunks(io.BytesIO(csv.encode()), "segment.csv", 100))
+    new, old = _messages(df)
+    assert new == old
+    assert "First row value: nan." in new[0]
+    assert new[1] == ("Row 2: Missing required address field 'house' for customer_account_id 2 "
+                      "(column 'house' value: nan)")
+    assert "np." not in "".join(new)
+
+
+_CELLS = {
+    "customer_account_id": [None, float("nan"), "", " ", "nan", "NULL", "12", " 12.0 ", "-3", "0",
+                            "abc", "1e3", 7, 7.0, 8.9, -1],
+    "filial_id": [None, float("nan"), "", "2", "2.5", "x", 3, 3.0, " 4 "],
+    "street_name": [None, float("nan"), "", " ", "none", "Abay", " Satpayev ", 5, 5.0],
+    "house": [None, float("nan"), "", "null", "10", "10.0", "10a", 10, 10.5, -2],
+    "flat": [None, float("nan"), "", "3", "3b", 3.0],
+    "zip_code": [None, "050000", "50000.0", "A1", 50000],
+    "town_name": [None, "Almaty", " "],
+}
+
+
+def test_mixed_object_cells_match_legacy_loop():
+    rng = random.Random(20240601)
+    rows = [{col: rng.choice(values) for col, values in _CELLS.items()} for _ in range(2000)]
+    df = pd.DataFrame(rows, columns=list(_CELLS), dtype=object)
+    new, old = _messages(df)
+    assert new == old
+    assert len(new) > 500  # the fuzz hits the error paths
+
+
+def test_first_row_numpy_value_is_shown_as_python_value():
+    df = pd.DataFrame({"customer_account_id": [float("nan"), 2.0], "filial_id": [1, 1],
+                       "street_name": ["Abay", "Abay"], "house": [1.0, float("nan")]})
+    new, old = _messages(df)
+    assert new == old == [
+        "Row 1: Missing customer_account_id. Column 'customer_account_id' found. "
+        "First row value: nan. "
+        "Available columns: ['customer_account_id', 'filial_id', 'street_name', 'house']",
+        "Row 2: Missing required address field 'house' for customer_account_id 2 "
+        "(column 'house' value: nan)",
+    ]
@@ -0,0 +1,136 @@
+"""
+Write-behind queue for landing open/expiry tracking.
+
+A landing view used to commit `opened_at`/`status='OPENED'` (or `EXPIRED`)
+synchronously, turning each page view into a serialized SQLite write. The
+landing now records these state changes in memory; a background thread flushes
+them in one executemany transaction every TRACKING_FLUSH_INTERVAL seconds, or
+sooner once TRACKING_FLUSH_MAX_BATCH links are pending. Repeated opens of the
+same link coalesce into one update that keeps the first open time.
+
+The updates are guarded so a late flush never overwrites a decision: an open
+only moves NEW -> OPENED and keeps the first opened_at, an expiry only moves
+NEW/OPENED -> EXPIRED. Pending changes are flushed on graceful shutdown (see
+app.shutdown_background_tasks); a hard kill loses at most one interval of
+opens, which is acceptable for tracking data.
+"""
+import logging
+import threading
+
+from db import db, now_iso
+
+
+class LinkTracker:
+    """Coalescing in-memory queue of link opens/expiries with a periodic flusher."""
+
+    def __init__(self, app):
+        self.write_behind = bool(app.config.get("TRACKING_WRITE_BEHIND", True))
+        self.flush_interval = float(app.config.get("TRACKING_FLUSH_INTERVAL") or 1)
+        self.max_batch = max(1, int(app.config.get("TRACKING_FLUSH_MAX_BATCH") or 500))
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time (timer, size trigger, shutdown)
+        self._opened = {}     # link_id -> first opened_at seen
+        self._expired = set()
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._stats = {"opens_recorded": 0, "expiries_recorded": 0, "coalesced": 0,
+                       "flushes": 0, "rows_flushed": 0, "flush_failures": 0}
+
+    # ----- lifecycle -----
+    def start(self):
+        if not self.write_behind or (self._thread and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="link-tracker", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop the flusher and write whatever is still pending."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    # ----- recording -----
+    def record_open(self, link_id: int):
+        opened_at = now_iso()
+        with self._lock:
+            self._stats["opens_recorded"] += 1
+            if link_id in self._opened:
+                self._stats["coalesced"] += 1
+            else:
+                self._opened[link_id] = opened_at
+            pending = len(self._opened) + len(self._expired)
+        self._after_record(pending)
+
+    def record_expired(self, link_id: int):
+        with self._lock:
+            self._stats["expiries_recorded"] += 1
+            if link_id in self._expired:
+                self._stats["coalesced"] += 1
+            self._expired.add(link_id)
+            pending = len(self._opened) + len(self._expired)
+        self._after_record(pending)
+
+    def _after_record(self, pending: int):
+        if not self.write_behind or not (self._thread and self._thread.is_alive()):
+            # Synchronous mode (or flusher not running): write immediately, as before
+            self.flush()
+        elif pending >= self.max_batch:
+            self._wake.set()
+
+    # ----- flushing -----
+    def _loop(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.flush_interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logging.exception("Link tracking flush failed")
+
+    def flush(self) -> int:
+        """Write pending opens/expiries in one transaction; returns the number of links written."""
+        with self._flush_lock:
+            with self._lock:
+                opened, self._opened = self._opened, {}
+                expired, self._expired = self._expired, set()
+            if not opened and not expired:
+                return 0
+            try:
+                with db() as conn:
+                    c = conn.cursor()
+                    if opened:
+                        c.executemany("""UPDATE links
+                                            SET opened_at=COALESCE(opened_at, ?),
+                                                status=CASE WHEN status='NEW' THEN 'OPENED'
+                                                            ELSE status END
+                                          WHERE id=?""",
+                                      [(ts, link_id) for link_id, ts in opened.items()])
+                    if expired:
+                        c.executemany("""UPDATE links SET status='EXPIRED'
+                                          WHERE id=? AND status IN ('NEW', 'OPENED')""",
+                                      [(link_id,) for link_id in expired])
+                    conn.commit()
+            except Exception:
+                # Put the batch back (keeping the earliest open time) and retry on the next flush
+                with self._lock:
+                    for link_id, ts in opened.items():
+                        self._opened[link_id] = min(ts, self._opened.get(link_id, ts))
+                    self._expired |= expired
+                    self._stats["flush_failures"] += 1
+                raise
+            n = len(opened) + len(expired)
+            with self._lock:
+                self._stats["flushes"] += 1
+                self._stats["rows_flushed"] += n
+            return n
+
+    def stats(self) -> dict:
+        with self._lock:
+            out = dict(self._stats, pending=len(self._opened) + len(self._expired))
+        out["write_behind"] = self.write_behind
+        out["flush_interval"] = self.flush_interval
+        return out
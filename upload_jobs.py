@@ -0,0 +1,288 @@
+"""
+Background processing of segment uploads.
+
+POST /admin/uploads/new only checks the header, saves the file under
+UPLOAD_DIR and inserts a QUEUED bulk_uploads row; the admin is redirected to
+the upload page, which polls GET /admin/uploads/<id>/progress. An
+UploadJobRunner in each gunicorn worker claims queued uploads and processes
+them chunk by chunk (upload_reader -> upload_validation -> ingest) in a
+background thread. At most UPLOAD_JOBS_MAX_RUNNING uploads run at once across
+all workers, so the others keep serving landing traffic.
+
+Every chunk commits its links together with the progress counters and a
+heartbeat. A job whose worker died is re-claimed once its heartbeat is older
+than UPLOAD_JOB_LEASE_SECONDS and resumes after the last committed row; a
+worker that shuts down hands its job back to the queue the same way. An
+upload deleted while running stops at its next chunk.
+"""
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import Future
+from contextlib import closing
+
+import metrics
+from db import db, now_iso
+from ingest import ingest_rows
+from parallel import LazyPool, sign_link_tokens
+from snapshots import set_head
+from upload_reader import UploadReadError, read_chunks
+from upload_validation import resolve_columns, validate_frame
+
+QUEUED = "QUEUED"
+RUNNING = "RUNNING"
+DONE = "DONE"
+FAILED = "FAILED"
+
+# Row error messages kept per upload (the page shows them, the rest are counted)
+MESSAGES_KEPT = 10
+
+NO_VALID_ROWS = "No valid rows found in file. Please check the file format."
+
+
+def _iso_in(seconds: float) -> str:
+    at = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+    return at.isoformat()
+
+
+def save_file(file, upload_dir: str) -> str:
+    """Store an uploaded file under upload_dir with a unique name; returns its path."""
+    os.makedirs(upload_dir, exist_ok=True)
+    ext = os.path.splitext(file.filename or "")[1].lower()
+    path = os.path.join(upload_dir, f"{uuid.uuid4().hex}{ext}")
+    file.save(path)
+    return path
+
+
+def remove_file(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logging.warning(f"Could not remove upload file {path}: {e}")
+
+
+def progress(row) -> dict:
+    """JSON-ready progress of a bulk_uploads row."""
+    elapsed = None
+    if row["started_at"]:
+        started = datetime.datetime.fromisoformat(row["started_at"])
+        end = (datetime.datetime.fromisoformat(row["finished_at"]) if row["finished_at"]
+               else datetime.datetime.now(datetime.timezone.utc))
+        elapsed = max((end - started).total_seconds(), 0.0)
+    rows_parsed = row["rows_parsed"] or 0
+    return {
+        "id": row["id"],
+        "status": row["status"],
+        "rows_parsed": rows_parsed,
+        "rows_valid": row["rows_valid"] or 0,
+        "rows_rejected": row["rows_rejected"] or 0,
+        "links_created": row["links_created"] or 0,
+        "started_at": row["started_at"],
+        "finished_at": row["finished_at"],
+        "elapsed_seconds": round(elapsed, 3) if elapsed is not None else None,
+        "rows_per_second": round(rows_parsed / elapsed, 1) if elapsed else None,
+        "error": row["error"],
+        "messages": json.loads(row["messages_json"] or "[]"),
+    }
+
+
+class UploadJobRunner:
+    """Background poller that processes queued uploads one at a time."""
+
+    def __init__(self, app):
+        self.chunk_rows = int(app.config.get("UPLOAD_CHUNK_ROWS") or 50000)
+        self.poll_interval = float(app.config.get("UPLOAD_JOBS_POLL_INTERVAL") or 2)
+        self.max_running = max(1, int(app.config.get("UPLOAD_JOBS_MAX_RUNNING") or 1))
+        self.processes = int(app.config.get("UPLOAD_PROCESSES") or 0)
+        self.secret_key = app.config["SECRET_KEY"]
+        # A RUNNING upload without a chunk commit for this long is re-claimed by another worker
+        self.lease_seconds = float(app.config.get("UPLOAD_JOB_LEASE_SECONDS") or 300)
+        self._thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+
+    # ----- lifecycle -----
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name="upload-jobs", daemon=True)
+        self._thread.start()
+        logging.info(f"Upload job runner started (poll {self.poll_interval}s)")
+
+    def stop(self):
+        """Stop polling; a running upload is handed back to the queue after its current chunk."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=30)
+
+    def wake(self):
+        """Look for queued uploads now (e.g. right after one was created)."""
+        self._wake.set()
+
+    # ----- polling -----
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                job = self._claim()
+                if job is not None:
+                    self._run(job)
+                    continue  # there may be more queued uploads
+            except Exception:
+                logging.exception("Upload job poll failed")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def _claim(self):
+        now = now_iso()
+        stale_before = _iso_in(-self.lease_seconds)
+        token = uuid.uuid4().hex
+        with db() as conn:
+            c = conn.cursor()
+            # One statement under the write lock: the running count cannot change in between
+            c.execute("""UPDATE bulk_uploads
+                            SET status='RUNNING', claim_token=?, heartbeat_at=?,
+                                started_at=COALESCE(started_at, ?)
+                          WHERE id = (SELECT id FROM bulk_uploads
+                                       WHERE status='QUEUED'
+                                          OR (status='RUNNING' AND heartbeat_at<=?)
+                                       ORDER BY id LIMIT 1)
+                            AND (SELECT COUNT(*) FROM bulk_uploads
+                                  WHERE status='RUNNING' AND heartbeat_at>?) < ?
+                      RETURNING *""",
+                      (token, now, now, stale_before, stale_before, self.max_running))
+            job = c.fetchone()
+            conn.commit()
+        return dict(job) if job else None
+
+    # ----- execution -----
+    def _run(self, job: dict):
+        upload_id = job["id"]
+        if job["rows_parsed"]:
+            logging.info(f"Upload {upload_id}: resuming after row {job['rows_parsed']}")
+        try:
+            outcome = self._process(job)
+        except Exception as e:
+            logging.exception(f"Upload {upload_id} failed")
+            message = str(e) if isinstance(e, UploadReadError) else f"Failed to parse file: {e}"
+            # Chunks committed before the error stay: their links may already be opened, agreed
+            # or exported. The upload stays as FAILED with the error and the links it did create.
+            with db() as conn:
+                c = conn.cursor()
+                c.execute("""UPDATE bulk_uploads
+                                SET status='FAILED', error=?, finished_at=?, file_path=NULL
+                              WHERE id=? AND claim_token=?
+                          RETURNING links_created""",
+                          (message, now_iso(), upload_id, job["claim_token"]))
+                row = c.fetchone()
+                conn.commit()
+            if row and row[0]:
+                logging.info(f"Upload {upload_id}: keeping {row[0]} links created before the error")
+            outcome = FAILED
+        if outcome in (DONE, FAILED):
+            remove_file(job["file_path"])
+
+    def _validated(self, fh, job: dict, pool: LazyPool):
+        """(rows, (clean, errors)) per chunk not committed yet, in file order.
+
+        With UPLOAD_PROCESSES > 1 chunks are validated in a process pool, up to one chunk
+        per process in flight; the job's pool is started once the file turns out to span chunks.
+        """
+        skip = job["rows_parsed"] or 0  # rows committed before a restart
+        first_row = skip + 1
+        cols, executor = None, None
+        pending: deque[tuple[int, Future]] = deque()  # (rows, validate_frame future)
+        for df in read_chunks(fh, job["filename"], self.chunk_rows):
+            if cols is None:
+                cols = resolve_columns(df.columns)  # header was checked when the upload was queued
+            if skip:
+                if skip >= len(df):
+                    skip -= len(df)
+                    continue
+                df, skip = df.iloc[skip:], 0
+            if executor is None and len(df) >= self.chunk_rows:
+                executor = pool.get()
+            if executor is None:
+                yield len(df), validate_frame(df, cols, first_row)
+            else:
+                pending.append((len(df), executor.submit(validate_frame, df, cols, first_row)))
+                if len(pending) >= self.processes:
+                    rows, future = pending.popleft()
+                    yield rows, future.result()
+            first_row += len(df)
+        while pending:
+            rows, future = pending.popleft()
+            yield rows, future.result()
+
+    def _process(self, job: dict):
+        """DONE / FAILED; QUEUED when handed back on shutdown, None when deleted or re-claimed."""
+        upload_id, token = job["id"], job["claim_token"]
+        total = job["rows_parsed"] or 0
+        valid, rejected = job["rows_valid"] or 0, job["rows_rejected"] or 0
+        created = job["links_created"] or 0
+        messages = json.loads(job["messages_json"] or "[]")
+
+        with open(job["file_path"], "rb") as fh, db() as conn, LazyPool(self.processes) as pool, \
+                closing(self._validated(fh, job, pool)) as validated:
+            c = conn.cursor()
+            chunk_started = time.monotonic()
+            for rows, (clean, error_frame) in validated:
+                if self._stop.is_set():
+                    c.execute("""UPDATE bulk_uploads SET status='QUEUED', claim_token=NULL
+                                  WHERE id=? AND claim_token=?""", (upload_id, token))
+                    conn.commit()
+                    return QUEUED
+
+                chunk_links = ingest_rows(
+                    c, clean, upload_id=upload_id, offer_id=job["offer_id"],
+                    expires_at=job["expires_at"], snapshot_id=job["snapshot_id"],
+                    product_key=job["product_key"],
+                    external_prefix=job["external_prefix"] or "BATCH",
+                    sign_tokens=lambda ids: sign_link_tokens(self.secret_key, ids, pool))
+                created += chunk_links
+                total += rows
+                valid += len(clean)
+                rejected += len(error_frame)
+                messages.extend(error_frame["message"].head(MESSAGES_KEPT - len(messages)).tolist())
+                c.execute("""UPDATE bulk_uploads
+                                SET rows_parsed=?, rows_valid=?, rows_rejected=?, links_created=?,
+                                    count_total=?, messages_json=?, heartbeat_at=?
+                              WHERE id=? AND claim_token=? AND status='RUNNING'""",
+                          (total, valid, rejected, created, total,
+                           json.dumps(messages, ensure_ascii=False), now_iso(), upload_id, token))
+                if c.rowcount == 0:
+                    conn.rollback()
+                    logging.info(f"Upload {upload_id} was deleted or re-claimed; stopping")
+                    return None
+                conn.commit()
+                metrics.upload_chunk(len(clean), len(error_frame), chunk_links,
+                                     time.monotonic() - chunk_started)
+                chunk_started = time.monotonic()
+
+            if created == 0:
+                status, error = FAILED, NO_VALID_ROWS
+            else:
+                status, error = DONE, None
+                # Product-bound links follow the snapshot of the newest upload
+                if job["product_key"]:
+                    set_head(c, job["offer_id"], job["product_key"], job["snapshot_id"])
+            c.execute("""UPDATE bulk_uploads SET status=?, error=?, finished_at=?, file_path=NULL
+                          WHERE id=? AND claim_token=?""",
+                      (status, error, now_iso(), upload_id, token))
+            if c.rowcount == 0:
+                conn.rollback()
+                return None
+            conn.commit()
+        logging.info(f"Upload {upload_id} {status.lower()}: {total} rows, {created} links, "
+                     f"{rejected} rejected")
+        return status
+
@@ -0,0 +1,117 @@
+"""
+Chunked reading of segment upload files.
+
+read_chunks() yields the uploaded file as DataFrames of at most `chunk_rows`
+rows, so memory stays bounded by the chunk size rather than the file size:
+
+  * CSV: the encoding is checked first by streaming the file through an
+    incremental UTF-8 decoder (windows-1251 if that fails), then pandas reads
+    it in chunks straight from the upload stream;
+  * XLSX: openpyxl's read-only row iterator; cells are converted and parsed
+    the way pd.read_excel does (header mangling, NA strings, types), chunk by
+    chunk.
+
+The first chunk always carries the header, even when the file has no rows.
+Column dtypes are inferred per chunk.
+"""
+import codecs
+
+import pandas as pd
+from pandas.io.parsers import TextParser
+
+_DETECT_BLOCK_BYTES = 1 << 20
+
+
+class UploadReadError(ValueError):
+    """The file cannot be read; str() is the message shown to the admin."""
+
+
+def csv_encoding(stream) -> str:
+    """'utf-8' if the whole stream decodes as UTF-8, else 'windows-1251'. Rewinds the stream."""
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    stream.seek(0)
+    try:
+        while True:
+            block = stream.read(_DETECT_BLOCK_BYTES)
+            if not block:
+                decoder.decode(b"", final=True)
+                return "utf-8"
+            decoder.decode(block)
+    except UnicodeDecodeError:
+        return "windows-1251"
+    finally:
+        stream.seek(0)
+
+
+def _csv_chunks(stream, chunk_rows: int):
+    encoding = csv_encoding(stream)
+    try:
+        with pd.read_csv(stream, encoding=encoding, chunksize=chunk_rows) as reader:
+            yield from reader
+    except Exception as e:
+        if encoding == "utf-8":
+            raise
+        raise UploadReadError(
+            f"Failed to parse CSV file. Tried UTF-8 and Windows-1251. Error: {e}") from e
+
+
+def _xlsx_cell(cell):
+    # Same conversion as pandas' openpyxl reader
+    from openpyxl.cell.cell import TYPE_ERROR, TYPE_NUMERIC
+
+    if cell.value is None:
+        return ""
+    if cell.data_type == TYPE_ERROR:
+        return float("nan")
+    if cell.data_type == TYPE_NUMERIC:
+        value = int(cell.value)
+        return value if value == cell.value else float(cell.value)
+    return cell.value
+
+
+def _xlsx_chunks(stream, chunk_rows: int):
+    from openpyxl import load_workbook
+
+    book = load_workbook(stream, read_only=True, data_only=True, keep_links=False)
+    try:
+        sheet = book.worksheets[0]
+        sheet.reset_dimensions()
+        rows = iter(sheet.rows)
+        header = [_xlsx_cell(cell) for cell in next(rows, ())]
+        while header and header[-1] == "":
+            header.pop()
+        width = len(header)
+        if not width:
+            yield pd.DataFrame()
+            return
+
+        def frame(data):
+            return TextParser([header] + data, header=0).read()
+
+        chunk, empty, sent = [], [], False
+        for row in rows:
+            values = [_xlsx_cell(cell) for cell in row]
+            if not any(v != "" for v in values):
+                # pd.read_excel drops trailing empty rows only: hold them until data follows
+                empty.append([""] * width)
+                continue
+            chunk.extend(empty)
+            empty = []
+            # Cells right of the header only ever land in unnamed columns: dropped
+            chunk.append(values[:width] + [""] * (width - len(values)))
+            if len(chunk) >= chunk_rows:
+                yield frame(chunk)
+                chunk, sent = [], True
+        if chunk or not sent:
+            yield frame(chunk)
+    finally:
+        book.close()
+
+
+def read_chunks(file, filename: str, chunk_rows: int):
+    """Yield the upload as DataFrames of at most chunk_rows rows (CSV by extension, else XLSX)."""
+    chunk_rows = max(1, int(chunk_rows))
+    stream = getattr(file, "stream", file)
+    if filename.lower().endswith(".csv"):
+        return _csv_chunks(stream, chunk_rows)
+    return _xlsx_chunks(stream, chunk_rows)
@@ -0,0 +1,399 @@
+"""
+Column-wise parsing and validation of segment upload files.
+
+validate_frame() turns the uploaded DataFrame into a clean frame (one row per
+valid input row, values ready to insert) and an error frame (one row per
+rejected input row, first error only), using pandas/NumPy operations per
+column instead of a Python loop per row. Messages and parsing rules are the
+ones upload_new applied row by row:
+
+  * customer_account_id: int(float(value)), must be positive;
+  * filial_id: int(value);
+  * street_id / house / flat: int(float(value)); zip_code: str(int(float(value)));
+  * street_name / house are required; text fields are stripped;
+  * phone / identification_number lose a trailing ".0" (Excel floats);
+  * customer_id is optional and silently dropped when invalid or not positive.
+
+Values the vectorized parsers cannot handle (underscored numbers, odd types in
+object columns, ...) fall back to the same Python conversion for those rows
+only, so results match the old per-row code.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+
+NULL_WORDS = ("nan", "none", "null")
+
+# File column -> address JSON key, in the order the keys appear in links.address_json
+ADDRESS_COLUMNS = {
+    "town_name": "TOWN_NAME",
+    "street_name": "STREET_NAME",
+    "street_id": "STREET_ID",  # Keep for API compatibility
+    "house": "HOUSE",
+    "sub_house": "SUB_HOUSE",
+    "flat": "FLAT",
+    "sub_flat": "SUB_FLAT",
+    "zip_code": "ZIP_CODE",
+}
+REQUIRED_ADDRESS_COLUMNS = ("street_name", "house")
+_INT_ADDRESS_KEYS = ("STREET_ID", "HOUSE", "FLAT")
+
+NAME_ALIASES = ("name", "full_name", "customer_name", "contact_name")
+IDENTIFICATION_ALIASES = ("identification_number", "iin", "iin_bin", "iin/bin", "bin")
+
+# Largest magnitude that still fits a SQLite INTEGER
+_INT64_LIMIT = 2 ** 63
+
+CLEAN_COLUMNS = ["row", "customer_account_id", "filial_id", "customer_id", "phone", "name",
+                 "identification_number", "address_json"]
+ERROR_COLUMNS = ["row", "customer_account_id", "message"]
+
+
+class UploadFormatError(ValueError):
+    """The file as a whole cannot be imported (missing required columns)."""
+
+
+def _find_column(columns, *names):
+    for col in columns:
+        if str(col).lower().strip() in names:
+            return col
+    return None
+
+
+def _available_columns(columns, limit=10):
+    available = ", ".join([f"'{c}'" for c in list(columns)[:limit]])
+    if len(columns) > limit:
+        available += f", ... ({len(columns)} total columns)"
+    return available
+
+
+def resolve_columns(columns) -> dict:
+    """Map logical upload fields to the file's column names (case insensitive).
+
+    Raises UploadFormatError with the message shown to the admin when a required
+    column is missing. Returns a dict with keys customer_account_id, filial_id,
+    customer_id, name, identification_number, phone (None when absent),
+    address (logical address column -> file column) and warnings.
+    """
+    columns = list(columns)
+    customer_col = _find_column(columns, "customer_account_id")
+    if not customer_col:
+        raise UploadFormatError(
+            f"File must contain 'customer_account_id' column. "
+            f"Found columns: {_available_columns(columns)}")
+    filial_col = _find_column(columns, "filial_id")
+    if not filial_col:
+        raise UploadFormatError(
+            f"File must contain 'filial_id' column. Found columns: {_available_columns(columns)}")
+
+    columns_lower = [str(c).lower() for c in columns]
+    missing_cols = [col for col in REQUIRED_ADDRESS_COLUMNS if col not in columns_lower]
+    if missing_cols:
+        raise UploadFormatError(
+            f"File must contain required address columns: {', '.join(missing_cols)}")
+
+    address = {}
+    for excel_col in ADDRESS_COLUMNS:
+        col = _find_column(columns, excel_col)
+        if col is not None:
+            address[excel_col] = col
+    warnings = []
+    missing_address_cols = [col for col in REQUIRED_ADDRESS_COLUMNS if col not in address]
+    if missing_address_cols:
+        warnings.append(f"Warning: Some required address columns not found: "
+                        f"{', '.join(missing_address_cols)}. "
+                        f"Available columns: {_available_columns(columns, limit=len(columns))}")
+
+    return {
+        "customer_account_id": customer_col,
+        "filial_id": filial_col,
+        "customer_id": _find_column(columns, "customer_id"),
+        "name": _find_column(columns, *NAME_ALIASES),
+        "identification_number": _find_column(columns, *IDENTIFICATION_ALIASES),
+        "phone": "phone" if "phone" in columns else None,  # exact name, as before
+        "address": address,
+        "warnings": warnings,
+    }
+
+
+# ----- column parsers -----
+def _is_numeric(raw: pd.Series) -> bool:
+    return pd.api.types.is_numeric_dtype(raw) and not pd.api.types.is_bool_dtype(raw)
+
+
+def _text(raw: pd.Series) -> pd.Series:
+    """str(value).strip() for every cell ('' where the cell is missing)."""
+    strings = raw.astype(str)
+    if not _is_numeric(raw):  # str() of a number has no surrounding whitespace
+        strings = strings.str.strip()
+    return strings.where(raw.notna(), "").astype(object)
+
+
+def _is_blank(raw: pd.Series) -> pd.Series:
+    """pd.isna(value) or value == ''"""
+    if _is_numeric(raw):
+        return raw.isna()
+    return raw.isna() | (raw == "")
+
+
+def _null_word(text: pd.Series) -> pd.Series:
+    """Stripped text is 'nan' / 'none' / 'null' (any case)."""
+    out = pd.Series(False, index=text.index)
+    short = text.str.len().isin((3, 4)).to_numpy()
+    if short.any():
+        out[short] = text[short].str.lower().isin(NULL_WORDS)
+    return out
+
+
+def _has_text(raw: pd.Series, text: pd.Series) -> pd.Series:
+    """Not missing, and the stripped text is not empty / nan / none / null."""
+    return raw.notna() & (text != "") & ~_null_word(text)
+
+
+def _py(value):
+    # Messages show values as the old per-row loop did: Python scalars, not np.float64(nan)
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _keep(values, mask) -> np.ndarray:
+    """Object array of values where mask is set, None elsewhere."""
+    if isinstance(values, pd.Series):
+        values = values.to_numpy(dtype=object)
+    values = np.asarray(values, dtype=object)
+    keep = np.asarray(mask, dtype=bool)
+    out = np.full(len(values), None, dtype=object)
+    out[keep] = values[keep]
+    return out
+
+
+def _slow(values, fn):
+    """Apply a Python conversion to the few cells the vectorized path could not parse."""
+    results, errors = [], []
+    for v in values:
+        try:
+            results.append(fn(v))
+            errors.append(None)
+        except (ValueError, TypeError, OverflowError) as e:
+            results.append(None)
+            errors.append(e)
+    return results, errors
+
+
+def _to_int64(values: pd.Series, ok: pd.Series):
+    """Truncate floats to int64 where they are finite and fit. Returns (values, fits)."""
+    values = values.where(ok).astype("float64")
+    fits = ok & np.isfinite(values) & (values.abs() < _INT64_LIMIT)
+    return np.trunc(values.where(fits, 0)).astype("int64"), fits
+
+
+def _parse_float_int(raw: pd.Series, text: pd.Series, candidates: pd.Series):
+    """int(float(str(value))) per cell. Returns (int64 values, ok mask, {position: error})."""
+    if _is_numeric(raw):
+        values = raw.astype("float64")
+    else:
+        values = pd.Series(np.asarray(pd.to_numeric(text.where(candidates), errors="coerce"),
+                                      dtype="float64"), index=raw.index)
+    errors = {}
+    retry = (candidates & values.isna()).to_numpy()
+    if retry.any():
+        results, errs = _slow(text[retry].tolist(), float)
+        for pos, res, err in zip(np.flatnonzero(retry), results, errs):
+            if err is None:
+                values.iat[pos] = res
+            else:
+                errors[pos] = err
+    ints, fits = _to_int64(values, candidates & values.notna())
+    # nan / inf / too large: keep the error int() raises
+    for pos in np.flatnonzero((candidates & ~fits).to_numpy()):
+        if pos not in errors:
+            try:
+                int(values.iat[pos])
+                errors[pos] = OverflowError("value out of range")
+            except (ValueError, OverflowError) as e:
+                errors[pos] = e
+    return ints, fits, errors
+
+
+def _parse_int(raw: pd.Series, candidates: pd.Series):
+    """int(value) per cell. Returns (int64 values, ok mask)."""
+    if pd.api.types.is_bool_dtype(raw) or pd.api.types.is_integer_dtype(raw):
+        return raw.where(candidates, 0).astype("int64"), candidates.copy()
+    if pd.api.types.is_float_dtype(raw):
+        return _to_int64(raw, candidates)
+    strings = raw.astype(str).where(raw.notna(), "")
+    fast = (candidates & strings.str.fullmatch(r"\s*[+-]?\d+\s*").astype(bool)).to_numpy()
+    values = pd.Series(np.nan, index=raw.index, dtype="float64")
+    if fast.any():
+        values[fast] = pd.to_numeric(strings[fast].str.strip(), errors="coerce").astype("float64")
+    retry = (candidates & ~fast).to_numpy()
+    if retry.any():
+        results, _ = _slow(raw[retry].tolist(), int)
+        for pos, res in zip(np.flatnonzero(retry), results):
+            if res is not None:
+                values.iat[pos] = float(res)
+    return _to_int64(values, candidates & values.notna())
+
+
+def _json_fragments(values: np.ndarray) -> np.ndarray:
+    """json.dumps() of each non-None value, encoded once per distinct value."""
+    present = np.array([v is not None for v in values], dtype=bool)
+    out = np.full(len(values), None, dtype=object)
+    if present.any():
+        codes, uniques = pd.factorize(pd.Series(values[present], dtype=object))
+        encoded = np.array([json.dumps(u) for u in uniques], dtype=object)
+        out[present] = encoded[codes]
+    return out
+
+
+def _address_json(address_values, n: int) -> np.ndarray:
+    """json.dumps(address) for every row, built column by column.
+
+    Produces exactly what json.dumps() of the per-row dict gives: keys in
+    ADDRESS_COLUMNS order, None values left out, default separators.
+    """
+    acc = np.full(n, "", dtype=object)
+    for api_key, values in address_values:
+        frags = _json_fragments(values)
+        present = frags != None  # noqa: E711 (elementwise)
+        sep = np.where(acc != "", ", ", "")
+        pair = json.dumps(api_key) + ": " + np.where(present, frags, "")
+        acc = np.where(present, acc + sep + pair, acc)
+    return "{" + acc + "}"
+
+
+def validate_frame(df: pd.DataFrame, cols: dict, first_row: int = 1):
+    """Validate an upload frame. Returns (clean, errors) DataFrames.
+
+    clean has CLEAN_COLUMNS (row is the 1-based row number in the file),
+    errors has ERROR_COLUMNS with the message shown to the admin.
+    first_row: file row number of df's first row (chunked reads).
+    """
+    df = df.reset_index(drop=True)
+    n = len(df)
+    rows = np.arange(first_row, first_row + n)
+    error = np.full(n, None, dtype=object)
+
+    def fail(mask, make_message):
+        # Only the first failing check of a row is reported, as before
+        for pos in np.flatnonzero(np.asarray(mask, dtype=bool) & (error == None)):  # noqa: E711
+            error[pos] = f"Row {rows[pos]}: {make_message(pos)}"
+
+    # customer_account_id
+    customer_col = cols["customer_account_id"]
+    raw = df[customer_col]
+    missing = _is_blank(raw)
+    if n and first_row == 1 and missing.iat[0]:
+        first = raw.iat[0]
+        fail(rows == 1, lambda pos: (
+            f"Missing customer_account_id. Column '{customer_col}' found. "
+            f"First row value: {repr(_py(first))}. "
+            f"Available columns: {list(df.columns)[:5]}"))
+    fail(missing, lambda pos: "Missing customer_account_id (empty or NaN)")
+    text = _text(raw)
+    blank = ~missing & ((text == "") | _null_word(text))
+    fail(blank, lambda pos: f"Missing customer_account_id (value: '{raw.iat[pos]}')")
+    candidates = ~missing & ~blank
+    account_ids, ok, parse_errors = _parse_float_int(raw, text, candidates)
+    fail(candidates & ~ok, lambda pos: (
+        f"Invalid customer_account_id (value: '{raw.iat[pos]}', "
+        f"type: {type(raw.iat[pos]).__name__}, "
+        f"error: {str(parse_errors.get(pos))})"))
+    fail(ok & (account_ids <= 0), lambda pos: (
+        f"Invalid customer_account_id (must be positive, got: {account_ids.iat[pos]})"))
+
+    # filial_id
+    raw = df[cols["filial_id"]]
+    missing = _is_blank(raw)
+    fail(missing, lambda pos: f"Missing 'filial_id' for customer_account_id {account_ids.iat[pos]}")
+    filial_ids, ok = _parse_int(raw, ~missing)
+    fail(~missing & ~ok, lambda pos: (
+        f"Invalid 'filial_id' for customer_account_id {account_ids.iat[pos]}"))
+
+    # address: columns are checked in ADDRESS_COLUMNS order, first error wins
+    address_values = []  # (api_key, object array of value-or-None)
+    street = None
+    for excel_col, api_key in ADDRESS_COLUMNS.items():
+        df_col = cols["address"].get(excel_col)
+        if df_col is None:
+            continue
+        raw = df[df_col]
+        text = _text(raw)
+        present = ~_is_blank(raw) & ~_null_word(text)
+        if api_key in _INT_ADDRESS_KEYS or api_key == "ZIP_CODE":
+            ints, ok, _ = _parse_float_int(raw, text, present)
+            fail(present & ~ok, lambda pos, raw=raw, excel_col=excel_col: (
+                f"Invalid '{excel_col}' value '{raw.iat[pos]}' "
+                f"for customer_account_id {account_ids.iat[pos]} "
+                f"(must be a number)"))
+            values = _keep(ints.astype(str) if api_key == "ZIP_CODE" else ints, ok)
+        else:
+            values = _keep(text, present & (text != ""))
+        if excel_col in REQUIRED_ADDRESS_COLUMNS:
+            fail(~present, lambda pos, raw=raw, excel_col=excel_col, df_col=df_col: (
+                f"Missing required address field '{excel_col}' "
+                f"for customer_account_id {account_ids.iat[pos]} "
+                f"(column '{df_col}' value: {repr(_py(raw.iat[pos]))})"))
+        if api_key == "STREET_NAME":
+            street = (raw, text)
+        address_values.append((api_key, values))
+
+    # A street_name of only whitespace is present but empty once stripped
+    if street is not None:
+        street_raw, street_text = street
+        fail(street_text == "", lambda pos: (
+            f"Missing or invalid 'street_name' for customer_account_id {account_ids.iat[pos]} "
+            f"(found value: {repr(_py(street_raw.iat[pos]))})"))
+
+    valid = error == None  # noqa: E711 (elementwise)
+    none = np.full(n, None, dtype=object)
+
+    # phone (optional): strip, drop the ".0" of numbers Excel stored as floats
+    phone = none
+    if cols.get("phone"):
+        raw = df[cols["phone"]]
+        text = _text(raw)
+        phone = _keep(text.where(~text.str.endswith(".0"), text.str[:-2]), ~_is_blank(raw))
+
+    name = none
+    if cols.get("name"):
+        raw = df[cols["name"]]
+        text = _text(raw)
+        name = _keep(text, _has_text(raw, text))
+
+    identification = none
+    if cols.get("identification_number"):
+        raw = df[cols["identification_number"]]
+        text = _text(raw)
+        trimmed = text.where(~text.str.endswith(".0"), text.str[:-2])
+        identification = _keep(trimmed, _has_text(raw, text))
+
+    customer_id = none
+    if cols.get("customer_id"):
+        raw = df[cols["customer_id"]]
+        text = _text(raw)
+        ids, ok, _ = _parse_float_int(raw, text, _has_text(raw, text))
+        customer_id = _keep(ids, ok & (ids > 0))
+
+    address_json = _address_json([(k, v[valid]) for k, v in address_values], int(valid.sum()))
+
+    clean = pd.DataFrame({
+        "row": rows[valid],
+        "customer_account_id": account_ids.to_numpy()[valid],
+        "filial_id": filial_ids.to_numpy()[valid],
+        # object dtype keeps None (not NaN) for absent optional values
+        "customer_id": pd.Series(customer_id[valid], dtype=object),
+        "phone": pd.Series(phone[valid], dtype=object),
+        "name": pd.Series(name[valid], dtype=object),
+        "identification_number": pd.Series(identification[valid], dtype=object),
+        "address_json": pd.Series(address_json, dtype=object),
+    }, columns=CLEAN_COLUMNS)
+
+    invalid = ~valid
+    errors = pd.DataFrame({
+        "row": rows[invalid],
+        "customer_account_id": pd.array(
+            [int(a) if a > 0 else None for a in account_ids.to_numpy()[invalid]], dtype="Int64"),
+        "message": pd.Series(error[invalid], dtype=object),
+    }, columns=ERROR_COLUMNS)
+    return clean, errors